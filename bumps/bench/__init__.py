@@ -0,0 +1,23 @@
+"""
+Model evaluation benchmarks.
+
+Time the evaluation of a fit problem through the serial, multiprocessing
+and MPI mappers, recording evaluations per second, mapper overhead per
+point, DREAM generations per second and the memory high water mark of
+the benchmark process so far.
+The benchmarks run on a set of bundled synthetic problems of varying cost
+and dimension (see :mod:`bumps.bench.problems`), plus any model file given
+on the command line::
+
+    bumps --bench [modelfile] [--mpi] [--pop=10] [--steps=5]
+
+Each measurement is a dictionary, written as one line of JSON to the file
+given by *--bench=file* so that the results can be tracked across machines
+and bumps versions.
+
+Only the model file is timed through the MPI mapper, since the MPI
+workers receive one problem when the mapper starts.
+"""
+
+from .problems import PROBLEMS, make_problem
+from .runner import bench_problem, environment, main
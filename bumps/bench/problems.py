@@ -0,0 +1,51 @@
+"""
+Synthetic benchmark problems.
+
+Each problem fits Gaussian peaks to simulated data with one :class:`Curve`
+per peak, so the dimension is three times the number of peaks and the
+cost of each evaluation grows with the number of peaks times the number
+of points in each peak.
+"""
+
+from numpy import exp, linspace
+from numpy.random import RandomState
+
+from ..curve import Curve
+from ..fitproblem import FitProblem
+
+# name, number of peaks, number of points per peak
+PROBLEMS = [
+    ('peak1x100', 1, 100),
+    ('peak10x100', 10, 100),
+    ('peak1x10000', 1, 10000),
+    ('peak10x10000', 10, 10000),
+    ('peak30x1000', 30, 1000),
+    ('peak10x20000', 10, 20000),
+    ]
+
+def peak(x, A=1, mu=0, sigma=1):
+    return A*exp(-0.5*((x-mu)/sigma)**2)
+
+def make_problem(npeaks, npoints, seed=1, name=None):
+    """
+    Return a fit problem with *npeaks* peaks of *npoints* points each.
+
+    The simulated data and the starting point depend only on *seed*.
+    """
+    rng = RandomState(seed)
+    x = linspace(-5, 5, npoints)
+    models = []
+    for k in range(npeaks):
+        A, mu, sigma = rng.uniform(1,10), rng.uniform(-2,2), rng.uniform(0.5,2)
+        dy = 0.05*A + 0*x
+        y = peak(x, A, mu, sigma) + rng.randn(npoints)*dy
+        M = Curve(peak, x, y, dy, name="P%d "%k, vectorized=True,
+                  A=A*rng.uniform(0.8,1.2), mu=mu+rng.uniform(-0.5,0.5),
+                  sigma=sigma*rng.uniform(0.8,1.2))
+        M.A.range(0, 2*A)
+        M.mu.range(-5, 5)
+        M.sigma.range(0.1, 4)
+        models.append(M)
+    if name is None:
+        name = "peak%dx%d"%(npeaks, npoints)
+    return FitProblem(models if npeaks > 1 else models[0], name=name)
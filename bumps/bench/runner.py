@@ -0,0 +1,173 @@
+"""
+Benchmark runner.
+
+:func:`bench_problem` returns the measurements for one problem and
+:func:`main` runs the benchmarks for *bumps --bench*.
+"""
+
+import sys
+import time
+import json
+import math
+import platform
+
+import numpy
+
+from .. import __version__
+from ..fitters import FitDriver, DreamFit
+from ..mapper import SerialMapper, MPMapper, MPIMapper
+from .problems import PROBLEMS, make_problem
+
+def environment():
+    """
+    Return the software and hardware details which are stored with each
+    measurement.
+    """
+    import multiprocessing
+    return dict(bumps=__version__,
+                python=platform.python_version(),
+                numpy=numpy.__version__,
+                platform=platform.platform(),
+                cpus=multiprocessing.cpu_count(),
+                date=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def max_rss():
+    """
+    Return the memory high water mark in kB for this process, or None if
+    it is not available on this platform.
+
+    This is the peak over the life of the process, so it includes every
+    benchmark run before the current one.  Worker processes are not
+    included, since the pool workers are still running.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1   # bytes on OS X
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//scale
+
+def time_map(mapper, points, min_time=0.5):
+    """
+    Return the wall clock time for *mapper(points)*, averaged over enough
+    calls to take *min_time* seconds.  The first call, which may start
+    a worker pool, is not included.
+    """
+    mapper(points)
+    n, t0 = 0, time.time()
+    while True:
+        mapper(points)
+        n += 1
+        t = time.time() - t0
+        if t >= min_time:
+            return t/n
+
+def time_dream(problem, mapper, pop, steps):
+    """
+    Return the DREAM generations per second for *steps* generations.
+    """
+    driver = FitDriver(DreamFit, problem=problem, monitors=[],
+                       abort_test=lambda: False, mapper=mapper,
+                       steps=steps, burn=0, pop=pop, init='lhs')
+    t0 = time.time()
+    driver.fit()
+    return steps/(time.time() - t0)
+
+def bench_problem(name, problem, mappers, pop=10, steps=10, min_time=0.5):
+    """
+    Time *problem* through each of the *mappers*, returning a list with
+    one dictionary of measurements for each mapper.
+
+    *mappers* is a list of (label, start, workers) where *start(problem)*
+    returns the mapper.  The first mapper should be the serial mapper,
+    since the overhead per point for each mapper is the time per point
+    beyond the serial time divided evenly among the workers.
+
+    The population has *pop* points per parameter, as it would for
+    DREAM, and *steps* is the number of DREAM generations to time, or 0
+    to skip the DREAM timing.
+
+    The memory high water mark *maxrss_kb* is cumulative (see
+    :func:`max_rss`), so it only gives an upper bound for the problem.
+    """
+    x0 = problem.getp()
+    points = problem.randomize(int(math.ceil(pop*len(x0))))
+    records = []
+    serial = None
+    for label, start, workers in mappers:
+        mapper = start(problem)
+        per_call = time_map(mapper, points, min_time=min_time)
+        if serial is None:
+            serial = per_call
+        gens = time_dream(problem, mapper, pop, steps) if steps else None
+        problem.setp(x0)
+        rss = max_rss()
+        records.append(dict(
+            problem=name,
+            parameters=len(x0),
+            datapoints=int(problem.model_points()),
+            mapper=label,
+            workers=workers,
+            population=len(points),
+            evals_per_sec=len(points)/per_call,
+            overhead_per_point=(per_call - serial/workers)/len(points),
+            dream_gens_per_sec=gens,
+            maxrss_kb=rss,
+            ))
+    return records
+
+def _show(record):
+    gens = record['dream_gens_per_sec']
+    print "%-16s %4d %8d %-6s %3d %12.1f %12.2f %10s %10s"%(
+        record['problem'], record['parameters'], record['datapoints'],
+        record['mapper'], record['workers'], record['evals_per_sec'],
+        record['overhead_per_point']*1e6,
+        "%.2f"%gens if gens is not None else "-",
+        record['maxrss_kb'] if record['maxrss_kb'] is not None else "-")
+    sys.stdout.flush()
+
+def main(opts, problem=None):
+    """
+    Run the benchmarks for *bumps --bench*.
+
+    *opts* are the command line options and *problem* is the fit problem
+    from the model file, if any.
+    """
+    import multiprocessing
+    cpus = multiprocessing.cpu_count()
+    pop = float(getattr(opts, 'pop', None) or 10)
+    steps = int(getattr(opts, 'steps', None) or 5)
+    if opts.mpi and problem is None:
+        raise ValueError("--bench with --mpi needs a model file")
+
+    mappers = [('serial', lambda p: SerialMapper.start_mapper(p, []), 1),
+               ('mp', lambda p: MPMapper.start_mapper(p, [], cpus=cpus), cpus)]
+    problems = [(name, make_problem(npeaks, npoints))
+                for name, npeaks, npoints in PROBLEMS]
+    if problem is not None:
+        problems.insert(0, (problem.name, problem))
+
+    env = environment()
+    print "# bumps %(bumps)s on %(platform)s with %(cpus)d cpus"%env
+    print "%-16s %4s %8s %-6s %3s %12s %12s %10s %10s"%(
+        "problem", "npar", "ndata", "mapper", "n", "evals/s",
+        "overhead us", "DREAM gen/s", "maxrss kB")
+    records = []
+    for k, (name, p) in enumerate(problems):
+        these = mappers
+        if opts.mpi and k == 0:
+            from mpi4py import MPI
+            these = mappers + [('mpi', lambda p: MPIMapper.start_mapper(p, []),
+                                MPI.COMM_WORLD.size)]
+        for record in bench_problem(name, p, these, pop=pop, steps=steps):
+            record.update(env)
+            records.append(record)
+            _show(record)
+
+    if isinstance(opts.bench, basestring):
+        with open(opts.bench, 'a') as fid:
+            for record in records:
+                fid.write(json.dumps(record, sort_keys=True)+"\n")
+    else:
+        for record in records:
+            print json.dumps(record, sort_keys=True)
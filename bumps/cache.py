@@ -0,0 +1,212 @@
+"""
+Cache of function values for repeated parameter vectors.
+
+Several fitters return to points they have already evaluated, such as the
+restart points in simplex, the best point in a multistart fit or the
+goal-seek step in DREAM.  :class:`NllfCache` remembers the most recently
+used values so that expensive models need not be evaluated twice at the
+same point.  Use :meth:`BaseFitProblem.enable_cache
+<bumps.fitproblem.BaseFitProblem.enable_cache>` to attach one to a fit
+problem.
+"""
+
+__all__ = ["NllfCache"]
+
+import sys
+from collections import OrderedDict
+
+import numpy
+
+class NllfCache(object):
+    """
+    Bounded least recently used cache of values keyed on parameter vectors.
+
+    *size* is the maximum number of values to keep.
+
+    *bits* is the number of low order mantissa bits to ignore when
+    comparing parameter vectors, so that points which differ only by
+    rounding error share a value.  The default is to compare exactly.
+
+    The cache has a data version which is part of each key.  Call
+    :meth:`invalidate` when the data changes, which clears the cache and
+    increments the version so that values still being computed for the
+    old data are not stored under the new version.
+    """
+    def __init__(self, size=10000, bits=0):
+        self.size = size
+        self.bits = bits
+        self.version = 0
+        self.hits = self.misses = 0
+        self._mask = numpy.int64(~((1<<bits)-1))
+        self._values = OrderedDict()
+        self._bytes = 0
+
+    def key(self, point):
+        """
+        Return the cache key for *point* under the current data version.
+        """
+        return self.keys(numpy.asarray(point, 'd')[None,:])[0]
+
+    def keys(self, points):
+        """
+        Return the cache keys for each row of *points*.
+        """
+        bits = numpy.ascontiguousarray(points, 'd').view('i8') & self._mask
+        return [(self.version, row.tostring()) for row in bits]
+
+    def get(self, key):
+        """
+        Return the value for *key*, or None if it is not in the cache.
+        """
+        value = self._values.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._values[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Store *value* for *key*, dropping the least recently used value if
+        the cache is full.  Values for an old data version are ignored.
+        """
+        if key[0] != self.version or self.size <= 0:
+            return
+        if key in self._values:
+            del self._values[key]
+        else:
+            self._bytes += _sizeof(key)
+        self._values[key] = value
+        while len(self._values) > self.size:
+            old, _ = self._values.popitem(last=False)
+            self._bytes -= _sizeof(old)
+
+    def invalidate(self):
+        """
+        Clear the cache and start a new data version.
+        """
+        self.version += 1
+        self._values.clear()
+        self._bytes = 0
+
+    def wrap_mapper(self, mapper):
+        """
+        Return a mapper which uses the cache, sending only the points
+        which are not already in the cache to *mapper*.
+        """
+        def cached_mapper(points):
+            points = numpy.asarray(points, 'd')
+            keys = self.keys(points)
+            values = numpy.empty(len(points), 'd')
+            missing = []
+            for i, key in enumerate(keys):
+                value = self.get(key)
+                if value is None:
+                    missing.append(i)
+                else:
+                    values[i] = value
+            if missing:
+                values[missing] = numpy.asarray(mapper(points[missing]), 'd')
+                for i in missing:
+                    self.put(keys[i], float(values[i]))
+            return values
+        return cached_mapper
+
+    def stats(self):
+        """
+        Return a dictionary with the number of *hits* and *misses*, the
+        *hit_rate*, the number of *entries* and an estimate of the memory
+        used in *bytes*.
+        """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_rate=float(self.hits)/lookups if lookups else 0.,
+                    entries=len(self._values),
+                    bytes=self._bytes + sys.getsizeof(self._values))
+
+    def __str__(self):
+        s = self.stats()
+        return ("cache hit rate %.1f%% (%d of %d) with %d entries using %.0f kB"
+                % (100*s['hit_rate'], s['hits'], s['hits']+s['misses'],
+                   s['entries'], s['bytes']/1024.))
+
+def _sizeof(key):
+    # Size of the key tuple and its contents, the float value stored with
+    # it, and the [prev, next, key] link that OrderedDict keeps for it
+    return (sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(key[1])
+            + sys.getsizeof(0.) + sys.getsizeof([None]*3))
+
+def test():
+    # Hit and miss accounting
+    cache = NllfCache(size=2)
+    a, b, c = [cache.key([v, 1.]) for v in (1., 2., 3.)]
+    assert cache.get(a) is None
+    cache.put(a, 10.)
+    assert cache.get(a) == 10.
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.stats()['hit_rate'] == 0.5
+
+    # Least recently used value is dropped when the cache is full
+    cache.put(b, 20.)
+    cache.get(a)
+    cache.put(c, 30.)
+    assert cache.get(b) is None
+    assert cache.get(a) == 10. and cache.get(c) == 30.
+    assert cache.stats()['entries'] == 2
+
+    # Low order bits are ignored only when asked
+    x = numpy.array([1., 2.])
+    y = numpy.nextafter(x, 3.)
+    assert NllfCache(bits=0).key(x) != NllfCache(bits=0).key(y)
+    assert NllfCache(bits=8).key(x) == NllfCache(bits=8).key(y)
+    assert NllfCache(bits=8).key(x) != NllfCache(bits=8).key(x+1e-10)
+
+    # Values computed for old data are not stored after invalidation
+    cache.invalidate()
+    assert cache.get(a) is None and cache.stats()['entries'] == 0
+    cache.put(a, 10.)
+    assert cache.get(cache.key([1., 1.])) is None
+
+    # Only the points which are not cached are sent to the mapper
+    cache = NllfCache()
+    sent = []
+    def mapper(points):
+        sent.extend(points.tolist())
+        return numpy.sum(points, axis=1)
+    cached = cache.wrap_mapper(mapper)
+    assert cached([[1., 2.], [3., 4.]]).tolist() == [3., 7.]
+    assert cached([[3., 4.], [5., 6.]]).tolist() == [7., 11.]
+    assert sent == [[1., 2.], [3., 4.], [5., 6.]]
+
+    # The fit problem clears its cache when the data or the fitted
+    # parameters change
+    from .parameter import Parameter
+    from .fitproblem import FitProblem
+    class Fitness(object):
+        calls = 0
+        def __init__(self):
+            self.a = Parameter(1, name='a').range(0, 10)
+        def parameters(self):
+            return dict(a=self.a)
+        def numpoints(self):
+            return 3
+        def nllf(self):
+            self.calls += 1
+            return (self.a.value - 2)**2
+        def resynth_data(self): pass
+        def restore_data(self): pass
+    fitness = Fitness()
+    problem = FitProblem(fitness)
+    problem.enable_cache()
+    assert problem.nllf([3.]) == problem.nllf([3.]) == 1.
+    assert fitness.calls == 1
+    for change in (problem.resynth_data, problem.restore_data,
+                   problem.model_reset):
+        calls = fitness.calls
+        change()
+        problem.nllf([3.])
+        assert fitness.calls == calls + 1
+
+if __name__ == "__main__":
+    test()
@@ -16,6 +16,9 @@ import numpy
 
 from . import fitters
 from .fitters import FIT_OPTIONS, FitDriver, StepMonitor, ConsoleMonitor
+from .fitters import MultiStart, resample
+from .fitproblem import instrument
+from .monitor import Timers, TimingMonitor
 from .fitproblem import load_problem as load_script
 from .mapper import MPMapper, AMQPMapper, MPIMapper, SerialMapper
 from . import util
@@ -160,10 +163,19 @@ def run_profile(problem, steps):
         1 ms setting parameters and computing nllf
 
     Using the GPU for abeles/convolution will only give us 2-3x speedup.
+
+    Before profiling, the time spent in each of the problem methods is
+    shown using the fit timers.
     """
     from .util import profile
     p = initpop.random_init(steps, problem)
 
+    timers = Timers()
+    instrument(problem, timers)
+    map(problem.nllf, p)
+    instrument(problem, None)
+    print timers.summary()
+
     # The cost of
     # To get good information from the profiler, you wil
     # Modify this function to obtain different information
@@ -247,10 +259,12 @@ class BumpsOpts(ParseOpts):
     FLAGS = set(("preview", "chisq", "profile", 
                  "simulate", "simrandom", "shake",
                  "worker", "batch", "overwrite", "parallel", "stepmon",
-                 "cov", "remote", "staj", "edit", "mpi",
+                 "steady", "memmap",
+                 "cov", "remote", "staj", "edit", "mpi", "bench",
                  "multiprocessing-fork", # passed in when app is a frozen image
                ))
     VALUES = set(("plot", "store", "resume", "fit", "noise", "seed", "pars",
+                  "checkpoint", "target", "bench", "cache",
                   "resynth", "transport", "notify", "queue",
                   #"mesh","meshsteps",
                 ))
@@ -303,6 +317,12 @@ Options:
         if store already exists, replace it
     --resume=path
         resume a fit from previous stored state (only works on some fitters)
+    --checkpoint=seconds    [dream]
+        save the sampler state to the store every so many seconds so that
+        the fit can be continued with --resume if it is interrupted
+    --memmap        [dream]
+        keep the sample history in a memory mapped file in the store rather
+        than in memory, for long runs on large models
     --parallel
         run fit using multiprocessing for parallelism
     --mpi
@@ -331,10 +351,23 @@ Options:
     --Tmax=10       [pt]
         temperatures vector; use a higher maximum temperature and a larger
         nT if your fit is getting stuck in local minima
+    --replicas=1    [pt]
+        number of chains at each temperature; use more replicas to keep
+        more processors busy with --parallel or --mpi
     --CR=0.9        [de, rl, pt]
         crossover ratio for population mixing
     --starts=1      [%(fitter)s]
-        number of times to run the fit from random starting points
+        number of times to run the fit from random starting points; with
+        --parallel the starts are run concurrently
+    --central=0     [newton]
+        use central rather than forward differences (--central=1) for
+        the gradient; this is more accurate but needs twice as many
+        function evaluations
+    --target=chisq
+        stop the starts once the best chisq reaches the target
+    --steady        [de]
+        with --parallel, replace each population member as soon as its
+        trial point is evaluated rather than waiting for the generation
     --init=lhs      [dream]
         population initialization method:
           eps:    ball around initial parameter set
@@ -343,11 +376,24 @@ Options:
           random: uniformly distributed within parameter ranges
     --stepmon
         show details for each step
+    --cache=size
+        remember the cost of the last size points evaluated so that
+        fitters which return to a point do not recompute the model
     --resynth=0
-        run resynthesis error analysis for n generations
+        run resynthesis error analysis for n generations; the fits are
+        saved as they complete, and an interrupted analysis continues
+        from where it left off when rerun with the same store; the .rsy
+        summary is rewritten with all completed fits; with --parallel the
+        fits run on local processes, otherwise they run serially
 
     --chisq
         print the model description and chisq value and exit
+    --bench
+    --bench=results.json
+        time the model file (if any) and a set of synthetic problems with
+        the serial, multiprocessing and (with --mpi) MPI mappers, using
+        --pop and --steps for the population size and DREAM generations;
+        results are appended to the file as JSON, or printed
     -?/-h/--help
         display this help
 """%{'fitter':'|'.join(sorted(FIT_OPTIONS.keys())),
@@ -378,6 +424,9 @@ Options:
     plot = property(fget=lambda self: self._plot, fset=_set_plot)
     store = None
     resume = None
+    checkpoint = None
+    target = None
+    cache = None
     _fitter = fitters.FIT_DEFAULT
     def _set_fitter(self, value):
         if value not in set(FIT_OPTIONS.keys()):
@@ -440,16 +489,33 @@ def _initial_model(opts):
 
 def resynth(fitdriver, problem, mapper, opts):
     make_store(problem,opts,exists_handler=store_overwrite_query)
-    fid = open(problem.output_path+".rsy",'at')
-    fitdriver.mapper = mapper.start_mapper(problem, opts.args)
-    for i in range(opts.resynth):
-        problem.resynth_data()
-        best, fbest = fitdriver.fit()
+    filename = problem.output_path+"-resynth.npy"
+    if opts.overwrite and os.path.exists(filename):
+        os.unlink(filename)
+    fitter = fitdriver.fitclass(problem)
+    options = fitdriver.options.copy()
+    if options.get('starts', 1) > 1:
+        fitter = MultiStart(fitter)
+    # Each sample must be fit in the process which synthesized its data.
+    # Local processes fit whole samples.  MPI and AMQP workers keep the
+    # problem they were started with, so they would fit the original data;
+    # the samples are fit serially instead.
+    if mapper is MPMapper:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    else:
+        workers = 1
+    points = resample(fitter, problem.getp(), samples=opts.resynth,
+                      workers=workers, seed=opts.seed, filename=filename,
+                      abort_test=fitdriver.abort_test, **options)
+    # The summary is rebuilt from every completed sample in the .npy file,
+    # including those from earlier runs, so it replaces the old summary.
+    fid = open(problem.output_path+".rsy",'wt')
+    for i,(fbest,best) in enumerate(zip(points[:,0],points[:,1:])):
         print "step %d chisq %g"%(i,2*fbest/problem.dof)
         fid.write('%.15g '%(2*fbest/problem.dof))
         fid.write(' '.join('%.15g'%v for v in best))
         fid.write('\n')
-    problem.restore_data()
     fid.close()
 
 def config_matplotlib(backend):
@@ -524,6 +590,11 @@ def main():
     else: # preview
         pass
  
+    if opts.bench:
+        from .bench import main as bench
+        bench(opts, initial_model(opts)[0] if opts.args else None)
+        return
+
     problem, problem_output = initial_model(opts)
 
     # TODO: AMQP mapper as implemented requires workers started up with
@@ -575,6 +646,8 @@ def main():
             resume_path = None
 
         make_store(problem,opts,exists_handler=store_overwrite_query)
+        if opts.cache:
+            problem.enable_cache(int(opts.cache))
 
         # Show command line arguments and initial model
         print "#"," ".join(sys.argv)
@@ -584,11 +657,39 @@ def main():
             fid = open(problem.output_path+'.log', 'w')
             fitdriver.monitors = [ConsoleMonitor(problem),
                                StepMonitor(problem,fid,fields=['step','value'])]
-
+        if opts.batch:
+            fitdriver.timers = Timers()
+            if fitdriver.monitors is None:
+                fitdriver.monitors = [ConsoleMonitor(problem)]
+            fitdriver.monitors.append(TimingMonitor(fitdriver.timers))
+
+        if opts.checkpoint:
+            fitdriver.options['checkpoint'] = problem.output_path+"-checkpoint"
+            fitdriver.options['checkpoint_interval'] = float(opts.checkpoint)
+        if opts.memmap:
+            fitdriver.options['history_file'] = problem.output_path+"-history"
+        if fitdriver.options.get('starts', 1) > 1:
+            if opts.target is not None:
+                fitdriver.options['target'] = float(opts.target)
+            if mapper is MPMapper:
+                import multiprocessing
+                fitdriver.options['workers'] = multiprocessing.cpu_count()
+        if opts.fit == 'amoeba' and mapper is not SerialMapper:
+            fitdriver.options['speculative'] = True
+        if opts.fit == 'de' and opts.steady:
+            start = getattr(mapper, 'start_async_mapper', None)
+            if start is not None:
+                fitdriver.options['async_mapper'] = start(problem, opts.args)
         fitdriver.mapper = mapper.start_mapper(problem, opts.args)
         best, fbest = fitdriver.fit(resume=resume_path)
         remember_best(fitdriver, problem, best)
-        if opts.cov: print problem.cov()
+        if fitdriver.timers is not None:
+            print fitdriver.timers.summary()
+        if problem.nllf_cache is not None:
+            print problem.nllf_cache
+        if opts.cov:
+            start = getattr(mapper, 'start_residuals_mapper', None)
+            print problem.cov(mapper=start(problem, opts.args) if start else None)
         beep()
         if not opts.batch:
             import pylab
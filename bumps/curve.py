@@ -31,8 +31,16 @@ class Curve(object):
     default is taken from the function definition (if the function uses
     par=value to define the parameter) or is set to zero if no default is
     given in the function.
+
+    If *vectorized* is True, the population optimizers evaluate the whole
+    population with a single call to *fn*, with each fitted parameter
+    given as an array with a leading population axis (see
+    :meth:`theory_batch`).  Only use this if *fn* computes each output
+    point from the corresponding x and broadcast parameters alone.  Any
+    reduction over x, such as normalizing by *sum(y)*, would be taken
+    over the entire population instead.
     """
-    def __init__(self, fn, x, y, dy, name="", **fnkw):
+    def __init__(self, fn, x, y, dy, name="", vectorized=False, **fnkw):
         self.x, self.y = numpy.asarray(x), numpy.asarray(y)
         if dy is None:
             self.dy = 1
@@ -42,6 +50,7 @@ class Curve(object):
                 raise ValueError("measurement uncertainty must be positive")
 
         self.fn = fn
+        self.vectorized = vectorized
 
         # Make every name a parameter; initialize the parameters
         # with the default value if function is defined with keyword
@@ -100,6 +109,40 @@ class Curve(object):
             self._cached_theory = self._function(x, **kw)
         return self._cached_theory
 
+    def theory_batch(self, parameters, points):
+        """
+        Evaluate the theory for a population of parameter sets.
+
+        *parameters* is the list of fitted parameters and *points* is
+        the (Npop, Nvar) array of values for those parameters.  The fitted
+        parameters are passed to the function as arrays with a leading
+        population axis, with the remaining axes of length one so that
+        they broadcast against *x*.  Returns an array of shape
+        (Npop,) + y.shape, or None if the model is not *vectorized*, if
+        the function does not broadcast or if a parameter expression
+        depends on a fitted parameter.
+        """
+        if not self.vectorized:
+            return None
+        index = dict((id(p),k) for k,p in enumerate(parameters))
+        shape = (len(points),) + (1,)*self.x.ndim
+        kw = {}
+        for k,v in self._parameters.items():
+            if id(v) in index:
+                kw[k] = numpy.reshape(points[:,index[id(v)]], shape)
+            elif any(id(p) in index for p in v.parameters()):
+                return None
+            else:
+                kw[k] = v.value
+        try:
+            theory = numpy.asarray(self._function(self.x, **kw))
+        except (TypeError, ValueError):
+            # Function uses scalar operations on the parameters
+            return None
+        if theory.shape != (len(points),) + self.y.shape:
+            return None
+        return theory
+
     def residuals(self):
         return (self.theory() - self.y)/self.dy
          
@@ -107,6 +150,12 @@ class Curve(object):
         R = self.residuals()
         return 0.5*numpy.sum(R**2)
 
+    def nllf_batch(self, parameters, points):
+        theory = self.theory_batch(parameters, points)
+        if theory is None: return None
+        R = numpy.reshape((theory - self.y)/self.dy, (len(points),-1))
+        return 0.5*numpy.sum(R**2, axis=1)
+
     def plot(self, view=None):
         import pylab
         pylab.errorbar(self.x, self.y, yerr=self.dy, fmt='.')
@@ -133,11 +182,44 @@ class PoissonCurve(Curve):
     
     See :class:`Curve` for details.
     """
-    def __init__(self, fn, x, y, name="", **fnkw):
-        Curve.__init__(self, fn, x, y, sqrt(y), name=name, **fnkw)
+    def __init__(self, fn, x, y, name="", vectorized=False, **fnkw):
+        Curve.__init__(self, fn, x, y, sqrt(y), name=name,
+                       vectorized=vectorized, **fnkw)
         self._logfacty = numpy.sum(logfactorial(self.y))
     def nllf(self):
         theory = self.theory()
         if (theory<=0).any(): return 1e308
         return -sum( self.y*log(theory) - theory ) + self._logfacty
-
+    def nllf_batch(self, parameters, points):
+        theory = self.theory_batch(parameters, points)
+        if theory is None: return None
+        theory = numpy.reshape(theory, (len(points),-1))
+        bad = (theory<=0).any(axis=1)
+        theory[bad] = 1
+        y = numpy.reshape(self.y, -1)
+        nllf = -numpy.sum( y*log(theory) - theory, axis=1 ) + self._logfacty
+        nllf[bad] = 1e308
+        return nllf
+
+
+def test():
+    from .fitproblem import FitProblem
+    x = numpy.linspace(1, 10, 20)
+    y = 2*x + 1
+    points = numpy.array([[1.,0.],[2.,1.],[3.,-2.]])
+    def line(x, a, b):
+        return a*x + b
+    def normalized(x, a, b):
+        y = a*x + b
+        return y/numpy.sum(y)
+    for fn, vectorized in ((line, True), (line, False), (normalized, False)):
+        M = Curve(fn, x, y, numpy.ones_like(x), a=1, b=0,
+                  vectorized=vectorized)
+        M.a.range(0, 5)
+        M.b.range(-5, 5)
+        problem = FitProblem(M)
+        batch = problem.nllf_batch(points)
+        serial = [problem.nllf(p) for p in points]
+        assert numpy.allclose(batch, serial), (fn.__name__, batch, serial)
+    # The population is not passed to functions which are not vectorized
+    assert M.theory_batch(problem._parameters, points) is None
@@ -100,13 +100,17 @@
 2010-04-20 Paul Kienzle
 * Convert to python
 """
-from __future__ import division
+from __future__ import division, with_statement
+import os
 import sys
 import time
 
-from .state import MCMCDraw
+import numpy
+
+from . import util
+from .state import MCMCDraw, load_state, append_state
+from .gelman import RunningGelman
 from .metropolis import metropolis, metropolis_dr, dr_step
-from .gelman import gelman
 from .crossover import AdaptiveCrossover
 from .diffev import de_step
 from .bounds import make_bounds_handler
@@ -163,6 +167,16 @@ class Dream(object):
     goalseek_optimizer=None
     goalseek_interval=1e100 # close enough to never
     goalseek_minburn=1000
+    # Checkpoint the sampler state every checkpoint_interval seconds to
+    # files starting with the checkpoint path.  The checkpoint can be
+    # restored with load_checkpoint, and sampling will continue exactly
+    # as if it had not been interrupted.  A checkpoint is also saved before
+    # the circular history buffers would overwrite unsaved records, such
+    # as during a long burn-in.
+    checkpoint=None
+    checkpoint_interval=600
+    # Keep the thinned points in a memory mapped file rather than in memory.
+    history_file=None
 
 
     def __init__(self, **kw):
@@ -174,6 +188,7 @@ class Dream(object):
                 raise TypeError("Unknown attribute "+k)
 
         self._initialized = False
+        self._resume = None
 
     def sample(self, state=None, abort_test=None):
         """
@@ -181,6 +196,9 @@ class Dream(object):
         """
         if not self._initialized:
             self._initialized = True
+        if state is None and self._resume is not None:
+            # Continue from the state restored by load_checkpoint
+            state = self.state
         self.state = state
         try:
             run_dream(self, abort_test=abort_test)
@@ -189,12 +207,14 @@ class Dream(object):
         return self.state
 
 def run_dream(dream, abort_test=None):
+    if abort_test is None:
+        abort_test = lambda: False
 
     # Step 1: Sample s points in the parameter space
     # [PAK] I moved this out of dream so that the user can use whatever
     # complicated sampling scheme they want.  Unfortunately, this means
     # the user needs to know some complex sampling scheme.
-    if dream.population == None:
+    if dream.population is None:
         raise ValueError("initial population not defined")
 
     # Remember the problem dimensions
@@ -213,7 +233,12 @@ def run_dream(dream, abort_test=None):
     state = dream.state
     state.labels = dream.model.labels
     previous_draws = state.draws
-    if previous_draws:
+    resume, dream._resume = dream._resume, None
+    if resume is not None:
+        # Continue from a checkpoint, restoring the generator state
+        x, logp = resume['x'], resume['logp']
+        _restore_sampler(dream, resume)
+    elif previous_draws:
         x, logp = state._last_gen()
     else:
         # No initial state, so evaluate initial population
@@ -227,13 +252,19 @@ def run_dream(dream, abort_test=None):
             dream.monitor(state, x, logp)
 
     # Skip R_stat and pCR until we have some data data to analyze
-    state._update(R_stat=-2, CR_weight=dream.CR.weight)
+    if resume is None:
+        state._update(R_stat=-2, CR_weight=dream.CR.weight)
 
     # Now start drawing samples
     #print "previous draws", previous_draws, "new draws",dream.draws + dream.burn
     last_goalseek = (dream.draws + dream.burn)/Npop - dream.goalseek_minburn
     next_goalseek = state.generation + dream.goalseek_interval if dream.goalseek_optimizer else 1e100
-    
+    if resume is not None:
+        next_goalseek = float(resume['next_goalseek'])
+    last_checkpoint = time.time()
+    # History records already in the checkpoint files
+    saved = _history_counts(state) if resume is not None else (0, 0, 0)
+
     while state.draws < dream.draws + dream.burn:
 
         # Age the population using differential evolution
@@ -318,8 +349,7 @@ def run_dream(dream, abort_test=None):
         # ---------------------------------------------------------------------
 
         # Calculate Gelman and Rubin convergence diagnostic
-        _, points, _ = state.chains()
-        R_stat = gelman(points, portion=0.5)
+        R_stat = state._current_R_stat(portion=0.5)
 
         if state.draws <= 0.1 * dream.draws:
             # Adapt the crossover ratio, but only during burn-in.
@@ -333,6 +363,36 @@ def run_dream(dream, abort_test=None):
         
         if abort_test(): break
 
+        # Checkpoint at the end of the update so that the sampler can
+        # restart without needing the partial crossover statistics.  The
+        # checkpoint appends the new history records to the saved state,
+        # so it must happen before the next update could overwrite any
+        # records in the circular buffers which have not been saved.
+        if dream.checkpoint and (
+                time.time() >= last_checkpoint + dream.checkpoint_interval
+                or _history_full(state, saved, dream.DE_steps)):
+            save_checkpoint(dream, dream.checkpoint, x, logp,
+                            next_goalseek=next_goalseek)
+            last_checkpoint = time.time()
+            saved = _history_counts(state)
+
+def _history_counts(state):
+    """
+    Return the number of generation, thinned generation and update records
+    produced so far.
+    """
+    return state.generation, state._thin_count, state._update_count
+
+def _history_full(state, saved, steps):
+    """
+    Return True if an update of *steps* generations could overwrite records
+    produced since the history counts were *saved*.
+    """
+    gen, thin, update = [n - s for n, s in zip(_history_counts(state), saved)]
+    return (gen + steps > state.Ngen
+            or thin + steps//state.thinning + 1 > state.Nthin
+            or update + 1 > state.Nupdate)
+
 
 
 def allocate_state(dream):
@@ -352,6 +412,198 @@ def allocate_state(dream):
     #print Ngen, Nthin, Nupdate, draws, steps, Npop, Nvar
 
     if dream.state != None:
-        dream.state.resize(Ngen, Nthin, Nupdate, Nvar, Nchain, Ncr, thinning)
+        dream.state.resize(Ngen, Nthin, Nupdate, Nvar, Nchain, Ncr, thinning,
+                           history=dream.history_file)
     else:
-        dream.state = MCMCDraw(Ngen, Nthin, Nupdate, Nvar, Nchain, Ncr, thinning)
+        dream.state = MCMCDraw(Ngen, Nthin, Nupdate, Nvar, Nchain, Ncr, thinning,
+                               history=dream.history_file)
+
+
+def save_checkpoint(dream, filename, x, logp, next_goalseek=1e100):
+    """
+    Save the sampler state needed to resume *dream* from the current
+    population *x* with log likelihood *logp*.
+
+    Generations since the last checkpoint are appended to the binary
+    state files starting with *filename* (see :func:`state.append_state`),
+    so the cost of each checkpoint is proportional to the number of new
+    generations rather than the length of the run.  The current
+    population, crossover adaptation and random number generator state
+    are stored in *filename*-resume.npz.
+    """
+    state = dream.state
+    append_state(state, filename)
+    data = dict(x=x, logp=logp,
+                next_goalseek=next_goalseek,
+                counts=[state.generation, state._thin_count,
+                        state._update_count, len(state._outliers)],
+                draws=state.draws,
+                thin_timer=state._thin_timer,
+                best_logp=state._best_logp,
+                CR_weight=dream.CR.weight)
+    if state._best_x is not None:
+        data['best_x'] = state._best_x
+    if state._gen_current is not None:
+        data['gen_current'] = state._gen_current
+    if hasattr(dream.CR, '_count'):
+        data['CR_count'] = dream.CR._count
+        data['CR_distance'] = dream.CR._distance
+    # Keep the running R-statistic sums so the resumed run rounds the same
+    gelman = state._gelman
+    if gelman is not None and gelman._window is not None:
+        data['gelman_portion'] = gelman.portion
+        data['gelman_window'] = list(gelman._window) + [gelman._refresh]
+        data['gelman_shift'] = gelman._shift
+        data['gelman_sum'] = gelman._sum
+        data['gelman_sumsq'] = gelman._sumsq
+    # Parts of dream use numpy.random directly, and others use util.RNG,
+    # so save both if they are different.
+    _save_rng(data, 'rng', numpy.random)
+    if util.RNG is not numpy.random:
+        _save_rng(data, 'util_rng', util.RNG)
+
+    # Write to a temporary file and rename so that a partial write never
+    # replaces a good checkpoint.
+    path = filename+'-resume.npz'
+    with open(path+'.tmp', 'wb') as fid:
+        numpy.savez(fid, **data)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(path+'.tmp', path)
+
+def load_checkpoint(dream, filename):
+    """
+    Restore the sampler state saved by :func:`save_checkpoint`.
+
+    The next call to *dream.sample()* continues from the checkpoint.  The
+    population size and the sampling options should be the same as those
+    used for the original run.
+    """
+    with open(filename+'-resume.npz', 'rb') as fid:
+        data = numpy.load(fid)
+        resume = dict((k, data[k]) for k in data.files)
+    state = load_state(filename)
+
+    # Ignore records which were written after the resume information
+    # if the checkpoint was interrupted.
+    Ngen, Nthin, Nupdate, Noutliers = [int(v) for v in resume['counts']]
+    state.generation = Ngen
+    state._gen_draws = state._gen_draws[:Ngen]
+    state._gen_logp = state._gen_logp[:Ngen]
+    state._gen_acceptance_rate = state._gen_acceptance_rate[:Ngen]
+    state._thin_count = Nthin
+    state._thin_draws = state._thin_draws[:Nthin]
+    state._thin_logp = state._thin_logp[:Nthin]
+    state._thin_point = state._thin_point[:Nthin]
+    state._update_count = Nupdate
+    state._update_draws = state._update_draws[:Nupdate]
+    state._update_R_stat = state._update_R_stat[:Nupdate]
+    state._update_CR_weight = state._update_CR_weight[:Nupdate]
+    state._outliers = state._outliers[:Noutliers]
+    state.draws = int(resume['draws'])
+    state._thin_timer = int(resume['thin_timer'])
+    state._best_logp = float(resume['best_logp'])
+    state._best_x = resume.get('best_x', None)
+    state._gen_current = resume.get('gen_current', None)
+    if 'gelman_window' in resume:
+        gelman = RunningGelman(float(resume['gelman_portion']))
+        start, stop, refresh = [int(v) for v in resume['gelman_window']]
+        gelman._window, gelman._refresh = (start, stop), refresh
+        gelman._shift = resume['gelman_shift']
+        gelman._sum = resume['gelman_sum']
+        gelman._sumsq = resume['gelman_sumsq']
+        state._gelman = gelman
+
+    dream.state = state
+    dream._resume = resume
+
+def _restore_sampler(dream, resume):
+    dream.CR.weight = resume['CR_weight']
+    if 'CR_count' in resume:
+        dream.CR._count = resume['CR_count']
+        dream.CR._distance = resume['CR_distance']
+    _restore_rng(resume, 'rng', numpy.random)
+    if 'util_rng_keys' in resume:
+        _restore_rng(resume, 'util_rng', util.RNG)
+
+def _save_rng(data, prefix, rng):
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    data[prefix+'_keys'] = keys
+    data[prefix+'_pos'] = pos
+    data[prefix+'_gauss'] = [has_gauss, cached_gaussian]
+
+def _restore_rng(data, prefix, rng):
+    has_gauss, cached_gaussian = data[prefix+'_gauss']
+    rng.set_state(('MT19937', data[prefix+'_keys'], int(data[prefix+'_pos']),
+                   int(has_gauss), float(cached_gaussian)))
+
+
+def test():
+    """
+    Check that a run resumed from a checkpoint matches an uninterrupted run,
+    and that a run with its history in a file matches one in memory.
+    """
+    import tempfile
+    import shutil
+    from .model import MVNormal
+
+    Nchain, Nvar = 10, 3
+    model = MVNormal(numpy.zeros(Nvar), numpy.eye(Nvar))
+    model.bounds = [-10*numpy.ones(Nvar), 10*numpy.ones(Nvar)]
+    def sampler(checkpoint, burn, interval, history_file=None):
+        numpy.random.seed(42)
+        population = numpy.random.randn(1, Nchain, Nvar)
+        return Dream(model=model, population=population,
+                     draws=Nchain*100, burn=burn, thinning=2, DE_steps=5,
+                     checkpoint=checkpoint, checkpoint_interval=interval,
+                     history_file=history_file,
+                     monitor=lambda state, pop, logp: None)
+
+    # Checkpoint after every update without burn-in, and with a burn-in
+    # long enough that the circular buffers wrap several times between
+    # checkpoints on the (never reached) time interval.
+    for burn, interval, stop in ((0, 0, 43), (Nchain*300, 1e100, 343)):
+        path = tempfile.mkdtemp()
+        try:
+            full = sampler(os.path.join(path, 'full'), burn, interval).sample()
+
+            # Interrupt partway through an update, then continue from the
+            # last checkpoint.
+            part = os.path.join(path, 'part')
+            resumed = sampler(part, burn, interval)
+            resumed.sample(abort_test=lambda: resumed.state.generation >= stop)
+            resumed = sampler(part, burn, interval)
+            numpy.random.seed(1)  # the checkpoint restores the generator
+            load_checkpoint(resumed, part)
+            resumed = resumed.sample()
+        finally:
+            shutil.rmtree(path)
+        _check_same_state(resumed, full)
+
+    # Keep the thinned points in a memory mapped file, with a burn-in so
+    # that the buffer wraps.
+    memory = sampler(None, Nchain*300, 0).sample()
+    path = tempfile.mkdtemp()
+    try:
+        history = os.path.join(path, 'history')
+        mapped = sampler(None, Nchain*300, 0, history_file=history).sample()
+        assert isinstance(mapped._thin_point, numpy.memmap)
+        _check_same_state(mapped, memory)
+        del mapped
+    finally:
+        shutil.rmtree(path)
+
+def _check_same_state(resumed, full):
+    assert resumed.generation == full.generation
+    assert resumed.draws == full.draws
+    for a, b in zip(resumed.chains(), full.chains()):
+        assert (a == b).all()
+    for a, b in zip(resumed.logp(), full.logp()):
+        assert (a == b).all()
+    for a, b in zip(resumed.R_stat(), full.R_stat()):
+        assert (a == b).all()
+    for a, b in zip(resumed.CR_weight(), full.CR_weight()):
+        assert (a == b).all()
+
+if __name__ == "__main__":
+    test()
@@ -1,10 +1,12 @@
 from __future__ import division
 from numpy import zeros, ones, dot, cov, eye, sqrt, sum, all
-from numpy import where, select
+from numpy import where, select, arange, argsort, sort, any, asarray
 from numpy.linalg import norm, cholesky, LinAlgError
 from .util import draw
 from numpy import random as RNG
 
+SNOOKER,DE,DIRECT = 0,1,2
+
 def de_step(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
     """
     Generates offspring using METROPOLIS HASTINGS monte-carlo markov chain
@@ -12,6 +14,140 @@ def de_step(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
     The number of chains may be smaller than the population size if the
     population is selected from both the current generation and the
     ancestors.
+
+    The offspring for all chains are generated together, grouping the
+    chains by algorithm and, for DE, by the number of pairs used.  This
+    draws from the same distribution as :func:`_de_step_serial`, which
+    generates the offspring one chain at a time.
+    """
+    Npop, Nvar = pop.shape
+    CR = asarray(CR)
+
+    # Initialize the delta update to zero
+    delta_x = zeros( (Nchain,Nvar) )
+    step_alpha = ones( Nchain )
+
+    # Choose snooker, de or direct according to snooker_rate, and 80:20
+    # ratio of de to direct.
+    u = RNG.rand(Nchain)
+    de_rate = 0.8 * (1-snooker_rate)
+    alg = select([u < snooker_rate, u < snooker_rate+de_rate],
+                 [SNOOKER,DE], default=DIRECT)
+    use_de_step = (alg == DE)
+
+    # Use DE with cross-over ratio, grouping chains by the number of
+    # vector pair differences k ~ discrete U[1,max pairs]
+    de_chains = where(alg == DE)[0]
+    de_pairs = RNG.randint(max_pairs, size=len(de_chains))+1
+    for k in range(1,max_pairs+1):
+        qq = de_chains[de_pairs == k]
+        n = len(qq)
+        if n == 0: continue
+
+        # Select 2*k members at random different from the current member
+        perm = _draw_others(qq, 2*k, Npop)
+        r1,r2 = perm[:,:k],perm[:,k:]
+
+        # Select the dims to update based on the crossover ratio, making
+        # sure at least one dim is selected
+        vars = RNG.rand(n,Nvar) > (1-CR[qq,None])
+        empty = where(~any(vars,axis=1))[0]
+        vars[empty,RNG.randint(Nvar,size=len(empty))] = True
+
+        # Weight the size of the jump inversely proportional to the
+        # number of contributions, both from the parameters being
+        # updated and from the population defining the step direction.
+        gamma = 2.38/sqrt(2 * sum(vars,axis=1) * k)
+
+        # Find and average step from the selected pairs
+        step = sum(pop[r1]-pop[r2], axis=1)
+
+        # Apply that step with F scaling and noise
+        jiggle = 1 + eps * (2 * RNG.rand(n,Nvar) - 1)
+        delta_x[qq] = where(vars, jiggle*gamma[:,None]*step, 0)
+
+    # Use snooker update
+    qq = where(alg == SNOOKER)[0]
+    if len(qq) > 0:
+        # Select current and three others
+        perm = _draw_others(qq, 3, Npop)
+        xi = pop[qq]
+        z,R1,R2 = [pop[perm[:,i]] for i in range(3)]
+
+        # Find the step direction and scale it to the length of the
+        # projection of R1-R2 onto the step direction.
+        step = xi - z
+        denom = sum(step**2,axis=1)
+        same = where(denom == 0)[0]
+        if len(same) > 0:
+            step[same] = noise*RNG.randn(len(same),Nvar)
+            denom[same] = sum(step[same]**2,axis=1)
+        scale = sum( (R1-R2)*step, axis=1 ) / denom
+
+        # Step using gamma of 2.38/sqrt(2) + U(-0.5,0.5)
+        gamma = 1.2 + RNG.rand(len(qq))
+        delta_x[qq] = (gamma * scale)[:,None] * step
+
+        # Scale Metropolis probability by (||xi* - z||/||xi - z||)^(d-1)
+        step_alpha[qq] = (sqrt(sum((delta_x[qq]+step)**2,axis=1))
+                          / sqrt(sum(step**2,axis=1)))**((Nvar-1)/2)
+
+    # Use one pair and all dimensions
+    qq = where(alg == DIRECT)[0]
+    if len(qq) > 0:
+        # Note that there is no F scaling, dimension selection or noise
+        perm = _draw_others(qq, 2, Npop)
+        delta_x[qq] = pop[perm[:,0]] - pop[perm[:,1]]
+
+    # If no step was specified (exceedingly unlikely!), then
+    # select a delta at random from a gaussian approximation to the
+    # current population
+    qq = where(all(delta_x == 0, axis=1))[0]
+    if len(qq) > 0:
+        try:
+            # Compute the Cholesky Decomposition of x_old
+            R = (2.38/sqrt(Nvar)) * cholesky(cov(pop.T) + noise*eye(Nvar))
+            # Generate jump using multinormal distribution
+            delta_x[qq] = dot(RNG.randn(len(qq),Nvar), R)
+        except LinAlgError:
+            print "Bad cholesky"
+            delta_x[qq] = RNG.randn(len(qq),Nvar)
+
+    # Update x_old with delta_x and noise
+    x_new = pop[:Nchain] + delta_x + noise*RNG.randn(Nchain,Nvar)
+
+    return x_new, step_alpha, use_de_step
+
+def _draw_others(qq, k, Npop):
+    """
+    For each chain in *qq* select *k* distinct members of the population
+    other than the chain itself.
+
+    Returns an array of shape len(qq) x k.
+    """
+    n, pool = len(qq), Npop-1
+    if k > pool/4:
+        # For small pools, take the first k of a random permutation
+        perm = argsort(RNG.rand(n,pool),axis=1)[:,:k]
+    else:
+        # For large pools, draw with replacement and redraw any rows
+        # containing duplicates.  Conditioned on the members being
+        # distinct, every ordered selection is equally likely.
+        perm = RNG.randint(pool, size=(n,k))
+        redraw = arange(n)
+        while len(redraw) > 0:
+            ordered = sort(perm[redraw],axis=1)
+            redraw = redraw[any(ordered[:,1:] == ordered[:,:-1],axis=1)]
+            perm[redraw] = RNG.randint(pool, size=(len(redraw),k))
+    # Skip over the current member
+    perm[perm >= qq[:,None]] += 1
+    return perm
+
+def _de_step_serial(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
+    """
+    Generate offspring one chain at a time.
+
+    This is the reference implementation for :func:`de_step`.
     """
     Npop, Nvar = pop.shape
 
@@ -23,7 +159,6 @@ def de_step(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
     # ratio of de to direct.
     u = RNG.rand(Nchain)
     de_rate = 0.8 * (1-snooker_rate)
-    SNOOKER,DE,DIRECT = 0,1,2
     alg = select([u < snooker_rate, u < snooker_rate+de_rate],
                  [SNOOKER,DE], default=DIRECT)
     use_de_step = (alg == DE)
@@ -128,9 +263,9 @@ def _check():
     import numpy
     Nchain, Npop, Nvar = 4, 10, 3
 
-    pop = 100*numpy.arange(Npop*Nvar).reshape((Npop,Nvar))
+    pop = 100*numpy.arange(Npop*Nvar, dtype='d').reshape((Npop,Nvar))
     pop += RNG.rand(*pop.shape)*1e-6
-    CR = 1./(RNG.randint(4,size=Nvar)+1)
+    CR = 1./(RNG.randint(4,size=Nchain)+1)
     x_new, _step_alpha, used = de_step(Nchain,pop,CR,max_pairs=2,eps=0.05)
     print """\
 The following table shows the expected portion of the dimensions that
@@ -142,5 +277,40 @@ population.
         vstr = " ".join("%4d"%(int(v/100+0.5)) for v in x_new[i]-pop[i])
         print rstr, vstr
 
+def test():
+    """
+    Check that the batched and serial step generators produce the same
+    distribution of offspring.
+    """
+    import numpy
+    from scipy.stats import ks_2samp
+    Nchain, Npop, Nvar, Ntrials = 6, 12, 4, 2000
+    pop = RNG.randn(Npop,Nvar)*[1,2,3,4]
+    CR = [0.25,0.5,0.75,1.,0.5,0.5]
+    opts = dict(max_pairs=3, eps=0.05, snooker_rate=0.3)
+    def trials(fn):
+        x,alpha,used = zip(*[fn(Nchain,pop,CR,**opts) for _ in range(Ntrials)])
+        return numpy.array(x)-pop[:Nchain], numpy.array(alpha), numpy.array(used)
+    dx1,alpha1,used1 = trials(de_step)
+    dx2,alpha2,used2 = trials(_de_step_serial)
+    # Use a loose significance level since there are many comparisons
+    for i in range(Nchain):
+        for j in range(Nvar):
+            assert ks_2samp(dx1[:,i,j],dx2[:,i,j])[1] > 1e-4, (i,j)
+        assert ks_2samp(alpha1[:,i],alpha2[:,i])[1] > 1e-4, i
+    assert abs(numpy.mean(used1)-numpy.mean(used2)) < 0.05
+
+def _benchmark():
+    import time
+    Nvar, Nchain = 10, 500
+    pop = RNG.randn(2*Nchain,Nvar)
+    CR = RNG.rand(Nchain)
+    for fn in (_de_step_serial, de_step):
+        t0 = time.time()
+        for _ in range(10): fn(Nchain,pop,CR,max_pairs=3)
+        print "%s: %.1f ms per step"%(fn.__name__,(time.time()-t0)*100)
+
 if __name__ == "__main__":
     _check()
+    test()
+    _benchmark()
@@ -6,6 +6,7 @@ Convergence test statistic from Gelman and Rubin, 1992.
 from __future__ import division
 
 from numpy import var, mean, ones, sqrt,sum,transpose,reshape,cov,corrcoef
+from numpy import zeros
 
 def gelman(sequences, portion=0.5):
     """
@@ -54,6 +55,83 @@ def gelman(sequences, portion=0.5):
 
     return R_stat
 
+class RunningGelman(object):
+    """
+    Gelman-Rubin R-statistic updated as generations are added to the chains.
+
+    Running sums and sums of squares are kept for each chain over the last
+    *portion* of the thinned history, so that computing the statistic
+    after each update only requires the generations which entered or left
+    the window since the last update.  Call with the
+    :class:`state.MCMCDraw` state to get the current R-statistic; this
+    will agree with *gelman(state.chains()[1], portion)*.
+
+    Use *replace_chain* when a chain is replaced by a copy of another.
+    """
+    # Number of thinned generations read from the history at once
+    block = 1000
+
+    def __init__(self, portion=0.5):
+        self.portion = portion
+        self._window = None
+
+    def __call__(self, state):
+        count = state._thin_count
+        Ngen = min(count, len(state._thin_draws))
+        chain_len = int(Ngen*self.portion)
+        start, stop = count - chain_len, count
+        if chain_len < 2:
+            self._window = None
+            return -2 * ones(state.Nvar)
+
+        if (self._window is None
+            or start >= self._refresh
+            or self._window[0] < count - Ngen):
+            # Recompute from scratch whenever the window has moved past
+            # the generations in the last full computation, which keeps
+            # the rounding errors from accumulating.
+            self._reset(state, start, stop)
+        else:
+            old_start, old_stop = self._window
+            self._add(state, old_stop, stop, 1)
+            self._add(state, old_start, start, -1)
+            self._window = start, stop
+
+        n = chain_len
+        meanSeq = self._sum/n
+        varSeq = (self._sumsq - self._sum*meanSeq)/(n-1)
+        meanSeq += self._shift
+        B = n * var(meanSeq, axis=0, ddof=1)
+        W = mean(varSeq, axis=0)
+        sigma2 = ((n - 1)/n) * W + (1/n) * B
+        Nchains = meanSeq.shape[0]
+        return sqrt((Nchains + 1)/Nchains * sigma2 / W - (n-1)/Nchains/n)
+
+    def replace_chain(self, old, new):
+        """
+        Chain *old* has been replaced by a copy of chain *new*.
+        """
+        if self._window is not None:
+            for v in (self._shift, self._sum, self._sumsq):
+                v[old] = v[new]
+
+    def _reset(self, state, start, stop):
+        # Shift by a point in the window to reduce cancellation in the
+        # variance from the sum of squares
+        self._shift = state._thin_rows(start, start+1)[0].copy()
+        self._sum = zeros(self._shift.shape)
+        self._sumsq = zeros(self._shift.shape)
+        self._add(state, start, stop, 1)
+        self._window = start, stop
+        self._refresh = stop
+
+    def _add(self, state, start, stop, sign):
+        for lo in range(start, stop, self.block):
+            rows = state._thin_rows(lo, min(lo+self.block, stop))
+            rows = rows - self._shift
+            self._sum += sign*sum(rows, axis=0)
+            self._sumsq += sign*sum(rows**2, axis=0)
+
 def test():
     from numpy import reshape, arange, transpose
     from numpy.linalg import norm
@@ -72,5 +150,19 @@ def test():
     R = gelman(S, portion=.1)
     assert norm(R - [-2, -2, -2, -2, -2, -2]) == 0
 
+    # Check the running statistic against the direct computation as
+    # the window slides through a circular buffer.
+    from numpy.random import randn
+    from .state import MCMCDraw
+    state = MCMCDraw(Ngen=60, Nthin=25, Nupdate=1, Nvar=3, Npop=5, Ncr=1,
+                     thinning=1)
+    for gen in range(60):
+        state._generation(new_draws=5, x=randn(5,3)+[0,1e2,1e4], logp=randn(5),
+                          accept=5)
+        if gen == 30: state._replace_outlier(1,3)
+        R = state._current_R_stat(portion=0.5)
+        target = gelman(state.chains()[1], portion=0.5)
+        assert norm((R-target)/target) < 1e-10
+
 if __name__ == "__main__":
     test()
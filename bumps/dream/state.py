@@ -17,7 +17,9 @@ The results may be queried as follows::
     show()/save(file)/load(file)
 
 Data is stored in circular arrays, which keeps the last N generations and
-throws the rest away.
+throws the rest away.  For long runs on large problems the thinned points
+can be kept in a memory mapped file rather than in memory by giving
+MCMCDraw a *history* filename.
 
 draws is the total number of draws from the sampler.
 
@@ -67,18 +69,23 @@ best_x is the corresponding point at which it was observed.
 
 generation is the last generation number
 """
-#TODO: state should be collected in files as we go
-from __future__ import division
+from __future__ import division, with_statement
 
-__all__ = ['MCMCDraw','load_state','save_state']
+__all__ = ['MCMCDraw','load_state','save_state','append_state']
 
+import os
 import re
 import gzip
+try:
+    import json
+except ImportError:
+    json = None
 
 import numpy
 from numpy import empty, sum, asarray, inf, argmax, hstack, dstack
 from numpy import savetxt,loadtxt, reshape
 from .outliers import identify_outliers
+from .gelman import RunningGelman
 from .util import draw, RNG
 
 #EXT = ".mc.gz"
@@ -86,7 +93,272 @@ from .util import draw, RNG
 EXT = ".mc"
 CREATE = open
 
-def save_state(state, filename):
+# Binary state format
+# ===================
+#
+# The binary format stores each of the per generation, per thinned
+# generation, per update and outlier records as rows of little endian
+# doubles in its own file, with the header information (population size,
+# number of variables, labels, best point, ...) in a small json file.
+# The points are kept separate from the other thinned generation records
+# so that they can be used directly from the memory mapped file.
+# Rows are stored in the order they were generated, so new generations
+# can be appended to the end of the files as sampling proceeds, and the
+# files can be memory mapped when the state is loaded.  Because the
+# header is written last, the files are usable even if the write was
+# interrupted: the number of complete rows in each file determines the
+# amount of history that is available.  A full save writes each file to
+# a temporary name and renames it into place, so a state which is memory
+# mapped from the files can be saved over them.  If the circular buffers
+# have wrapped, a full save contains only the records still in memory,
+# and the header records the number of earlier records for each file.
+#
+# Outlier removal rewrites the history of the replaced chain.  If the
+# records on disk can no longer be rewritten from memory because the
+# buffers have wrapped, the header keeps a list of (gen rows, thin rows,
+# old chain, new chain) replacements which are applied to the first
+# rows of the files when the state is loaded.
+#
+#    <filename>-state.json    header
+#    <filename>-gen.bin       draws, acceptance rate, logp[Npop]
+#    <filename>-thin.bin      draws, logp[Npop]
+#    <filename>-point.bin     point[Npop*Nvar]
+#    <filename>-update.bin    draws, R_stat[Nvar], CR_weight[Ncr]
+#    <filename>-outliers.bin  thinned generation, old chain, new chain
+BINARY_VERSION = 1
+BINARY_DTYPE = '<f8'
+
+def save_state(state, filename, format='binary'):
+    """
+    Save the MCMC state to files starting with *filename*.
+
+    *format* is 'binary' for the memory mappable binary format or 'text'
+    to export the state as text files (-chain.mc, -point.mc, -stats.mc
+    and -outliers.mc).  Both formats can be read by :func:`load_state`.
+    """
+    if format == 'binary':
+        _save_binary(state, filename, append=False)
+    elif format == 'text':
+        _save_text(state, filename)
+    else:
+        raise ValueError("state format should be binary or text")
+
+def append_state(state, filename):
+    """
+    Append generations produced since the last save to the binary state
+    files starting with *filename*.
+
+    The files are created if they do not already exist.  Raises ValueError
+    if some of the unsaved generations have already been dropped from the
+    circular history buffers.
+    """
+    _save_binary(state, filename, append=True)
+
+def _binary_header(state):
+    return dict(version=BINARY_VERSION,
+                Npop=state.Npop, Nvar=state.Nvar, Ncr=state.Ncr,
+                thinning=state.thinning,
+                generation=state.generation,
+                draws=int(state.draws),
+                thin_timer=state._thin_timer,
+                labels=state._labels,
+                title=state.title,
+                best_logp=float(state._best_logp),
+                best_x=(None if state._best_x is None
+                        else [float(v) for v in state._best_x]),
+                )
+
+def _binary_streams(state):
+    """
+    Return name, row width, number of rows and a row generator for each
+    of the binary record files.  The row generator returns the last n
+    rows in chronological order.
+    """
+    Npop, Nvar, Ncr = state.Npop, state.Nvar, state.Ncr
+    def gen_rows(n):
+        idx = _tail(state._gen_index, len(state._gen_draws), n)
+        return hstack((state._gen_draws[idx,None],
+                       state._gen_acceptance_rate[idx,None],
+                       state._gen_logp[idx]))
+    def thin_rows(n):
+        idx = _tail(state._thin_index, len(state._thin_draws), n)
+        return hstack((state._thin_draws[idx,None],
+                       state._thin_logp[idx]))
+    def point_rows(n):
+        idx = _tail(state._thin_index, len(state._thin_draws), n)
+        return reshape(state._thin_point[idx], (n, Npop*Nvar))
+    def update_rows(n):
+        idx = _tail(state._update_index, len(state._update_draws), n)
+        return hstack((state._update_draws[idx,None],
+                       state._update_R_stat[idx],
+                       state._update_CR_weight[idx]))
+    def outlier_rows(n):
+        rows = state._outliers[len(state._outliers)-n:]
+        return asarray(rows, 'd').reshape(n, 3)
+    return [('gen', 2+Npop, state.generation, len(state._gen_draws), gen_rows),
+            ('thin', 1+Npop, state._thin_count,
+             len(state._thin_draws), thin_rows),
+            ('point', Npop*Nvar, state._thin_count,
+             len(state._thin_draws), point_rows),
+            ('update', 1+Nvar+Ncr, state._update_count,
+             len(state._update_draws), update_rows),
+            ('outliers', 3, len(state._outliers), len(state._outliers),
+             outlier_rows),
+            ]
+
+def _tail(index, size, n):
+    """
+    Return indices of the last n records of a circular buffer whose next
+    record will be written at *index*.
+    """
+    return (index - n + numpy.arange(n)) % size if size else numpy.arange(0)
+
+def _saved_rows(path, width):
+    """
+    Return the number of complete rows in a binary record file.
+    """
+    if not os.path.exists(path):
+        return 0
+    return os.path.getsize(path)//(width*numpy.dtype(BINARY_DTYPE).itemsize)
+
+def _save_binary(state, filename, append):
+    if json is None:
+        raise ImportError("json is needed for binary state files")
+    header = _binary_header(state)
+    streams = _binary_streams(state)
+    if append:
+        # Check that the existing files are for the same state shape.
+        # Outlier removal rewrites the chain history, so if there are
+        # new outliers, rewrite everything that is still available.
+        try:
+            with open(filename+'-state.json') as fid:
+                old = json.load(fid)
+        except (IOError, ValueError):
+            old = None
+        saved_outliers = _saved_rows(filename+'-outliers.bin', 3)
+        if (old is None
+            or [old[k] for k in ('Npop','Nvar','Ncr','thinning')]
+               != [header[k] for k in ('Npop','Nvar','Ncr','thinning')]
+            or (saved_outliers != len(state._outliers)
+                and all(count <= size for _,_,count,size,_ in streams))):
+            append = False
+
+    itemsize = numpy.dtype(BINARY_DTYPE).itemsize
+    first = old.get('first', {}) if append else {}
+    header['first'] = {}
+    header['replay'] = old.get('replay', []) if append else []
+    if append:
+        # New outliers apply to the rows already saved; rows written below
+        # come from memory, where the chains have already been replaced.
+        gen_rows = _saved_rows(filename+'-gen.bin', 2+state.Npop)
+        thin_rows = min(_saved_rows(filename+'-thin.bin', 1+state.Npop),
+                        _saved_rows(filename+'-point.bin',
+                                    state.Npop*state.Nvar))
+        for _, old_chain, new_chain in state._outliers[saved_outliers:]:
+            header['replay'].append([gen_rows, thin_rows,
+                                     int(old_chain), int(new_chain)])
+    for name, width, count, size, rows in streams:
+        path = "%s-%s.bin"%(filename,name)
+        if append:
+            saved = _saved_rows(path, width)
+            start = first.get(name, 0)
+            if start + saved > count:
+                raise ValueError("%s has more records than the state"%path)
+            new = count - start - saved
+            if new > min(count, size):
+                raise ValueError("%s records have been dropped from the"
+                                 " history buffer before being saved"%name)
+            with open(path, 'r+b' if saved else 'wb') as fid:
+                # Drop any partial record left by an interrupted write
+                fid.seek(saved*width*itemsize)
+                fid.truncate()
+                if new > 0:
+                    fid.write(asarray(rows(new), BINARY_DTYPE).tostring())
+        else:
+            # The file may be mapped by the state being saved, so write
+            # a new file rather than truncating it.
+            new = min(count, size)
+            start = count - new
+            with open(path+'.tmp', 'wb') as fid:
+                if new > 0:
+                    fid.write(asarray(rows(new), BINARY_DTYPE).tostring())
+            _replace_file(path+'.tmp', path)
+        header['first'][name] = start
+
+    # Write the header last, replacing the old one in a single step
+    tmp = filename+'-state.json.tmp'
+    with open(tmp, 'w') as fid:
+        json.dump(header, fid)
+    _replace_file(tmp, filename+'-state.json')
+
+def _replace_file(tmp, path):
+    """
+    Rename *tmp* to *path*, replacing the existing file.
+    """
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+def _load_binary(filename, skip=0):
+    with open(filename+'-state.json') as fid:
+        header = json.load(fid)
+    if header['version'] > BINARY_VERSION:
+        raise ValueError("%s-state.json is from a newer version"%filename)
+    Npop, Nvar, Ncr = header['Npop'], header['Nvar'], header['Ncr']
+    def load(name, width):
+        path = "%s-%s.bin"%(filename,name)
+        n = _saved_rows(path, width)
+        if n == 0:
+            return numpy.empty((0,width))
+        # Copy on write so that the state can be modified in memory
+        # without changing the file.
+        return numpy.memmap(path, dtype=BINARY_DTYPE, mode='c',
+                            shape=(n,width))
+    gen = load('gen', 2+Npop)
+    thin = load('thin', 1+Npop)
+    point = load('point', Npop*Nvar)
+    update = load('update', 1+Nvar+Ncr)
+    outliers = load('outliers', 3)
+
+    # Replace outlier chains in rows saved before the outliers were removed
+    for gen_rows, thin_rows, old, new in header.get('replay', []):
+        gen[:gen_rows,2+old] = gen[:gen_rows,2+new]
+        thin[:thin_rows,1+old] = thin[:thin_rows,1+new]
+        chains = point[:thin_rows].reshape((-1,Npop,Nvar))
+        chains[:,old,:] = chains[:,new,:]
+
+    # Only the points are used in place; the remaining records are small
+    # and the state expects contiguous arrays, so copy them into memory.
+    Nthin = min(len(thin), len(point))
+    thin, point = thin[skip:Nthin], point[skip:Nthin]
+    Ngen, Nthin, Nupdate = len(gen), len(thin), len(update)
+    state = MCMCDraw(0,0,0,0,0,0,header['thinning'])
+    state.draws = int(gen[-1,0]) if Ngen else 0
+    state.generation = Ngen
+    state._gen_index = 0
+    state._gen_draws = gen[:,0].copy()
+    state._gen_acceptance_rate = gen[:,1].copy()
+    state._gen_logp = gen[:,2:].copy()
+    state._thin_count = Nthin
+    state._thin_index = 0
+    state._thin_timer = header['thin_timer']
+    state._thin_draws = thin[:,0].copy()
+    state._thin_logp = thin[:,1:].copy()
+    state._thin_point = point.reshape((Nthin,Npop,Nvar))
+    state._update_count = Nupdate
+    state._update_index = 0
+    state._update_draws = update[:,0].copy()
+    state._update_R_stat = update[:,1:1+Nvar].copy()
+    state._update_CR_weight = update[:,1+Nvar:].copy()
+    state._outliers = [tuple(int(v) for v in row) for row in outliers]
+    state._labels = header['labels']
+    state.title = header['title']
+    if header['best_x'] is not None:
+        state._best_logp = header['best_logp']
+        state._best_x = numpy.array(header['best_x'])
+    return state
+
+def _save_text(state, filename):
     trace = open(filename+"-trace.mc","w")
     trace.write("starting trace\n"); trace.flush();
     # Build 2-D data structures
@@ -114,8 +386,6 @@ def save_state(state, filename):
     trace.write("building stats\n"); trace.flush();
     stats = hstack((draws[:,None], R_stat, CR_weight))
 
-    #TODO: missing _outliers from save_state
-
     # Write convergence info
     trace.write("writing chain\n"); trace.flush();
     file = CREATE(filename+'-chain'+EXT,'w')
@@ -136,6 +406,13 @@ def save_state(state, filename):
     file.write('# draws %d*R-stat %d*CR_weight\n'%(Nvar,Ncr))
     savetxt(file,stats)
     file.close()
+
+    # Write outliers
+    trace.write("writing outliers\n"); trace.flush();
+    file=CREATE(filename+'-outliers'+EXT,'w')
+    file.write('# thinned_generation old_chain new_chain\n')
+    savetxt(file,state.outliers().reshape(-1,3),fmt='%d')
+    file.close()
     trace.write("done state save\n"); trace.flush();
     trace.close()
 
@@ -176,6 +453,22 @@ def loadtxt(file, report=0):
     return asarray(res)
 
 def load_state(filename, skip=0, report=0):
+    """
+    Load the MCMC state from files starting with *filename*.
+
+    Binary state files are memory mapped, so only the portions of the
+    history that are used will be read from disk.  If there is no binary
+    state, then the text files are read instead.
+
+    *skip* is the number of thinned generations to skip from the start
+    of the history.  *report* is the number of lines between progress
+    reports while reading text files.
+    """
+    if os.path.exists(filename+'-state.json'):
+        return _load_binary(filename, skip=skip)
+    return _load_text(filename, skip=skip, report=report)
+
+def _load_text(filename, skip=0, report=0):
     # Read chain file
     chain = loadtxt(filename+'-chain'+EXT)
 
@@ -218,7 +511,11 @@ def load_state(filename, skip=0, report=0):
     state._update_draws = stats[:,0]
     state._update_R_stat = stats[:,1:Nvar+1]
     state._update_CR_weight = stats[:,Nvar+1:]
-    state._outliers = []
+    if os.path.exists(filename+'-outliers'+EXT):
+        outliers = loadtxt(filename+'-outliers'+EXT).reshape(-1,3)
+        state._outliers = [tuple(int(v) for v in row) for row in outliers]
+    else:
+        state._outliers = []
 
     bestidx = numpy.argmax(point[:,0])
     state._best_logp = point[bestidx,0]
@@ -236,7 +533,8 @@ class MCMCDraw(object):
         """Number of parameters in the fit"""
         return self._thin_point.shape[2]
 
-    def __init__(self, Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning):
+    def __init__(self, Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning,
+                 history=None):
         # Total number of draws so far
         self.draws = 0
 
@@ -264,9 +562,16 @@ class MCMCDraw(object):
         self._thin_count = 0
         self._thin_timer = 0
         self._thin_draws = empty(Nthin, 'i')
-        self._thin_point = empty( (Nthin, Npop, Nvar) )
         self._thin_logp = empty( (Nthin, Npop) )
 
+        # Thinned points are kept in memory, or in a memory mapped file
+        # if a history filename is given.
+        self._history = history
+        if history is None:
+            self._thin_point = empty( (Nthin, Npop, Nvar) )
+        else:
+            self._thin_point = _history_buffer(history, (Nthin, Npop, Nvar))
+
         # Per update iteration
         self._update_index = 0
         self._update_count = 0
@@ -276,6 +581,9 @@ class MCMCDraw(object):
 
         self._outliers = []
 
+        # Running R-statistic, created on demand by _current_R_stat
+        self._gelman = None
+
         # Query functions will not return outlier chains; initially, all
         # chains are marked as good.  Call mark_outliers to remove
         # outlier chains from the set.
@@ -294,7 +602,8 @@ class MCMCDraw(object):
     @property
     def Ncr(self): return self._update_CR_weight.shape[1]
 
-    def resize(self, Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning):
+    def resize(self, Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning,
+               history=None):
         if self.Nvar != Nvar or self.Npop != Npop or self.Ncr != Ncr:
             raise ValueError("Cannot change Nvar, Npop or Ncr on resize")
 
@@ -315,18 +624,27 @@ class MCMCDraw(object):
             self._gen_logp = self._gen_logp[-Ngen:,:].copy()
             self._gen_acceptance_rate = self._gen_acceptance_rate[-Ngen:].copy()
 
+        if history is not None or self._history is not None:
+            # Move the points to the history file, keeping the most
+            # recent Nthin thinned generations.
+            self._history = history if history is not None else self._history
+            source, self._thin_point = self._thin_point, None
+            self._thin_point = _history_buffer(self._history,
+                                               (Nthin, Npop, Nvar), source)
         if Nthin > self.Nthin:
             self._thin_index = self.Nthin # must happen before resize!!
             self._thin_draws = numpy.resize(self._thin_draws, Nthin)
-            self._thin_point = numpy.resize(self._thin_point,  (Nthin, Npop, Nvar) )
+            if self._history is None:
+                self._thin_point = numpy.resize(self._thin_point,  (Nthin, Npop, Nvar) )
             self._thin_logp = numpy.resize(self._thin_logp,  (Nthin, Npop) )
         elif Nthin < self.Nthin:
             self._thin_draws = self._thin_draws[-Nthin:].copy()
-            self._thin_point = self._thin_point[-Nthin:,:,:].copy()
+            if self._history is None:
+                self._thin_point = self._thin_point[-Nthin:,:,:].copy()
             self._thin_logp = self._thin_logp[-Nthin:,:].copy()
 
         if Nupdate > self.Nupdate:
-            self._update_count = self.Nupdate # must happen before resize!!
+            self._update_index = self.Nupdate # must happen before resize!!
             self._update_draws = numpy.resize(self._update_draws, Nupdate)
             self._update_R_stat = numpy.resize(self._update_R_stat,  (Nupdate, Nvar) )
             self._update_CR_weight = numpy.resize(self._update_CR_weight,  (Nupdate, Ncr) )
@@ -335,13 +653,20 @@ class MCMCDraw(object):
             self._update_R_stat = self._update_R_stat[-Nupdate:,:].copy()
             self._update_CR_weight = self._update_CR_weight[-Nupdate:,:].copy()
 
-    def save(self, filename):
-        save_state(self,filename)
+    def save(self, filename, format='binary'):
+        save_state(self,filename,format=format)
 
     def show(self, portion=1.0, figfile=None):
         from views import plot_all
         plot_all(self, portion=portion, figfile=figfile)
 
+    def subscribe(self):
+        """
+        Return a :class:`StateSubscription` for following the changes
+        to the state as sampling proceeds.
+        """
+        return StateSubscription(self)
+
     def _last_gen(self):
         """
         Returns x, logp for most recent generation to dream.py.
@@ -419,6 +744,8 @@ class MCMCDraw(object):
         clone of another.
         """
         self._outliers.append((self._thin_index,old,new))
+        if self._gelman is not None:
+            self._gelman.replace_chain(old,new)
 
         self._gen_logp[:,old] = self._gen_logp[:,new]
         self._thin_logp[:,old] = self._thin_logp[:,new]
@@ -435,48 +762,71 @@ class MCMCDraw(object):
         self._labels = v
     labels = property(fget=_get_labels,fset=_set_labels)
 
+    def _thin_rows(self, start, stop):
+        """
+        Return the points for thinned generations *start* through *stop*-1,
+        numbered from the first thinned generation of the run.
+
+        Only the requested rows are read from the history buffer.
+        """
+        k = len(self._thin_draws)
+        count = self._thin_count
+        if count > k or count > self._thin_index:
+            Ngen, first = k, self._thin_index
+        else:
+            Ngen, first = count, 0
+        oldest = count - Ngen
+        if start < oldest or stop > count:
+            raise IndexError("thinned generations %d:%d are not available"
+                             %(start, stop))
+        rows = (first + numpy.arange(start, stop) - oldest)%k
+        return self._thin_point[rows]
+
+    def _current_R_stat(self, portion=0.5):
+        """
+        Returns the Gelman-Rubin R-statistic for the last *portion* of the
+        chains.  This is updated incrementally as generations are added.
+        """
+        if self._gelman is None or self._gelman.portion != portion:
+            self._gelman = RunningGelman(portion)
+        return self._gelman(self)
+
     def _draw_pop(self, Npop):
         """
         Generate a population from current generation and all history.
         """
-        _, chains, _ = self.chains()
-        Ngen,Nchain,Nvar = chains.shape
-        points = reshape(chains,(Ngen*Nchain,Nvar))
-
-        # There are two complications with the history buffer:
-        # (1) due to thinning, not every generation is stored
-        # (2) because it is circular, the cursor may be in the middle
-        # If the current generation isn't in the buffer (but is instead
-        # stored separately as _gen_current), then the entire buffer
-        # becomes the history pool.
-        # otherwise we need to exclude the current generation from
-        # the pool.  If (2) happens, we need to increment everything
-        # above the cursor by the number of chains.
-        if self._gen_current != None:
+        # Only the rows which are selected are read from the history, so
+        # the entire history never needs to be in memory at once.
+        k = len(self._thin_draws)
+        Nchain, Nvar = self._thin_point.shape[1:]
+        if self._thin_count > k or self._thin_count > self._thin_index:
+            # Circular buffer has wrapped; the oldest entry is at the cursor
+            Ngen, start = k, self._thin_index
+        else:
+            Ngen, start = self._thin_count, 0
+
+        # The history pool is every thinned generation except the current
+        # one.  If the current generation isn't in the buffer due to
+        # thinning (it is instead stored separately as _gen_current), then
+        # all thinned generations are in the pool.
+        if self._gen_current is not None:
             pool_size = Ngen*Nchain
-            cursor = pool_size  # infinite
         else:
             pool_size = (Ngen-1)*Nchain
-            k = len(self._thin_draws)
-            cursor = Nchain*((k+self._thin_index-1)%k)
 
         # Make a return population and fill it with the current generation
         pop = empty((Npop,Nvar),'d')
-        if self._gen_current != None:
+        if self._gen_current is not None:
             pop[:Nchain] = self._gen_current
         else:
-            #print pop.shape, points.shape, chains.shape
-            pop[:Nchain] = points[cursor:cursor+Nchain]
+            pop[:Nchain] = self._thin_point[(self._thin_index-1)%k]
 
         if Npop > Nchain:
-            # Find the remainder with unique ancestors.
-            # Again, because this is a circular buffer, their may be random
-            # numbers generated at or above the cursor.  All of these must
-            # be shifted by Nchains to avoid the cursor.
+            # Find the remainder with unique ancestors, numbering the
+            # pool from the oldest generation to the newest.
             perm = draw(Npop-Nchain,pool_size)
-            perm[perm>=cursor] += Nchain
-            #print "perm",perm; raw_input('wait')
-            pop[Nchain:] = points[perm]
+            row, chain = (start + perm//Nchain)%k, perm%Nchain
+            pop[Nchain:] = self._thin_point[row,chain]
 
         return pop
 
@@ -499,8 +849,11 @@ class MCMCDraw(object):
         if self._thin_count > self._thin_index > 0:
             self._thin_draws[:] = numpy.roll(self._thin_draws,
                                              -self._thin_index, axis=0)
-            self._thin_point[:] = numpy.roll(self._thin_point,
-                                             -self._thin_index, axis=0)
+            if not isinstance(self._thin_point, numpy.memmap):
+                self._thin_point[:] = numpy.roll(self._thin_point,
+                                                 -self._thin_index, axis=0)
+            else:
+                _rotate_rows(self._thin_point, self._thin_index)
             self._thin_logp[:] = numpy.roll(self._thin_logp,
                                             -self._thin_index, axis=0)
             self._thin_index = 0
@@ -803,6 +1156,206 @@ class MCMCDraw(object):
             pass
 
 
+class StateSubscription(object):
+    """
+    Follow the changes to an :class:`MCMCDraw` state.
+
+    Each call to :meth:`delta` returns a :class:`StateDelta` holding copies
+    of the records added to the state since the previous call.  The delta
+    can be handed to another thread and applied to a mirror of the state
+    with :meth:`StateDelta.apply`, so the mirror can be kept up to date
+    while sampling continues without copying the whole state each time.
+    For example, a monitor in the fit thread may use::
+
+        if subscription is None:
+            subscription = state.subscribe()
+        queue.put(subscription.delta())
+
+    with the consumer using::
+
+        mirror = queue.get().apply(mirror)
+
+    Deltas must be applied in the order they are produced.  The first
+    delta, and any delta taken after the state has been resized, resets
+    the mirror to the records currently available in the state.  If the
+    state keeps its points in a history file, the mirror keeps its points
+    in a temporary file in the same directory, so neither is held in
+    memory.
+    """
+    def __init__(self, state):
+        self.state = state
+        self._sent = None
+
+    def delta(self, full=False):
+        """
+        Return the changes to the state since the last delta.
+
+        If *full* is True, then send all the available records, resetting
+        the mirror.  This is needed after the state history has been
+        modified in place, e.g., by :meth:`MCMCDraw.keep_best`.
+        """
+        shape, counts = _state_shape(self.state), _state_counts(self.state)
+        reset = (full or self._sent is None or self._sent[0] != shape
+                 or any(c < s for c,s in zip(counts, self._sent[1])))
+        sent = (0,0,0,0) if reset else self._sent[1]
+        self._sent = shape, counts
+        return StateDelta(self.state, shape, counts, sent, reset)
+
+class StateDelta(object):
+    """
+    Records added to an :class:`MCMCDraw` state between two calls to
+    :meth:`StateSubscription.delta`.
+
+    *generations* is the number of new generations and *samples* is the
+    number of new thinned generations in the delta.  If *reset* is True,
+    the delta replaces the mirror rather than extending it.
+    """
+    def __init__(self, state, shape, counts, sent, reset):
+        self.shape, self.counts, self.reset = shape, counts, reset
+        self.generations = counts[0] - sent[0]
+        self.samples = counts[1] - sent[1]
+        # Only the records still in the circular buffers can be sent; if
+        # more than that are new, the oldest are overwritten in the mirror
+        # as well, so nothing is lost.
+        Ngen, Nthin, Nupdate = shape[:3]
+        def tail(index, size, n):
+            return _tail(index, size, min(n, size))
+        idx = tail(state._gen_index, Ngen, self.generations)
+        self.gen = (state._gen_draws[idx], state._gen_logp[idx],
+                    state._gen_acceptance_rate[idx])
+        idx = tail(state._thin_index, Nthin, self.samples)
+        self.thin = (state._thin_draws[idx], state._thin_point[idx],
+                     state._thin_logp[idx])
+        idx = tail(state._update_index, Nupdate, counts[2] - sent[2])
+        self.update = (state._update_draws[idx], state._update_R_stat[idx],
+                       state._update_CR_weight[idx])
+        self.outliers = state._outliers[sent[3]:]
+        self.draws = state.draws
+        self.thin_timer = state._thin_timer
+        self.best_x = None if state._best_x is None else state._best_x+0
+        self.best_logp = state._best_logp
+        self.good_chains = state._good_chains
+        self.labels, self.title = state._labels, state.title
+        self.history = state._history
+
+    def apply(self, state=None):
+        """
+        Apply the delta to the mirror *state*, returning the updated mirror.
+
+        A new mirror is created if *state* is None or the delta is a reset.
+        """
+        if self.reset or state is None:
+            Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning = self.shape
+            state = MCMCDraw(Ngen, Nthin, Nupdate, Nvar, Npop, Ncr, thinning)
+            if self.history is not None:
+                state._thin_point = _scratch_buffer((Nthin, Npop, Nvar),
+                                        os.path.dirname(self.history) or None)
+        elif _state_shape(state) != self.shape:
+            raise ValueError("state delta does not match the mirrored state")
+
+        # Outlier replacement rewrites the history of the replaced chain,
+        # so apply it to the existing records before adding the new ones,
+        # which already include the replacement.
+        for _, old, new in self.outliers:
+            state._gen_logp[:,old] = state._gen_logp[:,new]
+            state._thin_logp[:,old] = state._thin_logp[:,new]
+            state._thin_point[:,old,:] = state._thin_point[:,new,:]
+            if state._gelman is not None:
+                state._gelman.replace_chain(old, new)
+        state._outliers.extend(self.outliers)
+
+        state._gen_index = _append_rows(state._gen_index,
+            (state._gen_draws, state._gen_logp, state._gen_acceptance_rate),
+            self.gen)
+        state._thin_index = _append_rows(state._thin_index,
+            (state._thin_draws, state._thin_point, state._thin_logp),
+            self.thin)
+        state._update_index = _append_rows(state._update_index,
+            (state._update_draws, state._update_R_stat,
+             state._update_CR_weight),
+            self.update)
+        (state.generation, state._thin_count,
+         state._update_count, _) = self.counts
+
+        state.draws = self.draws
+        state._thin_timer = self.thin_timer
+        state._best_x, state._best_logp = self.best_x, self.best_logp
+        state._good_chains = self.good_chains
+        state._labels, state.title = self.labels, self.title
+        return state
+
+def _state_shape(state):
+    return (state.Ngen, state.Nthin, state.Nupdate, state.Nvar,
+            state.Npop, state.Ncr, state.thinning)
+
+def _state_counts(state):
+    return (state.generation, state._thin_count, state._update_count,
+            len(state._outliers))
+
+def _append_rows(index, arrays, rows):
+    """
+    Write *rows* to the circular buffers *arrays* starting at *index*,
+    returning the index of the next row.
+    """
+    n, size = len(rows[0]), len(arrays[0])
+    if n == 0:
+        return index
+    idx = (index + numpy.arange(n)) % size
+    for a, r in zip(arrays, rows):
+        a[idx] = r
+    return (index + n) % size
+
+def _history_buffer(filename, shape, source=None):
+    """
+    Create a memory mapped array of the given *shape* in *filename*.
+
+    If *source* is given, copy its most recent rows to the new buffer.
+    *source* may be mapped to *filename*; it is released before the new
+    buffer replaces the file.
+    """
+    tmp = filename+'.tmp'
+    buf = numpy.memmap(tmp, dtype='d', mode='w+', shape=shape)
+    if source is not None:
+        n = min(len(source), shape[0])
+        # Copy a row at a time so memory use is independent of history size
+        for i in range(n):
+            buf[i] = source[len(source)-n+i]
+        del source
+    buf.flush()
+    del buf
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+    return numpy.memmap(filename, dtype='d', mode='r+', shape=shape)
+
+def _scratch_buffer(shape, dir=None):
+    """
+    Create a memory mapped array of the given *shape* backed by an unnamed
+    temporary file in *dir*.  The file is removed when the array is freed.
+    """
+    import tempfile
+    with tempfile.TemporaryFile(dir=dir) as fid:
+        return numpy.memmap(fid, dtype='d', mode='w+', shape=shape)
+
+def _rotate_rows(a, shift):
+    """
+    Rotate the rows of *a* in place so that row *shift* becomes row 0.
+
+    This is numpy.roll(a, -shift, axis=0), but uses one row of temporary
+    storage rather than a copy of the entire array.
+    """
+    from fractions import gcd
+    n = len(a)
+    for start in range(gcd(n, shift)):
+        saved = a[start].copy()
+        i = start
+        while True:
+            j = (i + shift)%n
+            if j == start: break
+            a[i] = a[j]
+            i = j
+        a[i] = saved
+
 def _sample(state, portion, vars, selection):
     """
     Return a sample from a set of chains.
@@ -893,5 +1446,107 @@ def test():
     assert norm(logp[:,1] - pin[thinning-1::thinning,2]) == 0
     assert norm(logp[:,2] - pin[thinning-1::thinning,2]) == 0
 
+def test_subscribe():
+    from numpy.linalg import norm
+    from numpy.random import rand
+
+    # Make some fake data
+    Nupdate,Nstep = 3,5
+    Ngen = Nupdate*Nstep
+    Nvar,Npop,Ncr = 3,6,2
+    xin = rand(Ngen,Npop,Nvar)
+    pin = rand(Ngen,Npop)
+    accept = rand(Ngen,Npop) < 0.8
+    CRin = rand(Nupdate,Ncr)
+    Rin = rand(Nupdate,1)
+    thinning = 2
+
+    # Check that a mirror follows the state through the circular buffers
+    # wrapping and outlier replacement, with the points in memory or on disk.
+    import tempfile, shutil
+    path = tempfile.mkdtemp()
+    try:
+        for history in (None, os.path.join(path, 'points')):
+            state = MCMCDraw(Ngen=5, Nthin=3, Nupdate=2, Nvar=Nvar,
+                             Npop=Npop, Ncr=Ncr, thinning=thinning,
+                             history=history)
+            subscription = state.subscribe()
+            mirror = None
+            for gen in range(Ngen):
+                if gen%Nstep == 0:
+                    state._update(R_stat=Rin[gen//Nstep],
+                                  CR_weight=CRin[gen//Nstep])
+                state._generation(new_draws=Npop, x=xin[gen],
+                                  logp=pin[gen], accept=accept[gen])
+                if gen == 8:
+                    state._replace_outlier(1,2)
+                if gen%3 == 1 or gen == Ngen-1:
+                    mirror = subscription.delta().apply(mirror)
+            assert (isinstance(mirror._thin_point, numpy.memmap)
+                    == (history is not None))
+            for a, b in zip(state.chains(), mirror.chains()) + \
+                    zip(state.logp(), mirror.logp()) + \
+                    zip(state.CR_weight(), mirror.CR_weight()):
+                assert norm(a - b) == 0
+            assert state.outliers().tolist() == mirror.outliers().tolist()
+            del state, mirror, subscription
+        # The mirror does not leave files behind
+        assert os.listdir(path) == ['points']
+    finally:
+        shutil.rmtree(path)
+
+def test_save():
+    import tempfile, shutil
+    from numpy.random import rand
+
+    def generations(state, n):
+        Npop, Nvar = state.Npop, state.Nvar
+        for _ in range(n):
+            state._generation(new_draws=Npop, x=rand(Npop,Nvar),
+                              logp=rand(Npop), accept=rand(Npop)<0.5)
+    def same(a, b):
+        # Compare the records which are available in both states
+        for u, v in zip(a.chains(), b.chains()):
+            n = min(len(u), len(v))
+            assert len(v) > 0 and (u[-n:] == v[-n:]).all()
+
+    root = tempfile.mkdtemp()
+    try:
+        # Save a loaded state over the files it is mapped from
+        filename = os.path.join(root, 'run')
+        state = MCMCDraw(Ngen=20, Nthin=10, Nupdate=3,
+                         Nvar=2, Npop=5, Ncr=2, thinning=1)
+        generations(state, 6)
+        state.save(filename)
+        loaded = load_state(filename)
+        loaded.save(filename)
+        same(state, load_state(filename))
+
+        # Save a state whose buffers have wrapped, then append to it
+        filename = os.path.join(root, 'wrap')
+        state = MCMCDraw(Ngen=20, Nthin=4, Nupdate=3,
+                         Nvar=2, Npop=5, Ncr=2, thinning=1)
+        generations(state, 6)
+        state.save(filename)
+        generations(state, 2)
+        append_state(state, filename)
+        same(state, load_state(filename))
+
+        # Replace an outlier chain after the buffers have wrapped
+        generations(state, 3)
+        state._replace_outlier(1,2)
+        generations(state, 1)
+        append_state(state, filename)
+        loaded = load_state(filename)
+        same(state, loaded)
+        # Rows saved before the buffers wrapped have chain 1 replaced too
+        _, chains, logp = loaded.chains()
+        assert (chains[:-1,1] == chains[:-1,2]).all()
+        assert (logp[:-1,1] == logp[:-1,2]).all()
+    finally:
+        shutil.rmtree(root)
+
 if __name__ == "__main__":
     test()
+    test_subscribe()
+    test_save()
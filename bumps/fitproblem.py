@@ -14,6 +14,7 @@ import numpy
 
 from . import parameter, bounds as mbounds
 from .formatnum import format_uncertainty
+from .cache import NllfCache
 
 
 def preview(models=[], weights=None):
@@ -267,11 +268,38 @@ class Fitness(object):
         Restore the original data in the model (after resynth).
         """
         raise NotImplementedError
+    def nllf_batch(self, parameters, points):
+        """
+        Return the negative log likelihood for a population of points.
+
+        *parameters* is the list of fitted parameters and *points* is an
+        array of shape (Npop, Nvar) with one column per parameter.  Models
+        which can evaluate the whole population in one vectorized call
+        should return a vector of length Npop.  Return None if the batch
+        cannot be computed, and the fit problem will fall back to setting
+        the parameters and calling nllf for each point in turn.
+
+        This method is optional.
+        """
+        return None
     def residiuals(self):
         """
         Return residuals for current theory minus data.  For levenburg-marquardt.
         """
         raise NotImplementedError
+    def residuals_deriv(self, parameters):
+        """
+        Return the derivative of the residuals with respect to each of the
+        fitted *parameters* as an array of shape (Nresiduals, Nparameters).
+
+        Models with analytic derivatives can use this to avoid numerical
+        differentiation when computing the jacobian.  Set a column to NaN
+        if the derivative with respect to that parameter is not available,
+        or return None if there are no analytic derivatives.
+
+        This method is optional.
+        """
+        return None
     def save(self, basename):
         """
         Save the model to a file based on basename+extension.  This will point to
@@ -290,6 +318,22 @@ class Fitness(object):
         pass
 
 
+# Problem methods charged to their own phase by instrument()
+TIMED_METHODS = ('setp', 'model_update', 'model_nllf', 'model_nllf_batch',
+                 'parameter_nllf', 'constraints_nllf')
+
+def instrument(problem, timers):
+    """
+    Charge the time spent in the methods of *problem* listed in
+    *TIMED_METHODS* to the corresponding phases in *timers*, which is a
+    :class:`bumps.monitor.Timers` object.  Use *timers=None* to remove
+    the instrumentation.
+    """
+    for name in TIMED_METHODS:
+        problem.__dict__.pop(name, None)
+        if timers is not None:
+            setattr(problem, name, timers.timed(name, getattr(problem, name)))
+
 def no_constraints(): 
     """default constraints function for FitProblem"""
     return 0
@@ -341,6 +385,8 @@ def FitProblem(*args, **kw):
         return MultiFitProblem(*args, **kw)
 
 class BaseFitProblem(object):
+    _expressions = None
+    nllf_cache = None
     def __init__(self, fitness, name=None, constraints=no_constraints, 
                  penalty_nllf=1e6, soft_limit=numpy.inf, partial=False):
         self.constraints = constraints
@@ -381,7 +427,17 @@ class BaseFitProblem(object):
         if not self.partial: self.dof -= len(self._parameters)
         if self.dof <= 0:
             raise ValueError("Need more data points than fitting parameters")
+        self._compile_expressions(all_parameters)
+        self._data_changed()
         #self.constraints = pars.constraints()
+    def _compile_expressions(self, pars):
+        """
+        Gather the parameter expressions into a program that can be
+        evaluated in one pass on each model update.
+        """
+        if self._expressions is not None:
+            self._expressions.release()
+        self._expressions = parameter.compile_expressions(pars)
     def model_parameters(self):
         """
         Parameters associated with the model.
@@ -396,6 +452,8 @@ class BaseFitProblem(object):
         """
         Update the model according to the changed parameters.
         """
+        if self._expressions is not None:
+            self._expressions.update()
         if hasattr(self.fitness, 'update'):
             self.fitness.update()
     def model_nllf(self):
@@ -403,16 +461,46 @@ class BaseFitProblem(object):
         Negative log likelihood of seeing data given model.
         """
         return self.fitness.nllf()
+    def model_nllf_batch(self, points):
+        """
+        Negative log likelihood of seeing data given the model for each of
+        the parameter sets in *points*, or None if the model does not
+        support batch evaluation.
+        """
+        batch = getattr(self.fitness, 'nllf_batch', None)
+        if batch is None:
+            return None
+        return batch(self._parameters, points)
 
     def simulate_data(self, noise=None):
         """Simulate data with added noise"""
         self.fitness.simulate_data(noise=noise)
+        self._data_changed()
     def resynth_data(self):
         """Resynthesize data with noise from the uncertainty estimates."""
         self.fitness.resynth_data()
+        self._data_changed()
     def restore_data(self):
         """Restore original data after resynthesis."""
         self.fitness.restore_data()
+        self._data_changed()
+    def enable_cache(self, size=10000, bits=0):
+        """
+        Remember the nllf for the last *size* parameter vectors, ignoring
+        the last *bits* bits of each value.  See :class:`cache.NllfCache`.
+
+        The cache is used by :meth:`nllf`, and by the fit mapper when run
+        through :class:`fitters.FitDriver`.  It is cleared when the data
+        or the set of fitted parameters changes.  Use *problem.nllf_cache*
+        to see the hit rate and memory use.
+        """
+        self.nllf_cache = NllfCache(size=size, bits=bits)
+    def disable_cache(self):
+        """Stop caching nllf values."""
+        self.nllf_cache = None
+    def _data_changed(self):
+        if self.nllf_cache is not None:
+            self.nllf_cache.invalidate()
     def valid(self, pvec):
         return all(v in p.bounds for p,v in zip(self._parameters,pvec))
 
@@ -428,12 +516,10 @@ class BaseFitProblem(object):
         #TODO: do we have to leave the model in an invalid state?
         # WARNING: don't try to conditionally update the model
         # depending on whether any model parameters have changed.
-        # For one thing, the model_update below probably calls
-        # the subclass MultiFitProblem.model_update, which signals
-        # the individual models.  Furthermore, some parameters may
-        # related to others via expressions, and so a dependency
-        # tree needs to be generated.  Whether this is better than
-        # clicker() from SrFit I do not know.
+        # The model_update below may be the subclass method
+        # MultiFitProblem.model_update, which uses the dependency
+        # list built in model_reset to decide which of the individual
+        # models need to be signalled.
         for v, p in zip(pvec, self._parameters):
             p.value = v
         #self.constraints()
@@ -511,7 +597,24 @@ class BaseFitProblem(object):
         The model is not actually calculated if the parameter nllf plus the
         constraint nllf are bigger than *soft_limit*, but instead it is
         assigned a value of *penalty_nllf*.
+
+        If the cache is enabled (see :meth:`enable_cache`), the value is
+        returned from the cache when *pvec* has already been evaluated.
+        The parameters are still set to *pvec*.
         """
+        cache = self.nllf_cache
+        if cache is None:
+            return self._nllf(pvec)
+        key = cache.key(pvec if pvec is not None else self.getp())
+        value = cache.get(key)
+        if value is None:
+            value = self._nllf(pvec)
+            cache.put(key, value)
+        elif pvec is not None and self.valid(pvec):
+            self.setp(pvec)
+        return value
+
+    def _nllf(self, pvec):
         if pvec is not None:
             if self.valid(pvec):
                 self.setp(pvec)
@@ -544,6 +647,64 @@ class BaseFitProblem(object):
         # print "cost",cost,"=",pparameter,"+",pconstraint,"+",pmodel
         return cost
 
+    def nllf_batch(self, points):
+        """
+        Compute the cost function for each parameter set in *points*.
+
+        *points* is an array of shape (Npop, Nvar).  Returns a vector with
+        the value of :meth:`nllf` for each point.
+
+        If the model supports batch evaluation (see
+        :meth:`Fitness.nllf_batch`), then the entire population is sent
+        to the model in a single call.  The parameter and constraint
+        likelihoods, the bounds checks and the *soft_limit* cutoff are
+        still applied to each point individually, but these are cheap
+        compared to the model evaluation.  If the model does not support
+        batch evaluation, this is equivalent to calling :meth:`nllf` on
+        each point.
+        """
+        points = numpy.asarray(points, 'd')
+        if len(points) == 0:
+            return numpy.empty(0, 'd')
+
+        # Compute the prior for each point without updating the model.
+        # Remember the current parameter values so that we can restore
+        # them afterward; the model cache still reflects these values.
+        p0 = self.getp()
+        lo, hi = self.bounds()
+        valid = numpy.all((points >= lo) & (points <= hi), axis=1)
+        prior = numpy.empty(len(points), 'd')
+        prior[~valid] = inf
+        try:
+            for k in numpy.nonzero(valid)[0]:
+                for v, p in zip(points[k], self._parameters):
+                    p.value = v
+                if self._expressions is not None:
+                    self._expressions.update()
+                prior[k] = self.parameter_nllf() + self.constraints_nllf()
+        finally:
+            for v, p in zip(p0, self._parameters):
+                p.value = v
+            if self._expressions is not None:
+                self._expressions.update()
+        active = valid & (prior <= self.soft_limit)
+
+        try:
+            if active.any():
+                pmodel = self.model_nllf_batch(points[active])
+            else:
+                pmodel = numpy.empty(0, 'd')
+        except Exception:
+            # Errors will be reported by nllf on the individual points
+            pmodel = None
+        if pmodel is None:
+            return numpy.array([self.nllf(p) for p in points], 'd')
+
+        cost = prior + self.penalty_nllf
+        cost[active] = prior[active] + pmodel
+        cost[~valid | isnan(cost)] = inf
+        return cost
+
     def __call__(self, pvec=None):
         """
         Problem cost function.
@@ -581,65 +742,110 @@ class BaseFitProblem(object):
         if figfile != None:
             pylab.savefig(figfile+"-model.png", format='png')
 
-    def jacobian(self, pvec=None, step=None):
+    def residuals_batch(self, points):
+        """
+        Return the residuals for each parameter set in *points*.
+
+        *points* is an array of shape (Npop, Nvar).  Returns an array of
+        shape (Npop, Nresiduals).  The parameters are restored to their
+        current values when done.
+        """
+        p0 = self.getp()
+        try:
+            r = []
+            for p in points:
+                self.setp(p)
+                r.append(numpy.array(self.residuals(), 'd'))
+        finally:
+            self.setp(p0)
+        return numpy.array(r) if r else numpy.empty((0,0), 'd')
+
+    def jacobian(self, pvec=None, step=None, mapper=None):
         """
         Returns the derivative wrt the fit parameters at point p.
 
         Numeric derivatives are calculated based on step, where step is
         the portion of the total range for parameter j, or the portion of
         point value p_j if the range on parameter j is infinite.
+
+        Models which provide analytic derivatives through
+        :meth:`Fitness.residuals_deriv` use them in place of the
+        numeric derivatives.
+
+        *mapper* is an optional function which takes an array of points
+        and returns the residuals at each point, such as the one returned
+        by *start_residuals_mapper* in :mod:`bumps.mapper`.  All the
+        perturbed points are sent to the mapper in a single batch.  The
+        default is :meth:`residuals_batch`.
         """
         if step is None: step = 1e-8
         # Make sure the input vector is an array
         if pvec is None:
             pvec = [p.value for p in self._parameters]
-        pvec = numpy.asarray(pvec)
-        # We are being lazy here.  We can precompute the bounds, we can
-        # use the residuals_deriv from the sub-models which have analytic
-        # derivatives and we need only recompute the models which depend
-        # on the varying parameters.
-        # Meanwhile, let's compute the numeric derivative using the
-        # three point formula.
+        pvec = numpy.asarray(pvec, 'd')
         # We are not checking that the varied parameter in numeric
         # differentiation is indeed feasible in the interval of interest.
-        range = zip(*[p.bounds.limits for p in self._parameters])
-        lo,hi = [numpy.asarray(v) for v in range]
+        lo,hi = self.bounds()
         delta = (hi-lo)*step
         # For infinite ranges, use p*1e-8 for the step size
         idx = numpy.isinf(delta)
-        #print "J",idx,delta,pvec,type(idx),type(delta),type(pvec)
         delta[idx] = pvec[idx]*step
         delta[delta==0] = step
 
         # Set the initial value
-        for k,v in enumerate(pvec):
-            self._parameters[k].value = v
-        # Gather the residuals
-        r = []
-        for k,v in enumerate(pvec):
-            # Center point formula:
-            #     df/dv = lim_{h->0} ( f(v+h)-f(v-h) ) / ( 2h )
-            h = delta[k]
-            self._parameters[k].value = v + h
-            self.model_update()
-            rk = self.residuals()
-            self._parameters[k].value = v - h
-            self.model_update()
-            rk -= self.residuals()
-            r.append(rk/(2*h))
-            self._parameters[k].value = v
-        self.model_update()  # Restore model parameters
-        # return the jacobian
-        return numpy.vstack(r).T
+        self.setp(pvec)
+        J = self._analytic_jacobian()
+        return self._numeric_jacobian(J, pvec, delta, mapper)
+
+    def _analytic_jacobian(self):
+        """
+        Returns the analytic jacobian at the current point, with NaN for the
+        unknown derivatives, or None if there are no analytic derivatives.
+        """
+        deriv = getattr(self.fitness, 'residuals_deriv', None)
+        J = deriv(self._parameters) if deriv is not None else None
+        return numpy.array(J, 'd') if J is not None else None
 
+    def _numeric_jacobian(self, J, pvec, delta, mapper):
+        """
+        Fill in the columns of *J* containing NaN using the three point
+        formula, or compute the full jacobian if *J* is None.
 
-    def cov(self, pvec=None, step=None, tol=1e-8):
+        The parameters are left at *pvec*.
+        """
+        if J is None:
+            columns = numpy.arange(len(pvec))
+        else:
+            columns = numpy.nonzero(numpy.isnan(J).any(axis=0))[0]
+        if len(columns) == 0:
+            return J
+
+        # Center point formula:
+        #     df/dv = lim_{h->0} ( f(v+h)-f(v-h) ) / ( 2h )
+        # Build the points (v+h, v-h) for each parameter and evaluate them
+        # all at once.
+        points = numpy.repeat(pvec[None,:], 2*len(columns), axis=0)
+        for i,k in enumerate(columns):
+            points[2*i,k] += delta[k]
+            points[2*i+1,k] -= delta[k]
+        if mapper is None:
+            mapper = self.residuals_batch
+        r = numpy.asarray(mapper(points), 'd')
+        if J is None:
+            J = numpy.empty((r.shape[1], len(pvec)), 'd')
+        J[:,columns] = (r[0::2] - r[1::2]).T / (2*delta[columns])
+        return J
+
+
+    def cov(self, pvec=None, step=None, tol=1e-8, mapper=None):
         """
         Return the covariance matrix inv(J'J) at point p.
 
         We provide some protection against singular matrices by setting
         singular values smaller than tolerance *tol* to the tolerance
         value.
+
+        *mapper* is passed to :meth:`jacobian`.
         """
 
         # Find cov of f at p
@@ -652,19 +858,20 @@ class BaseFitProblem(object):
         #     inv(J'J) = inv(V S S V')
         #              = inv(V') inv(S S) inv(V)
         #              = V inv (S S) V'
-        J = self.jacobian(pvec, step=step)
+        J = self.jacobian(pvec, step=step, mapper=mapper)
         u,s,vh = numpy.linalg.svd(J,0)
         s[s<=tol] = tol
         JTJinv = numpy.dot(vh.T.conj()/s**2,vh)
         return JTJinv
 
-    def stderr(self, pvec=None, step=None):
+    def stderr(self, pvec=None, step=None, mapper=None):
         """
         Return parameter uncertainty.
 
         This is just the sqrt diagonal of covariance matrix inv(J'J) at point p.
         """
-        return numpy.sqrt(numpy.diag(self.cov(pvec, step=step)))
+        return numpy.sqrt(numpy.diag(self.cov(pvec, step=step,
+                                              mapper=mapper)))
 
     def __getstate__(self):
         return self.fitness,self.partial,self.name,self.penalty_nllf,self.soft_limit,self.constraints
@@ -681,6 +888,7 @@ class MultiFitProblem(BaseFitProblem):
                  constraints=no_constraints, 
                  soft_limit=numpy.inf, penalty_nllf=1e6,
                  freevars=None):
+        self.name = name
         self.partial = False
         self.constraints = constraints
         if freevars is None:
@@ -717,23 +925,94 @@ class MultiFitProblem(BaseFitProblem):
         if free: pars['freevars'] = free
         return pars
 
+    def model_reset(self):
+        """
+        Prepare for the fit.
+
+        In addition to the setup in :meth:`BaseFitProblem.model_reset`,
+        this records the parameters that each model depends on so that
+        :meth:`model_update` only needs to recalculate the models whose
+        parameters have changed.
+        """
+        BaseFitProblem.model_reset(self)
+        references = [id(p) for p in self.freevars.references()]
+        free = self.freevars.parameters().values()
+        self._dependencies = []
+        for i,f in enumerate(self._models):
+            # The free variable references are set from the model specific
+            # free parameters each time the model is selected, so depend on
+            # the model specific parameters rather than the references.
+            pars = [p for p in parameter.dependencies(f.model_parameters())
+                    if id(p) not in references]
+            pars += parameter.dependencies([v[i] for v in free])
+            self._dependencies.append(pars)
+        self._dependency_values = [None for _ in self._models]
+        self._clear_cache()
+
+    def _compile_expressions(self, pars):
+        """
+        Gather the parameter expressions for all models into one program.
+
+        Expressions involving free variables take different values for
+        each model, so these are left out of the program.
+        """
+        for f in self._models:
+            if f._expressions is not None:
+                f._expressions.release()
+                f._expressions = None
+        if self._expressions is not None:
+            self._expressions.release()
+        self._expressions = parameter.compile_expressions(pars,
+                                    exclude=self.freevars.references())
+
+    def _clear_cache(self, i=None):
+        """Forget the cached nllf and residuals for model *i*, or all models"""
+        if i is None:
+            self._cached_nllf = [None for _ in self._models]
+            self._cached_residuals = [None for _ in self._models]
+        else:
+            self._cached_nllf[i] = self._cached_residuals[i] = None
+
     def model_points(self):
         """Return number of points in all models"""
         return sum(f.model_points() for f in self.models)
     def model_update(self):
-        """Let all models know they need to be recalculated"""
-        # TODO: consider an "on changed" signal for model updates.
-        # The update function would be associated with model parameters
-        # rather than always recalculating everything.  This
-        # allows us to set up fits with 'fast' and 'slow' parameters,
-        # where the fit can quickly explore a subspace where the
-        # computation is cheap before jumping to a more expensive
-        # subspace.  SrFit does this.
-        for f in self.models:
-            f.model_update()
+        """Let models with changed parameters know they need to be recalculated"""
+        # Compare the parameters that each model depends on with their
+        # values at the last update.  This allows us to set up fits with
+        # 'fast' and 'slow' parameters, where the fit can quickly explore
+        # a subspace where the computation is cheap before jumping to a
+        # more expensive subspace.  SrFit does this.
+        self._expressions.update()
+        for i,f in enumerate(self.models):
+            values = [p.value for p in self._dependencies[i]]
+            if values != self._dependency_values[i]:
+                self._dependency_values[i] = values
+                self._clear_cache(i)
+                f.model_update()
     def model_nllf(self):
         """Return cost function for all data sets"""
-        return sum(f.model_nllf() for f in self.models)
+        for i,f in enumerate(self.models):
+            if self._cached_nllf[i] is None:
+                self._cached_nllf[i] = f.model_nllf()
+        return sum(self._cached_nllf)
+    def model_nllf_batch(self, points):
+        """
+        Return cost function for all data sets for each point, or None
+        if any of the models does not support batch evaluation.
+        """
+        # Free variables are swapped into the models one at a time, so
+        # they cannot be evaluated across the population.
+        if self.freevars.parameters():
+            return None
+        total = 0
+        for f in self._models:
+            batch = getattr(f.fitness, 'nllf_batch', None)
+            value = batch(self._parameters, points) if batch else None
+            if value is None:
+                return None
+            total = total + value
+        return total
     def constraints_nllf(self):
         """Return the cost function for all constraints"""
         return sum(f.constraints_nllf() for f in self.models) \
@@ -741,17 +1020,101 @@ class MultiFitProblem(BaseFitProblem):
     def simulate_data(self, noise=None):
         """Simulate data with added noise"""
         for f in self.models: f.simulate_data(noise=noise)
+        self._clear_cache()
+        self._data_changed()
     def resynth_data(self):
         """Resynthesize data with noise from the uncertainty estimates."""
         for f in self.models: f.resynth_data()
+        self._clear_cache()
+        self._data_changed()
     def restore_data(self):
         """Restore original data after resynthesis."""
         for f in self.models: f.restore_data()
+        self._clear_cache()
+        self._data_changed()
     def residuals(self):
-        resid = numpy.hstack([w * f.residuals()
-                              for w, f in zip(self.weights, self.models)])
+        for i,f in enumerate(self.models):
+            if self._cached_residuals[i] is None:
+                self._cached_residuals[i] = f.residuals()
+        resid = numpy.hstack([w * r for w, r
+                              in zip(self.weights, self._cached_residuals)])
         return resid
 
+    def _analytic_jacobian(self):
+        """
+        Returns the jacobian from the analytic derivatives of the models,
+        with zero for the parameters that a model does not depend on and
+        NaN for the unknown derivatives.
+        """
+        self.residuals()  # Need the number of residuals in each model
+        rows = numpy.cumsum([0]+[len(r) for r in self._cached_residuals])
+        J = numpy.zeros((rows[-1], len(self._parameters)), 'd')
+        free = self.freevars.parameters()
+        for i,f in enumerate(self.models):
+            depends = set(id(p) for p in self._dependencies[i])
+            used = [id(p) in depends for p in self._parameters]
+            # Free variables are swapped into the models by reference, so
+            # the models can't give the derivatives with respect to them.
+            deriv = getattr(f.fitness, 'residuals_deriv', None)
+            D = deriv(self._parameters) if deriv and not free else None
+            if D is None:
+                J[rows[i]:rows[i+1],used] = numpy.NaN
+            else:
+                J[rows[i]:rows[i+1],used] = (self.weights[i]
+                                             * numpy.asarray(D,'d')[:,used])
+        return J
+
+    def _numeric_jacobian(self, J, pvec, delta, mapper):
+        """
+        Fill in the unknown derivatives in *J* using the three point
+        formula, recomputing only the models which depend on each parameter.
+
+        If a *mapper* is given, all models are computed for all points in
+        a single batch instead.
+        """
+        if mapper is not None:
+            return BaseFitProblem._numeric_jacobian(self, J, pvec, delta,
+                                                    mapper)
+        rows = numpy.cumsum([0]+[len(r) for r in self._cached_residuals])
+        for k,p in enumerate(self._parameters):
+            models = [i for i in range(len(self._models))
+                      if numpy.isnan(J[rows[i]:rows[i+1],k]).any()]
+            if not models:
+                continue
+            v, h = pvec[k], delta[k]
+            r = []
+            for value in (v+h, v-h):
+                p.value = value
+                self._expressions.update()
+                r.append(self._model_residuals(models))
+            # Restore the value, leaving the cached residuals for the
+            # central point in place.
+            p.value = v
+            self._expressions.update()
+            self._model_residuals(models, evaluate=False)
+            for i,rplus,rminus in zip(models,*r):
+                J[rows[i]:rows[i+1],k] = (self.weights[i]
+                                          * (rplus-rminus)/(2*h))
+        return J
+
+    def _model_residuals(self, models, evaluate=True):
+        """
+        Update the selected *models* from the current parameter values
+        and return their residuals.  With *evaluate* False, the models
+        are flagged as changed but not recalculated.
+        """
+        r = []
+        try:
+            for i in models:
+                self.freevars.set_model(i)
+                f = self._models[i]
+                f.model_update()
+                if evaluate:
+                    r.append(numpy.array(f.residuals(), 'd'))
+        finally:
+            self.freevars.set_model(self._active_model_index)
+        return r
+
     def save(self, basename):
         for i, f in enumerate(self.models):
             f.save(basename + "-%d" % (i + 1))
@@ -771,7 +1134,9 @@ class MultiFitProblem(BaseFitProblem):
                 pylab.savefig(figfile+"-model%d.png"%i, format='png')
 
     def __getstate__(self):
-        return self.__dict__
+        # Don't copy the timed methods from instrument() or the nllf cache
+        return dict((k,v) for k,v in self.__dict__.items()
+                    if k not in TIMED_METHODS and k != 'nllf_cache')
 
     def __setstate__(self, state):
         self.__dict__ = state
@@ -799,3 +1164,81 @@ def load_problem(file, options=[]):
         raise ValueError(file+" does not define 'problem=FitProblem(...)'")
 
     return problem
+
+
+def test():
+    """
+    Check the batched, mapped, analytic and partial update jacobians
+    against serial finite differences.
+    """
+    from .mapper import SerialMapper
+    from .parameter import Parameter
+
+    class Quadratic(object):
+        # y = a x^2 + b x + c, with analytic derivatives for a and b
+        def __init__(self, x, y, a, b, c, deriv=True):
+            self.x, self.y, self.dy = x, y, 0.1 + 0*x
+            self.a, self.b, self.c, self.deriv = a, b, c, deriv
+        def parameters(self):
+            return dict(a=self.a, b=self.b, c=self.c)
+        def numpoints(self):
+            return len(self.x)
+        def update(self):
+            pass
+        def residuals(self):
+            theory = (self.a.value*self.x**2 + self.b.value*self.x
+                      + self.c.value)
+            return (theory - self.y)/self.dy
+        def nllf(self):
+            return 0.5*numpy.sum(self.residuals()**2)
+        def residuals_deriv(self, parameters):
+            if not self.deriv:
+                return None
+            known = {id(self.a): self.x**2/self.dy,
+                     id(self.b): self.x/self.dy}
+            return numpy.array([known.get(id(p), numpy.NaN*self.x)
+                                for p in parameters]).T
+
+    def serial_jacobian(problem, pvec):
+        lo, hi = problem.bounds()
+        delta = (hi - lo)*1e-8
+        J = []
+        for k in range(len(pvec)):
+            r = []
+            for h in (delta[k], -delta[k]):
+                p = pvec.copy()
+                p[k] += h
+                problem.setp(p)
+                r.append(numpy.array(problem.residuals(), 'd'))
+            J.append((r[0] - r[1])/(2*delta[k]))
+        problem.setp(pvec)
+        return numpy.array(J).T
+
+    def check(problem):
+        pvec = problem.getp() + 0.1
+        target = serial_jacobian(problem, pvec)
+        mapper = SerialMapper.start_residuals_mapper(problem, [])
+        for J in (problem.jacobian(pvec),
+                  problem.jacobian(pvec, mapper=mapper)):
+            assert numpy.allclose(J, target, rtol=1e-6, atol=1e-6)
+            assert (problem.getp() == pvec).all()
+
+    x = numpy.linspace(-1, 2, 7)
+    def pars(name):
+        return [Parameter(v, name=name+k).range(-5, 5)
+                for k, v in zip('abc', (1, 2, 3))]
+
+    # Analytic derivatives for some parameters, numeric for the rest, or
+    # numeric for all of them
+    for deriv in (True, False):
+        a, b, c = pars('')
+        check(FitProblem(Quadratic(x, 2*x**2 - x, a, b, c, deriv=deriv)))
+
+    # Models sharing a parameter and tied through an expression, so the
+    # partial update must recompute both models for the shared parameters
+    a1, b1, c1 = pars('M1 ')
+    a2, _, _ = pars('M2 ')
+    M1 = Quadratic(x, x**2, a1, b1, c1)
+    M2 = Quadratic(x, 3*x + 1, a2, b1, c1*2 + 1, deriv=False)
+    M3 = Quadratic(x, x, a2, b1, c1*2 + 1)
+    check(MultiFitProblem([M1, M2, M3], weights=[1, 2, 0.5]))
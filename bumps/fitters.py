@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 from copy import deepcopy
@@ -8,6 +9,7 @@ from . import monitor, parameter
 from .history import History
 from . import initpop
 from .dream import MCMCModel
+from .fitproblem import instrument
 
 
 class ConsoleMonitor(monitor.TimedUpdate):
@@ -98,6 +100,28 @@ class FitBase(object):
 
 
 class MultiStart(FitBase):
+    """
+    Run the fitter repeatedly from random starting points, keeping the best.
+
+    Options are passed through to the underlying fitter, except for:
+
+    *starts* is the number of fits to perform.
+
+    *keep_best* starts each fit from where the previous fit ended rather
+    than from a random point.  This is ignored when running in parallel.
+
+    *workers* is the number of processes to use.  With more than one
+    worker, the starts are farmed out to a process pool with each worker
+    holding its own copy of the problem.  The first start is from the
+    initial point and the rest are from random points.  The underlying
+    fitter evaluates its points directly rather than using the mapper,
+    so use this for fitters such as amoeba or newton which do not have
+    a population to evaluate in parallel.
+
+    *target* stops the fit once the best $\chi^2$ reaches the target value.
+
+    The monitors are updated with the best point so far after each start.
+    """
     name = "Multistart Monte Carlo"
     settings = [('starts', 100)]
 
@@ -105,17 +129,30 @@ class MultiStart(FitBase):
         self.fitter = fitter
         self.problem = fitter.problem
 
-    def solve(self, monitors=None, mapper=None, **options):
-        starts = options.pop('starts', 1)
+    def solve(self, monitors=None, abort_test=None, mapper=None, **options):
+        starts = max(options.pop('starts', 1), 1)
         reset = not options.pop('keep_best', True)
+        workers = options.pop('workers', 1)
+        target = options.pop('target', None)
+        if abort_test is None:
+            abort_test = lambda: False
+        if target is not None:
+            done = lambda f: f * 2 / self.problem.dof <= target
+        else:
+            done = lambda f: False
+        if workers > 1 and starts > 1:
+            return self._solve_parallel(monitors, abort_test, done,
+                                        starts, workers, options)
         f_best = numpy.inf
-        for _ in range(max(starts, 1)):
+        for _ in range(starts):
             print "round",_
             x, fx = self.fitter.solve(monitors=monitors, mapper=mapper,
-                                      **options)
+                                      abort_test=abort_test, **options)
             if fx < f_best:
                 x_best, f_best = x, fx
                 print x_best, fx
+            if abort_test() or done(f_best):
+                break
             if reset:
                 self.problem.randomize()
             elif 0:
@@ -126,6 +163,60 @@ class MultiStart(FitBase):
                 self.problem.setp(pop[0])
         return x_best, f_best
 
+    def _solve_parallel(self, monitors, abort_test, done,
+                        starts, workers, options):
+        import multiprocessing
+        update = MonitorRunner(problem=self.problem, monitors=monitors)
+        # Workers poll the shared stop flag as their abort test
+        stop = multiprocessing.RawValue('b', 0)
+        seeds = numpy.random.randint(2**31, size=starts)
+        pool = multiprocessing.Pool(workers, _MS_set_fitter,
+                                    (self.fitter, stop, options))
+        x_best, f_best = None, numpy.inf
+        try:
+            results = pool.imap_unordered(_MS_run_start, enumerate(seeds))
+            for k in range(starts):
+                while True:
+                    try:
+                        i, x, fx = results.next(timeout=0.2)
+                        break
+                    except multiprocessing.TimeoutError:
+                        if abort_test():
+                            stop.value = 1
+                if fx < f_best:
+                    x_best, f_best = x, fx
+                update(step=k+1, point=x_best, value=f_best,
+                       population_points=[x], population_values=[fx])
+                if stop.value or abort_test() or done(f_best):
+                    stop.value = 1
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        return x_best, f_best
+
+
+def _MS_set_fitter(fitter, stop, options):
+    global _fitter, _stop, _options, _x0
+    from .mapper import nice
+    nice()
+    _fitter, _stop, _options = fitter, stop, options
+    _x0 = fitter.problem.getp()
+def _MS_run_start(job):
+    """
+    Run one multistart fit, starting from the initial point for start 0
+    and from a random point otherwise.
+    """
+    start, seed = job
+    numpy.random.seed(seed)
+    if start == 0:
+        _fitter.problem.setp(_x0)
+    else:
+        _fitter.problem.randomize()
+    x, fx = _fitter.solve(monitors=[], abort_test=lambda: _stop.value != 0,
+                          mapper=None, **dict(_options))
+    return start, x, fx
+
 
 class DEFit(FitBase):
     name = "Differential Evolution"
@@ -148,13 +239,19 @@ class DEFit(FitBase):
         minimize = Minimizer(strategy=strategy, problem=self.problem,
                              monitors=monitors,
                              failure=Steps(options['steps']))
-        x = minimize(mapper=_mapper, abort_test=abort_test)
+        # Run as a steady state fit if given an asynchronous mapper
+        async_mapper = options.get('async_mapper', None)
+        if async_mapper is not None:
+            x = minimize.minimize_async(mapper=async_mapper,
+                                        abort_test=abort_test)
+        else:
+            x = minimize(mapper=_mapper, abort_test=abort_test)
         return x, minimize.history.value[0]
 
 
 class BFGSFit(FitBase):
     name = "Quasi-Newton BFGS"
-    settings = [('steps', 3000), ('starts', 100)]
+    settings = [('steps', 3000), ('starts', 100), ('central', 0)]
 
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
@@ -166,6 +263,8 @@ class BFGSFit(FitBase):
                              monitor=self._monitor,
                              abort_test=abort_test,
                              itnlimit=options['steps'],
+                             mapper=mapper,
+                             central=bool(options['central']),
                              )
         code = result['status']
         print "%d: %s" % (code, STATUS[code])
@@ -247,11 +346,10 @@ class RLFit(FitBase):
 class PTFit(FitBase):
     name = "Parallel Tempering"
     settings = [('steps', 1000), ('nT', 25), ('CR', 0.9),
-                ('burn', 4000), ('Tmin', 0.1), ('Tmax', 10)]
+                ('burn', 4000), ('Tmin', 0.1), ('Tmax', 10), ('replicas', 1)]
 
     def solve(self, monitors=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
-        # TODO: no mapper??
         from partemp import parallel_tempering
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
@@ -266,7 +364,9 @@ class PTFit(FitBase):
                                     CR=options['CR'],
                                     steps=options['steps'],
                                     burn=options['burn'],
-                                    monitor=self._monitor)
+                                    monitor=self._monitor,
+                                    mapper=mapper,
+                                    replicas=options['replicas'])
         return history.best_point, history.best
 
     def _monitor(self, step, x, fx, P, E):
@@ -281,7 +381,6 @@ class AmoebaFit(FitBase):
 
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
-        # TODO: no mapper??
         from simplex import simplex
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
@@ -291,7 +390,9 @@ class AmoebaFit(FitBase):
                          abort_test=abort_test,
                          update_handler=self._monitor,
                          maxiter=options['steps'],
-                         radius=options['radius'])
+                         radius=options['radius'],
+                         mapper=mapper,
+                         speculative=options.get('speculative', False))
         # Let simplex propose the starting point for the next amoeba
         # fit in a multistart amoeba context.  If the best is always
         # used, the fit can get stuck in a local minimum.
@@ -339,7 +440,7 @@ class DreamModel(MCMCModel):
         self.bounds = self.problem.bounds()
         self.labels = self.problem.labels()
 
-        self.mapper = mapper if mapper else lambda p: map(self.nllf, p)
+        self.mapper = mapper if mapper else self.problem.nllf_batch
 
     def log_density(self, x):
         return -self.nllf(x)
@@ -363,6 +464,7 @@ class DreamFit(FitBase):
     def __init__(self, problem):
         self.dream_model = DreamModel(problem)
         self.state = None
+        self._checkpoint = None
 
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
@@ -382,6 +484,16 @@ class DreamFit(FitBase):
                               thinning=options['thin'],
                               monitor=self._monitor,
                               DE_noise=1e-6)
+        if options.get('checkpoint', None):
+            sampler.checkpoint = options['checkpoint']
+            sampler.checkpoint_interval = options.get('checkpoint_interval',
+                                                      sampler.checkpoint_interval)
+        if options.get('history_file', None):
+            sampler.history_file = options['history_file']
+        if self._checkpoint:
+            dream.core.load_checkpoint(sampler, self._checkpoint)
+            self.state = sampler.state
+            self._checkpoint = None
 
         self.state = sampler.sample(state=self.state, abort_test=abort_test)
         self.state.mark_outliers()
@@ -408,6 +520,15 @@ class DreamFit(FitBase):
 
     def load(self, input_path):
         from . import dream
+        # Prefer the checkpoint if it is more recent than the saved state,
+        # e.g., if the fit was killed before it completed.
+        checkpoint = input_path + "-checkpoint"
+        if (os.path.exists(checkpoint + "-resume.npz")
+            and _mtime(checkpoint + "-resume.npz")
+                > _mtime(input_path + "-state.json")):
+            print "resuming from checkpoint", checkpoint
+            self._checkpoint = checkpoint
+            return
         print "loading saved state (this might take awhile) ..."
         self.state = dream.state.load_state(input_path, report=100)
 
@@ -435,62 +556,167 @@ class DreamFit(FitBase):
 
 
 class Resampler(FitBase):
-    #TODO: why isn't cli.resynth using this?
+    """
+    Fit the problem, then refit it repeatedly against resynthesized data.
+
+    The options are passed through to the underlying fitter, except for
+    *starts*, *restart*, *workers*, *seed* and *filename*, which control
+    the resampling as described in :func:`resample`.  The resampled
+    points are available as *points* after the fit.
+    """
     def __init__(self, fitter):
-        raise NotImplementedError
         self.fitter = fitter
+        self.problem = fitter.problem
 
-    def solve(self, **options):
-        starts = options.pop('starts', 1)
+    def solve(self, monitors=None, abort_test=None, mapper=None, **options):
+        samples = options.pop('starts', 1)
         restart = options.pop('restart', False)
-        x, fx = self.fitter.solve(**options)
-        points = _resampler(self.fitter, x, samples=starts,
-                            restart=restart, **options)
-        self.points = points  # save points for later plotting
+        workers = options.pop('workers', 1)
+        seed = options.pop('seed', None)
+        filename = options.pop('filename', None)
+        if abort_test is None:
+            abort_test = lambda: False
+        x, fx = self.fitter.solve(monitors=monitors, abort_test=abort_test,
+                                  mapper=mapper, **options)
+        self.points = resample(self.fitter, x, samples=samples,
+                               restart=restart, workers=workers, seed=seed,
+                               filename=filename, abort_test=abort_test,
+                               **options)
         return x, fx
 
 
-def _resampler(fitter, xinit, samples=100, restart=False, **options):
+def resample(fitter, xinit, samples=100, restart=False, workers=1,
+             seed=None, filename=None, abort_test=None, mapper=None,
+             **options):
     """
-    Refit the result multiple times with resynthesized data, building
-    up an array in Result.samples which contains the best fit to the
-    resynthesized data.  *samples* is the number of samples to generate.
-    *fitter* is the (local) optimizer to use. **kw are the parameters
-    for the optimizer.
+    Refit the result multiple times with resynthesized data, returning
+    an array with one row of (nllf, x) for each completed sample.
+
+    *fitter* is the (local) optimizer to use and *xinit* is the starting
+    point for each refit, or a random point if *restart* is True.  The
+    remaining options are passed to the fitter.
+
+    *samples* is the number of samples to generate.  Sample *i* uses random
+    seed *seed+i* for both data synthesis and fitting, so the samples are
+    reproducible regardless of the order in which they complete.  If *seed*
+    is None, a seed is drawn from the numpy random number generator.
+
+    *workers* is the number of processes to use.  Each worker holds its own
+    copy of the problem and synthesizes the data for its samples, so only
+    the seeds and the fitted points are passed between processes.
+    With a single worker, the samples are fit in this process and *mapper*
+    is passed to the fitter to evaluate populations of points.  The mapper
+    must evaluate the problem in this process, since the synthesized data
+    exists only here; mappers whose workers hold their own copy of the
+    problem, such as MPI or AMQP, would fit the original data.
+
+    *filename* is a .npy array file of shape samples x (Nvar+2) holding the
+    seed, nllf and point for each sample, with nllf set to NaN for samples
+    which are not yet complete.  Rows are written as the samples complete,
+    so the file can be monitored while the fit runs.  If the file already
+    exists with the same shape, the completed samples are kept and the
+    remaining samples are fit using the seeds stored in the file.
+
+    The fit stops early if *abort_test()* returns True or on keyboard
+    interrupt, and the samples completed so far are returned.
     """
-    x = xinit
-    points = []
+    from numpy.lib.format import open_memmap
+    if abort_test is None:
+        abort_test = lambda: False
+    shape = (samples, len(xinit)+2)
+    result = None
+    if filename is not None and os.path.exists(filename):
+        result = numpy.load(filename, mmap_mode='r+')
+        if result.shape != shape:
+            result = None
+    if result is None:
+        if seed is None:
+            seed = numpy.random.randint(2**31 - samples)
+        if filename is not None:
+            result = open_memmap(filename, mode='w+', dtype='d', shape=shape)
+        else:
+            result = numpy.empty(shape, 'd')
+        result[:, 0] = seed + numpy.arange(samples)
+        result[:, 1:] = numpy.NaN
+    jobs = [(i, int(result[i, 0]))
+            for i in range(samples) if numpy.isnan(result[i, 1])]
+
+    pool = None
     try:  # TODO: some solvers already catch KeyboardInterrupt
-        for _ in range(samples):
-            #print "== resynth %d of %d" % (i, samples)
-            fitter.problem.resynth_data()
-            if restart:
-                fitter.problem.randomize()
-            else:
-                fitter.problem.setp(x)
-            x, fx = fitter.solve(**options)
-            points.append(numpy.hstack((fx, x)))
-            #print self.problem.summarize()
-            #print "[chisq=%g]" % (nllf*2/self.problem.dof)
+        if workers > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers, _RS_set_fitter,
+                                        (fitter, xinit, restart, options))
+            fits = pool.imap_unordered(_RS_run_sample, jobs)
+        else:
+            fits = (_resample_one(fitter, xinit, restart, options, job,
+                                  mapper=mapper)
+                    for job in jobs)
+        for i, fx, x in fits:
+            result[i, 1] = fx
+            result[i, 2:] = x
+            if filename is not None:
+                result.flush()
+            #print "[chisq=%g]" % (fx*2/fitter.problem.dof)
+            if abort_test():
+                break
     except KeyboardInterrupt:
         pass
     finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
         # Restore the state of the problem
         fitter.problem.restore_data()
         fitter.problem.setp(xinit)
         fitter.problem.model_update()
-    return points
+    return numpy.array(result[~numpy.isnan(result[:, 1]), 1:])
+
+
+def _resample_one(fitter, xinit, restart, options, job, mapper=None):
+    """
+    Fit one resynthesized data set, returning (sample, nllf, x).
+    """
+    i, seed = job
+    numpy.random.seed(seed)
+    fitter.problem.resynth_data()
+    try:
+        if restart:
+            fitter.problem.randomize()
+        else:
+            fitter.problem.setp(xinit)
+        x, fx = fitter.solve(monitors=[], abort_test=lambda: False,
+                             mapper=mapper, **dict(options))
+    finally:
+        fitter.problem.restore_data()
+    return i, fx, x
+def _RS_set_fitter(fitter, xinit, restart, options):
+    global _rs_args
+    from .mapper import nice
+    nice()
+    _rs_args = fitter, xinit, restart, options
+def _RS_run_sample(job):
+    return _resample_one(*(_rs_args + (job,)))
 
 
 class FitDriver(object):
+    """
+    Run a fit.
+
+    If *timers* is a :class:`monitor.Timers` object, the time spent in the
+    problem methods, in the mapper and in the fitter itself is accumulated
+    there while the fit runs.  Use :class:`monitor.TimingMonitor` to report
+    it as the fit progresses.
+    """
     def __init__(self, fitclass=None, problem=None, monitors=None, abort_test=None,
-                 mapper=None, **options):
+                 mapper=None, timers=None, **options):
         self.fitclass = fitclass
         self.problem = problem
         self.options = options
         self.monitors = monitors
         self.abort_test = abort_test
-        self.mapper = mapper if mapper else lambda p: map(problem.nllf, p)
+        self.mapper = mapper if mapper else lambda p: problem.nllf_batch(p)
+        self.timers = timers
 
     def fit(self, resume=None):
         fitter = self.fitclass(self.problem)
@@ -499,11 +725,23 @@ class FitDriver(object):
         starts = self.options.get('starts', 1)
         if starts > 1:
             fitter = MultiStart(fitter)
+        mapper = self.mapper
+        cache = getattr(self.problem, 'nllf_cache', None)
+        if cache is not None:
+            mapper = cache.wrap_mapper(mapper)
+        if self.timers is not None:
+            self.timers.reset()
+            instrument(self.problem, self.timers)
+            mapper = self.timers.timed('mapper', mapper)
         t0 = time.clock()
-        x, fx = fitter.solve(monitors=self.monitors,
-                             abort_test=self.abort_test,
-                             mapper=self.mapper,
-                             **self.options)
+        try:
+            x, fx = fitter.solve(monitors=self.monitors,
+                                 abort_test=self.abort_test,
+                                 mapper=mapper,
+                                 **self.options)
+        finally:
+            if self.timers is not None:
+                instrument(self.problem, None)
         self.fitter = fitter
         self.time = time.clock() - t0
         self.result = x, fx
@@ -538,6 +776,10 @@ class FitDriver(object):
             self.fitter.plot(output_path=output_path)
 
 
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else 0
+
+
 def _fill_defaults(options, settings):
     for field, value in settings:
         if field not in options:
@@ -558,7 +800,9 @@ class FitOptions(object):
         nT     = ("# Temperatures",  "int"),
         Tmin   = ("Min Temperature", "float"),
         Tmax   = ("Max Temperature", "float"),
+        replicas = ("Replicas",      "int"),
         radius = ("Simplex Radius",  "float"),
+        central = ("Central Differences", "int"),
         )
 
     def __init__(self, fitclass):
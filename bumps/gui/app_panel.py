@@ -404,7 +404,7 @@ class AppPanel(wx.Panel):
         OpenFitOptions()
 
     def OnFitStart(self, event):
-        self.uncertainty_state = False
+        self.uncertainty_state = None
         if self.fit_thread:
             self.sb.SetStatusText("Error: Fit already running")
             return
@@ -470,7 +470,15 @@ class AppPanel(wx.Panel):
         elif event.message == 'convergence_update':
             self.view['convergence'].OnFitProgress(event)
         elif event.message in ('uncertainty_update', 'uncertainty_final'):
-            self.uncertainty_state = event.uncertainty_state
+            # Bring the mirror of the DREAM state up to date and share it
+            # with the views.  The final event replaces the mirror with the
+            # completed state.
+            delta = event.uncertainty_delta
+            if delta is None:
+                self.uncertainty_state = event.uncertainty_state
+            else:
+                self.uncertainty_state = delta.apply(self.uncertainty_state)
+                event.uncertainty_state = self.uncertainty_state
             self.view['uncertainty'].OnFitProgress(event)
             self.view['correlation'].OnFitProgress(event)
             self.view['trace'].OnFitProgress(event)
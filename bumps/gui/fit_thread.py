@@ -77,6 +77,10 @@ class GUIMonitor(monitor.Monitor):
 # Horrible hack: we put the DREAM state in the fitter object the first time
 # back from the DREAM monitor; if our fitter object contains dream_state,
 # then we will send the dream_update notifications periodically.
+#
+# Rather than copying the entire state for each update, the monitor sends
+# the generations added since the last update, and the GUI thread applies
+# them to its own mirror of the state (see dream.state.StateSubscription).
 class DreamMonitor(monitor.Monitor):
     def __init__(self, win, problem, message, fitter, rate=None):
         self.time = 0
@@ -85,31 +89,37 @@ class DreamMonitor(monitor.Monitor):
         self.problem = problem
         self.fitter = fitter
         self.message = message
-        self.uncertainty_state = None
+        self.subscription = None
     def config_history(self, history):
         history.requires(time=1)
     def __call__(self, history):
         try:
-            self.uncertainty_state = history.uncertainty_state
-            if history.time[0] >= self.time+self.rate:
-                # Gack! holding on to state for final
-                evt = FitProgressEvent(problem=self.problem,
-                                       message="uncertainty_update",
-                                       uncertainty_state = deepcopy(self.uncertainty_state))
-                wx.PostEvent(self.win, evt)
-                self.time = history.time[0]
+            state = history.uncertainty_state
         except AttributeError:
-            self.uncertainty_state = None
-            pass
+            self.subscription = None
+            return
+        if self.subscription is None or self.subscription.state is not state:
+            self.subscription = state.subscribe()
+        if history.time[0] >= self.time+self.rate:
+            evt = FitProgressEvent(problem=self.problem,
+                                   message="uncertainty_update",
+                                   uncertainty_delta=self.subscription.delta())
+            wx.PostEvent(self.win, evt)
+            self.time = history.time[0]
 
     def final(self):
         """
         Close out the monitor
         """
-        if self.uncertainty_state:
+        if self.subscription is not None:
+            # Sampling is complete, so hand the state itself to the GUI
+            # rather than copying it.  It includes the changes made in
+            # place by outlier marking and keep_best.
             evt = FitProgressEvent(problem=self.problem,
                                    message="uncertainty_final",
-                                   uncertainty_state = deepcopy(self.uncertainty_state))
+                                   uncertainty_delta=None,
+                                   uncertainty_state=self.subscription.state)
+            self.subscription = None
             wx.PostEvent(self.win, evt)
 
 #==============================================================================
@@ -5,6 +5,17 @@ from .. import errplot
 from .plot_view import PlotView
 from .signal import log_message
 
+def _has_new_samples(event):
+    """
+    Return True if the state update in *event* changes the samples.  The
+    plot state is a mirror which is updated in place, so the plot need
+    not be redrawn if no samples have been added.  The final update
+    replaces the mirror with the completed state, so it is always drawn.
+    """
+    delta = event.uncertainty_delta
+    return (delta is None or delta.reset or delta.samples > 0
+            or delta.outliers)
+
 class UncertaintyView(PlotView):
     title = "Uncertainty"
     def plot(self):
@@ -20,7 +31,7 @@ class UncertaintyView(PlotView):
     def OnFitProgress(self, event):
         if event.problem != self.model: return
         self.plot_state = event.uncertainty_state
-        self.plot()
+        if _has_new_samples(event): self.plot()
 
 class CorrelationView(PlotView):
     title = "Correlations"
@@ -36,7 +47,7 @@ class CorrelationView(PlotView):
     def OnFitProgress(self, event):
         if event.problem != self.model: return
         self.plot_state = event.uncertainty_state
-        self.plot()
+        if _has_new_samples(event): self.plot()
 
 
 class TraceView(PlotView):
@@ -51,7 +62,7 @@ class TraceView(PlotView):
     def OnFitProgress(self, event):
         if event.problem != self.model: return
         self.plot_state = event.uncertainty_state
-        self.plot()
+        if _has_new_samples(event): self.plot()
 
 class ModelErrorView(PlotView):
     title = "Model Uncertainty"
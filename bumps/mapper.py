@@ -37,22 +37,67 @@ class SerialMapper(object):
         pass
     @staticmethod
     def start_mapper(problem, modelargs):
-        return lambda points: map(problem.nllf, points)
+        return lambda points: problem.nllf_batch(points)
+    @staticmethod
+    def start_residuals_mapper(problem, modelargs):
+        return lambda points: problem.residuals_batch(points)
     @staticmethod
     def stop_mapper(mapper):
         pass
 
-def _MP_set_problem(problem):
-    global _problem
+def _MP_set_problem(problem, points, values):
+    global _problem, _points, _values
     nice()
     _problem = problem
-def _MP_run_problem(point):
-    global _problem
-    return _problem.nllf(point)
-    
+    _points, _values = points, values
+def _MP_run_range(job):
+    """
+    Evaluate points[start:stop] from the shared population buffer, storing
+    the results in the shared value buffer.
+    """
+    import numpy
+    start, stop, nvars = job
+    points = numpy.frombuffer(_points, 'd')[start*nvars:stop*nvars]
+    values = numpy.frombuffer(_values, 'd')
+    values[start:stop] = _problem.nllf_batch(points.reshape(stop-start, nvars))
+def _MP_run_point(point):
+    """
+    Return the nllf for a single point.
+
+    Errors are returned rather than raised since apply_async never calls
+    the callback for a task which fails.
+    """
+    try:
+        return _problem.nllf(point)
+    except Exception, exc:
+        return exc
+def _MP_run_residuals(job):
+    """
+    Return the residuals for points[start:stop] from the shared population
+    buffer.
+    """
+    import numpy
+    start, stop, nvars = job
+    points = numpy.frombuffer(_points, 'd')[start*nvars:stop*nvars]
+    return _problem.residuals_batch(points.reshape(stop-start, nvars))
+
 class MPMapper(object):
+    """
+    Multiprocessing mapper.
+
+    The worker pool is kept between fits, and is restarted only when the
+    problem changes or when the population no longer fits in the shared
+    buffers.  Each generation is written to a shared memory buffer and
+    the workers are sent index ranges into that buffer, one range per
+    CPU, with the nllf values returned through a second shared buffer.
+    This avoids pickling the individual points, which is the main cost
+    of mapping cheap models over large populations.
+    """
     pool = None
-    
+    problem = None
+    cpus = 0
+    _points = _values = None
+
     @staticmethod
     def start_worker(problem):
         pass
@@ -62,15 +107,152 @@ class MPMapper(object):
         import multiprocessing
         if cpus is None:
             cpus = multiprocessing.cpu_count()
-        if MPMapper.pool is None:
-            MPMapper.pool = multiprocessing.Pool(cpus,_MP_set_problem,(problem,))
-        mapper = lambda points: MPMapper.pool.map(_MP_run_problem, points)
-        return mapper
-        
+        return lambda points: MPMapper._map(problem, points, cpus)
+
+    @staticmethod
+    def start_residuals_mapper(problem, modelargs, cpus=None):
+        """
+        Return a mapper which computes the residuals for each point, using
+        the same worker pool as the nllf mapper.
+        """
+        import multiprocessing
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+        return lambda points: MPMapper._map_residuals(problem, points, cpus)
+
+    @staticmethod
+    def start_async_mapper(problem, modelargs, cpus=None):
+        """
+        Return an asynchronous mapper for steady state fits, using the
+        same worker pool as the nllf mapper.  See :mod:`mystic.solver`
+        for the interface.
+        """
+        import multiprocessing
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+        return _MPAsyncMapper(problem, cpus)
+
     @staticmethod
     def stop_mapper(mapper):
         pass
 
+    @staticmethod
+    def _start_pool(problem, npoints, nvars, cpus):
+        import multiprocessing
+        import numpy
+        if MPMapper.pool is not None:
+            MPMapper.pool.terminate()
+            MPMapper.pool = None
+        points = multiprocessing.RawArray('d', npoints*nvars)
+        values = multiprocessing.RawArray('d', npoints)
+        MPMapper.pool = multiprocessing.Pool(cpus, _MP_set_problem,
+                                             (problem, points, values))
+        MPMapper.problem, MPMapper.cpus = problem, cpus
+        # Keep the shared buffers alive along with numpy views of them
+        MPMapper._shared = points, values
+        MPMapper._points = numpy.frombuffer(points, 'd').reshape(npoints, nvars)
+        MPMapper._values = numpy.frombuffer(values, 'd')
+
+    @staticmethod
+    def _map(problem, points, cpus):
+        import numpy
+        points = numpy.asarray(points, 'd')
+        if len(points) == 0:
+            return numpy.empty(0, 'd')
+        jobs = MPMapper._send(problem, points, cpus)
+        MPMapper.pool.map(_MP_run_range, jobs)
+        return MPMapper._values[:len(points)].copy()
+
+    @staticmethod
+    def _map_residuals(problem, points, cpus):
+        import numpy
+        points = numpy.asarray(points, 'd')
+        jobs = MPMapper._send(problem, points, cpus)
+        return numpy.vstack(MPMapper.pool.map(_MP_run_residuals, jobs))
+
+    @staticmethod
+    def _send(problem, points, cpus):
+        """
+        Copy *points* to the shared buffer, restarting the pool if needed,
+        and return one job for each CPU.
+        """
+        import numpy
+        npoints, nvars = points.shape
+        if (MPMapper.pool is None
+            or MPMapper.problem is not problem
+            or MPMapper.cpus != cpus
+            or MPMapper._points.shape[1] != nvars
+            or MPMapper._points.shape[0] < npoints):
+            MPMapper._start_pool(problem, npoints, nvars, cpus)
+        MPMapper._points[:npoints] = points
+        edges = numpy.linspace(0, npoints, min(cpus, npoints)+1).astype('i')
+        jobs = [(int(lo), int(hi), nvars)
+                for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+        return jobs
+
+
+class _MPAsyncMapper(object):
+    """
+    Send single points to the worker pool, collecting the results in the
+    order they complete.
+
+    Results for points submitted before the last call to :meth:`cancel`
+    are dropped when they arrive.  An error raised while evaluating a
+    point is raised again by :meth:`wait`.
+    """
+    def __init__(self, problem, cpus):
+        import Queue
+        import threading
+        self.problem, self.workers = problem, cpus
+        self._done = Queue.Queue()
+        self._lock = threading.Lock()
+        self._batch = 0
+
+    def submit(self, tag, point):
+        import numpy
+        point = numpy.asarray(point, 'd')
+        if (MPMapper.pool is None
+            or MPMapper.problem is not self.problem
+            or MPMapper.cpus != self.workers
+            or MPMapper._points.shape[1] != len(point)):
+            MPMapper._start_pool(self.problem, self.workers, len(point),
+                                 self.workers)
+        batch = self._batch
+        def callback(value):
+            # Called from the pool result thread
+            with self._lock:
+                if batch == self._batch:
+                    self._done.put((tag, point, value))
+        MPMapper.pool.apply_async(_MP_run_point, (point,), callback=callback)
+
+    def wait(self):
+        import Queue
+        # Poll so that KeyboardInterrupt is delivered while waiting
+        while True:
+            try:
+                done = [self._done.get(timeout=0.2)]
+                break
+            except Queue.Empty:
+                pass
+        while True:
+            try:
+                done.append(self._done.get_nowait())
+            except Queue.Empty:
+                break
+        for _, _, value in done:
+            if isinstance(value, Exception):
+                raise value
+        return done
+
+    def cancel(self):
+        import Queue
+        with self._lock:
+            self._batch += 1
+            while True:
+                try:
+                    self._done.get_nowait()
+                except Queue.Empty:
+                    break
 
 def _MPI_set_problem(comm, problem, root=0):
     global _problem
@@ -95,7 +277,7 @@ def _MPI_map(comm, points, root=0):
                   root=root)
 
     # Evaluate models assigned to each processor
-    partial_result = numpy.array([_MPI_run_problem(pi) for pi in part],dtype='d')
+    partial_result = numpy.asarray(_problem.nllf_batch(part),dtype='d')
 
     # Collect results
     result = numpy.empty(npoints,dtype='d') if comm.rank==root else None
@@ -5,6 +5,8 @@ Process monitors
 Process monitors accept a history object each cycle and
 perform some sort of work on it.
 """
+import time
+
 from numpy import inf
 
 class Monitor(object):
@@ -96,3 +98,92 @@ class TimedUpdate(Monitor):
             self.improved = False
             self.improvement_time = t
             self.show_improvement(history)
+
+
+class Timers(object):
+    """
+    Accumulate wall clock time and call counts for the phases of a fit.
+
+    Time is exclusive: when a timed phase calls another timed phase, the
+    time in the inner phase is charged only to the inner phase.  The wall
+    clock time since the timers were reset which is not charged to any
+    phase is reported as *optimizer*.  This is the time the fitter spends
+    generating proposals and doing its own bookkeeping.
+
+    Use *timed(name, fn)* to wrap a function so that its calls are charged
+    to phase *name*.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.time = {}
+        self.calls = {}
+        self._stack = []
+        self._start = time.time()
+
+    def start(self, name):
+        now = time.time()
+        if self._stack:
+            self._charge(self._stack[-1], now)
+        self._stack.append([name, now])
+
+    def stop(self):
+        now = time.time()
+        phase = self._stack.pop()
+        self._charge(phase, now)
+        self.calls[phase[0]] = self.calls.get(phase[0], 0) + 1
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def _charge(self, phase, now):
+        name, mark = phase
+        self.time[name] = self.time.get(name, 0.) + (now - mark)
+
+    def timed(self, name, fn):
+        def timed_fn(*args, **kw):
+            self.start(name)
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.stop()
+        return timed_fn
+
+    def elapsed(self):
+        return time.time() - self._start
+
+    def summary(self):
+        """
+        Return a table of calls and time for each phase.
+        """
+        wall = max(self.elapsed(), 1e-9)
+        optimizer = wall - sum(self.time.values())
+        lines = ["%-18s %9s %10s %7s %10s"
+                 % ("phase", "calls", "time(s)", "%wall", "ms/call")]
+        for name in sorted(self.time, key=lambda k: -self.time[k]):
+            t, n = self.time[name], self.calls.get(name, 0)
+            lines.append("%-18s %9d %10.3f %6.1f%% %10.4f"
+                         % (name, n, t, 100*t/wall, 1000*t/max(n, 1)))
+        lines.append("%-18s %9s %10.3f %6.1f%%"
+                     % ("optimizer", "", optimizer, 100*optimizer/wall))
+        lines.append("%-18s %9s %10.3f" % ("wall", "", wall))
+        return "\n".join(lines)
+
+
+class TimingMonitor(Monitor):
+    """
+    Print the phase timing summary from *timers* every *progress* seconds.
+    """
+    def __init__(self, timers, progress=300):
+        self.timers = timers
+        self.progress_delta = progress
+        self.progress_time = 0
+
+    def config_history(self, history):
+        history.requires(time=1)
+
+    def __call__(self, history):
+        t = history.time[0]
+        if t > self.progress_time + self.progress_delta:
+            self.progress_time = t
+            print self.timers.summary()
@@ -60,8 +60,27 @@ For example:
     >>> h.accumulate(step=1)
     >>> print h.step[0]
     2
+
+Scalar values are stored as given.  Numeric arrays, such as points and
+populations, are copied into storage allocated when the first value
+arrives.  A trace therefore returns an array even if it was given a list,
+with its type widened to hold every value stored so far.  The arrays are
+views which will be overwritten once enough new values have been stored,
+so copy them if they need to be kept:
+
+    >>> h = History(point=2)
+    >>> h.update(point=[1,2])
+    >>> first = h.point[0]
+    >>> print first
+    [1 2]
+    >>> h.update(point=[3,4])
+    >>> h.update(point=[5,6])
+    >>> print first, h.point[1]
+    [5 6] [3 4]
 """
 
+import numpy
+
 # Design questions:
 # 1. Can optimizer function evaluators add traces?  Can they use traces?
 # 2. Do we want to support a skip option on traces, so that only every nth
@@ -74,6 +93,7 @@ class History(object):
     Provided traces can be specified as key word arguments, name=length.
     """
     def __init__(self, **kw):
+        self._tracemap = {}
         self.provides(**kw)
 
     def provides(self, **kw):
@@ -92,6 +112,7 @@ class History(object):
             else:
                 mon = self._new_trace(keep=v, name=k)
                 setattr(self, k, mon)
+                self._tracemap[k] = mon
 
     def requires(self, **kw):
         """
@@ -110,11 +131,13 @@ class History(object):
         Extend the given traces with the provided values.  The traced
         value will be the old value plus the new value.
         """
+        traces = self._tracemap
         for k,v in kw.items():
             try:
-                getattr(self,k).accumulate(v)
-            except AttributeError:
+                trace = traces[k]
+            except KeyError:
                 raise AttributeError(k+" is not being traced")
+            trace.accumulate(v)
 
     def update(self, **kw):
         """
@@ -122,11 +145,13 @@ class History(object):
         values are independent.  Use accumulate if you want to add the
         new value to the previous value in the trace.
         """
+        traces = self._tracemap
         for k,v in kw.items():
             try:
-                getattr(self,k).put(v)
-            except AttributeError:
+                trace = traces[k]
+            except KeyError:
                 raise AttributeError(k+" is not being traced")
+            trace.put(v)
 
     def _new_trace(self, keep=None, name=None):
         """
@@ -164,47 +189,140 @@ class Trace(object):
     trace.accumulate(value) adds value to the previous value before storing
     """
     # Implementation note:
-    # Traces are stored in reverse order because append is faster than insert.
-    # This detail is hidden from the caller since __getitem__ returns the
-    # appropriate value.
+    # Traces are stored in a ring buffer with _head indexing the most recent
+    # item.  Numeric arrays of a fixed shape are copied into a preallocated
+    # array of shape (keep,)+value.shape so that storing a value does not
+    # allocate memory.  The array is reallocated if a value needs a wider
+    # type.  Scalars, values which are not numeric, and values which change
+    # shape from one step to the next are stored by reference in a list.
     def __init__(self, keep=1, name="trace"):
         self.keep = keep
-        self._storage = []
         self.name = name
+        self._storage = None
+        self._head = -1
+        self._count = 0
     def requires(self, n):
         """
         Set the trace length to be at least n.
         """
         if n > self.keep:
+            if self._storage is not None:
+                self._resize(n)
             self.keep = n
     def accumulate(self, value):
         if self.keep < 1: return
-        try:
-            value = self._storage[-1] + value
-        except IndexError:
-            pass # Value is 0 + value => 0
+        if self._count > 0:
+            value = self[0] + value
+        # else value is 0 + value => value
         self.put(value)
     def put(self, value):
         """
-        Add an item to the trace, shifting off from the beginning
-        when the trace is full.
+        Add an item to the trace, replacing the oldest item when the
+        trace is full.
         """
         if self.keep < 1: return
-        if len(self._storage) == self.keep:
-            self._storage = self._storage[1:]
-        self._storage.append(value)
+        storage = self._storage
+        if isinstance(storage, numpy.ndarray):
+            value = numpy.asarray(value)
+            if (value.shape != storage.shape[1:]
+                    or not numpy.can_cast(value.dtype, storage.dtype)):
+                self._retype(value)
+        elif storage is None:
+            self._allocate(value)
+        self._head = (self._head + 1) % self.keep
+        self._storage[self._head] = value
+        if self._count < self.keep:
+            self._count += 1
+    def _allocate(self, value):
+        value = numpy.asarray(value)
+        if value.ndim > 0 and value.dtype.kind in 'biufc':
+            self._storage = numpy.empty((self.keep,)+value.shape, value.dtype)
+        else:
+            self._storage = [None]*self.keep
+    def _retype(self, value):
+        """
+        Convert the storage so that it can hold *value*.
+        """
+        old = self._storage
+        if value.shape == old.shape[1:] and value.dtype.kind in 'biufc':
+            self._storage = old.astype(numpy.promote_types(old.dtype, value.dtype))
+        else:
+            self._storage = [old[i] for i in range(self.keep)]
+    def _resize(self, n):
+        """
+        Copy the stored items to new storage of length *n*.
+        """
+        items = [self._storage[(self._head-i) % self.keep]
+                 for i in reversed(range(self._count))]
+        old = self._storage
+        if isinstance(old, numpy.ndarray):
+            self._storage = numpy.empty((n,)+old.shape[1:], old.dtype)
+        else:
+            self._storage = [None]*n
+        for i,v in enumerate(items):
+            self._storage[i] = v
+        self._head = self._count - 1
     def __len__(self):
-        return len(self._storage)
+        return self._count
     def __getitem__(self, key):
         if key < 0:
             raise IndexError(self.name
                              + " can only be accessed from the beginning")
-        try:
-            return self._storage[-key-1]
-        except IndexError:
+        if key >= self._count:
             raise IndexError(self.name + " has not accumulated enough history")
+        return self._storage[(self._head-key) % self.keep]
     def __setitem__(self, key, value):
         raise TypeError("cannot write directly to a trace; use put instead")
     def __str__(self):
         return ("Trace " + self.name + ": "
-                + ", ".join([str(k) for k in reversed(self._storage)]))
+                + ", ".join([str(self[k]) for k in range(len(self))]))
+
+
+def test():
+    # Scalars keep their type as the ring buffer wraps
+    trace = Trace(keep=3, name="value")
+    for v in [1, 2.5, numpy.float32(3), 4, 5]:
+        trace.put(v)
+    assert [trace[i] for i in range(3)] == [5, 4, 3]
+    assert [type(trace[i]) for i in range(3)] == [int, int, numpy.float32]
+
+    # Arrays are copied, and wrap around in order
+    trace = Trace(keep=3, name="point")
+    point = numpy.array([0, 0])
+    for k in range(5):
+        point[:] = k
+        trace.put(point)
+    assert [trace[i].tolist() for i in range(3)] == [[4,4], [3,3], [2,2]]
+
+    # Growing a wrapped trace keeps the most recent items first
+    trace.requires(5)
+    assert len(trace) == 3 and trace.keep == 5
+    trace.put([5, 5])
+    trace.put([6, 6])
+    trace.put([7, 7])
+    assert [trace[i].tolist() for i in range(5)] \
+        == [[7,7], [6,6], [5,5], [4,4], [3,3]]
+
+    # Values needing a wider type widen the storage, and values with a
+    # different shape switch it to a list
+    trace.put([8.5, 8])
+    assert trace._storage.dtype == numpy.dtype('d')
+    assert [trace[i].tolist() for i in range(3)] == [[8.5,8], [7,7], [6,6]]
+    trace.put([9, 9, 9])
+    assert isinstance(trace._storage, list)
+    assert [trace[i].tolist() for i in range(3)] \
+        == [[9,9,9], [8.5,8], [7,7]]
+    trace.requires(6)
+    trace.put("done")
+    assert [trace[i] for i in range(1)] == ["done"]
+    assert [trace[i].tolist() for i in range(1,6)] \
+        == [[9,9,9], [8.5,8], [7,7], [6,6], [5,5]]
+
+    # Accumulating arrays
+    h = History(calls=2)
+    h.accumulate(calls=numpy.array([1, 2]))
+    h.accumulate(calls=numpy.array([1, 2]))
+    assert h.calls[0].tolist() == [2, 4] and h.calls[1].tolist() == [1, 2]
+
+if __name__ == "__main__":
+    test()
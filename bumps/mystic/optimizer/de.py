@@ -24,6 +24,14 @@ Stepping interface::
 
     DifferentialEvolution
 
+The crossover and mutation functions come in two forms.  The batch forms
+such as :func:`c_exp_batch` and :func:`best1_batch` operate on the whole
+population at once, returning an (npop,ndim) crossover mask or mutant
+population.  The per-individual forms such as :func:`c_exp` and
+:func:`best1` are kept for compatibility with existing code and for
+user supplied strategies.  :class:`DifferentialEvolution` uses the batch
+form of a strategy when one is available.
+
 
 References
 ==========
@@ -84,6 +92,28 @@ def c_bin(ndim, CR):
     return idx
 
 
+def c_exp_batch(npop, ndim, CR):
+    """
+    Select a sequence of dimensions for each member of the population.
+
+    Returns an (npop,ndim) boolean mask.  See :func:`c_exp`.
+    """
+    L = numpy.minimum(abs(numpy.random.geometric(1-CR, size=npop)), ndim)
+    n = numpy.random.randint(ndim, size=npop)
+    offset = (numpy.arange(ndim)[None,:] - n[:,None]) % ndim
+    return offset < L[:,None]
+
+def c_bin_batch(npop, ndim, CR):
+    """
+    Select random dimensions for each member of the population.
+
+    Returns an (npop,ndim) boolean mask.  See :func:`c_bin`.
+    """
+    idx = numpy.random.rand(npop, ndim) < CR
+    idx[numpy.arange(npop), numpy.random.randint(ndim, size=npop)] = True
+    return idx
+
+
 def best1(F, best, pop, idx, dims):
     """
     Differential evolution mutation T = best + F*(r1-r2)
@@ -126,9 +156,84 @@ def rand2(F, best, pop, idx, dims):
     r0,r1,r2,r3,r4 = _candidates(pop, 5, exclude=idx)
     return r0[dims] + F*(r1[dims]+r2[dims]-r3[dims]-r4[dims])
 
+def best1_batch(F, best, pop):
+    """
+    Differential evolution mutation T = best + F*(r1-r2) for all members.
+    """
+    r1,r2 = _candidates_batch(pop, 2)
+    return best + F*(r1-r2)
+
+def best1u_batch(F, best, pop):
+    """
+    Differential evolution mutation T = best + U*(r1-r2),  U ~ Uniform[0,F]
+    for all members.
+    """
+    r1,r2 = _candidates_batch(pop, 2)
+    return best + F*numpy.random.rand(len(pop),1)*(r1-r2)
+
+def best2_batch(F, best, pop):
+    """
+    Differential evolution mutation T = best + F*(r1+r2-r3-r4) for all
+    members.
+    """
+    r1,r2,r3,r4 = _candidates_batch(pop, 4)
+    return best + F*(r1+r2-r3-r4)
+
+def randtobest1_batch(F, best, pop):
+    """
+    Differential evolution mutation T = F*(best-old + r1-r2) for all members.
+    """
+    r1,r2 = _candidates_batch(pop, 2)
+    return F*(best-pop + r1-r2)
+
+def rand1_batch(F, best, pop):
+    """
+    Differential evolution mutation T = r0 + F*(r1-r2) for all members.
+    """
+    r0,r1,r2 = _candidates_batch(pop, 3)
+    return r0 + F*(r1-r2)
+
+def rand2_batch(F, best, pop):
+    """
+    Differential evolution mutation T = r0 + F*(r1+r2-r3-r4) for all
+    members.
+    """
+    r0,r1,r2,r3,r4 = _candidates_batch(pop, 5)
+    return r0 + F*(r1+r2-r3-r4)
+
+# Batch forms of the per-individual strategies
+BATCH = {
+    c_exp: c_exp_batch, c_bin: c_bin_batch,
+    best1: best1_batch, best1u: best1u_batch, best2: best2_batch,
+    randtobest1: randtobest1_batch, rand1: rand1_batch, rand2: rand2_batch,
+    }
+
 ############################################################
 
 
+def _candidates_batch(pop, n):
+    """
+    Select *n* distinct random candidates from *pop* for each member of
+    *pop*, not including the member itself.
+
+    Returns a list of *n* arrays the same shape as *pop*.
+    """
+    npop = len(pop)
+    if npop <= n:
+        raise ValueError("population is too small for the mutation strategy")
+    rows = numpy.arange(npop)
+    selection = numpy.empty((npop, n), 'i')
+    # Redraw the rows with repeated candidates until they are all distinct.
+    # With n much less than npop very few rows need to be redrawn.
+    redraw = rows
+    while len(redraw):
+        s = numpy.random.randint(npop-1, size=(len(redraw), n))
+        s += (s >= redraw[:,None])
+        selection[redraw] = s
+        s = numpy.sort(s, axis=1)
+        redraw = redraw[numpy.any(s[:,1:] == s[:,:-1], axis=1)]
+    return [pop[selection[:,k]] for k in range(n)]
+
 def _candidates(pop, n, exclude=None):
     """
     Select *n* random candidates from *pop*, not including the
@@ -161,6 +266,10 @@ class DifferentialEvolution(solver.Strategy):
         is the current population, *idx* is the vector being updated and
         *dims* is the set of dimensions to update.
 
+    Crossover and mutation functions listed in :data:`BATCH` are applied
+    to the whole population at once using their batch forms.  Other
+    functions are called for each member of the population in turn.
+
     Available crossover functions (block is default)::
 
         c_exp:  start at dimension n and continue until U[0,1] >= CR
@@ -183,6 +292,7 @@ class DifferentialEvolution(solver.Strategy):
         self.mutate = mutate
         self.CR, self.F = CR, F
         self.npop = npop
+        self._pop = None
 
     def default_termination_conditions(self, problem):
         success = stop.Cf(tol=1e-7,scaled=False)
@@ -209,6 +319,7 @@ class DifferentialEvolution(solver.Strategy):
         ndim = len(current)
         population = problem.randomize(self.npop * ndim)
         population[0] = current
+        self._pop = None
 
         # Return the population
         return population
@@ -227,12 +338,67 @@ class DifferentialEvolution(solver.Strategy):
         pop = history.population_points[0]
         pop_size,ndim = pop.shape
 
+        crossover = BATCH.get(self.crossover, None)
+        mutate = BATCH.get(self.mutate, None)
+        if crossover is not None:
+            dims = crossover(pop_size, ndim, self.CR)
+        else:
+            # User crossover functions may return a boolean vector or a
+            # list of dimensions, so convert them to an (npop,ndim) mask.
+            dims = numpy.zeros((pop_size, ndim), 'bool')
+            for idx in range(pop_size):
+                dims[idx, self.crossover(ndim, self.CR)] = True
         trial = pop.copy()
-        for idx,vec in enumerate(trial):
-            dims = self.crossover(ndim, self.CR)
-            vec[dims] = self.mutate(self.F, best, pop, idx, dims)
+        if mutate is not None:
+            mutant = mutate(self.F, best, pop)
+            trial[dims] = mutant[dims]
+        else:
+            for idx,vec in enumerate(trial):
+                vec[dims[idx]] = self.mutate(self.F, best, pop, idx, dims[idx])
         return trial
 
+    def ask(self, history):
+        """
+        Generate a trial point for the next population member which is
+        not already being evaluated.
+
+        Returns *(idx, trial)*, where *idx* is the member to replace.
+        """
+        if self._pop is None:
+            self._pop = history.population_points[0].copy()
+            self._val = numpy.array(history.population_values[0], 'd')
+            self._busy = numpy.zeros(len(self._pop), 'bool')
+            self._next = 0
+        pop_size,ndim = self._pop.shape
+        idle = numpy.nonzero(~self._busy)[0]
+        if len(idle) == 0:
+            raise ValueError("more workers than population members")
+        # Cycle through the idle members starting from the last one
+        idx = idle[numpy.searchsorted(idle, self._next) % len(idle)]
+        self._next = (idx+1)%pop_size
+        self._busy[idx] = True
+
+        best = self._pop[numpy.argmin(self._val)]
+        trial = self._pop[idx].copy()
+        dims = self.crossover(ndim, self.CR)
+        trial[dims] = self.mutate(self.F, best, self._pop, idx, dims)
+        return idx, trial
+
+    def tell(self, history, idx, trial, value):
+        """
+        Replace population member *idx* with *trial* if it is better.
+        """
+        self._busy[idx] = False
+        if not value > self._val[idx]:
+            self._pop[idx] = trial
+            self._val[idx] = value
+
+    def population(self):
+        """
+        Return the current population and values in a steady state fit.
+        """
+        return self._pop.copy(), self._val.copy()
+
     def update(self, history):
         """
         Update population, keeping old points that are better than
@@ -254,3 +420,47 @@ class DifferentialEvolution(solver.Strategy):
 #minimizer_function(strategy=DifferentialEvolution,
 #                   success=stop.Df(1e-5,n=10),
 #                   failure=stop.Steps(100))
+
+
+def test():
+    """
+    Check that the batch and per-member crossover and mutation produce
+    the same kind of trial population.
+    """
+    class History(object):
+        pass
+    pop = numpy.random.rand(3, 4)
+    history = History()
+    history.point = [numpy.random.rand(4)]
+    history.population_points = [pop]
+
+    # With three members, best1 mutates each member using the difference
+    # between the other two members, in either order.
+    F = 0.8
+    def mutants(idx):
+        j, k = [i for i in range(3) if i != idx]
+        return [history.point[0] + F*(pop[j]-pop[k]),
+                history.point[0] + F*(pop[k]-pop[j])]
+
+    # Crossovers: batch mask, user mask, and user list of dimensions
+    first_dim = lambda ndim, CR: [0]
+    user_bin = lambda ndim, CR: c_bin(ndim, CR)
+    user_best1 = lambda F, best, pop, idx, dims: best1(F, best, pop, idx, dims)
+    for crossover in (c_bin, user_bin, first_dim):
+        for mutate in (best1, user_best1):
+            strategy = DifferentialEvolution(CR=0.5, F=F, npop=1,
+                                             crossover=crossover,
+                                             mutate=mutate)
+            for _ in range(20):
+                trial = strategy.next(history)
+                assert trial.shape == pop.shape
+                for idx in range(3):
+                    changed = trial[idx] != pop[idx]
+                    assert changed.any()
+                    if crossover is first_dim:
+                        assert changed.tolist() == [True, False, False, False]
+                    assert any(numpy.allclose(trial[idx][changed], m[changed])
+                               for m in mutants(idx))
+
+if __name__ == "__main__":
+    test()
@@ -25,6 +25,36 @@ program first generates an initial population, then each time it
 is run generates an updated population based on the results of
 submitting the previous population to a batch queue.
 
+Steady state fits
+=================
+
+When the cost of the model varies across parameter space, waiting for
+the whole population before generating the next one leaves most of the
+workers idle while the slowest point is evaluated.  Strategies which
+define :meth:`Strategy.ask` and :meth:`Strategy.tell` can instead be run
+with :meth:`Minimizer.minimize_async`, which accepts results one at a time
+as they complete and immediately sends a new trial point to the idle
+worker::
+
+    population = fit.start()
+    ... evaluate population and call fit.update(population, result) ...
+    while not fit.isdone():
+        tag, point = fit.strategy.ask(fit.history)
+        ... submit point and wait for any result ...
+        fit.strategy.tell(fit.history, tag, point, value)
+
+Every time as many results have been received as there are members in
+the population, the history is updated with the current population
+as one step, so step and call counts, best values and population based
+stopping conditions have the same meaning as for the generational fit.
+The asynchronous mapper must provide *workers*, the number of points
+to keep in flight, *submit(tag, point)* to start evaluating a point,
+*wait()* which blocks until at least one point is complete, and
+returns the list of completed *(tag, point, value)* triples, and
+*cancel()* which discards the points still being evaluated.  No more
+points are kept in flight than there are members in the population.
+:class:`SerialAsyncMapper` is a trivial example.
+
 History traces
 ==============
 
@@ -157,6 +187,61 @@ class Minimizer:
 
     __call__ = minimize
 
+    def minimize_async(self, mapper, abort_test=None):
+        """
+        Run the solver to completion as a steady state process, returning
+        the best point.
+
+        *mapper* is an asynchronous mapper, as described in the module
+        documentation.  The strategy must support :meth:`Strategy.ask`
+        and :meth:`Strategy.tell`.
+
+        Points which are still being evaluated when the fit stops are
+        cancelled.
+        """
+        if abort_test is None:
+            abort_test = lambda: False
+        population = self.start()
+        # The strategy cannot hand out a member which is still busy
+        workers = min(mapper.workers, len(population))
+        try:
+            # The initial population must be complete before trial
+            # points can be generated from it.
+            for i, p in enumerate(population):
+                mapper.submit(i, p)
+            result = numpy.empty(len(population), 'd')
+            pending = len(population)
+            while pending:
+                for i, _, value in mapper.wait():
+                    result[i] = value
+                    pending -= 1
+            self.update(population, result)
+            if self.isdone() or abort_test():
+                return self.history.point[0]
+
+            # Keep the workers busy, recording the population as a step
+            # each time a population's worth of results has arrived.
+            done = 0
+            while True:
+                while pending < workers:
+                    tag, point = self.strategy.ask(self.history)
+                    mapper.submit(tag, point)
+                    pending += 1
+                for tag, point, value in mapper.wait():
+                    self.strategy.tell(self.history, tag, point, value)
+                    pending -= 1
+                    done += 1
+                if done >= len(population):
+                    self.update(*self.strategy.population())
+                    done = 0
+                    if self.isdone(): break
+                if abort_test(): break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            mapper.cancel()
+        return self.history.point[0]
+
     def reset(self):
         """
         Clear the solver history.
@@ -208,6 +293,11 @@ class Minimizer:
 
         self.strategy.update(self.history)
 
+        # The strategy may have updated the population in the history
+        if len(self.history.population_points) > 0:
+            points = self.history.population_points[0]
+        if len(self.history.population_values) > 0:
+            values = self.history.population_values[0]
         minidx = numpy.argmin(values)
         self.history.update(
             point = points[minidx],
@@ -315,3 +405,51 @@ class Strategy:
         including any fields placed by :meth:`update`.
         """
         raise NotImplementedError
+
+    def ask(self, history):
+        """
+        Generate a single trial point for a steady state fit.
+
+        Returns *(tag, point)*, where *tag* identifies the trial when its
+        value is returned to :meth:`tell`.  Before the first call, the
+        initial population from :meth:`start` will have been evaluated
+        and recorded in *history*.
+
+        Strategies which do not support steady state fits need not
+        define this method.
+        """
+        raise NotImplementedError
+
+    def tell(self, history, tag, point, value):
+        """
+        Accept the *value* for the trial *point* returned by :meth:`ask`.
+        """
+        raise NotImplementedError
+
+    def population(self):
+        """
+        Return the points and values of the current population in a
+        steady state fit.
+        """
+        raise NotImplementedError
+
+class SerialAsyncMapper(object):
+    """
+    Asynchronous mapper which evaluates each point as it is submitted.
+
+    *fn* is the function to minimize.
+    """
+    workers = 1
+    def __init__(self, fn):
+        self.fn = fn
+        self._done = []
+
+    def submit(self, tag, point):
+        self._done.append((tag, point, self.fn(point)))
+
+    def wait(self):
+        done, self._done = self._done, []
+        return done
+
+    def cancel(self):
+        self._done = []
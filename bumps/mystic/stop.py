@@ -108,6 +108,9 @@ The following distance functions are predefined:
     norm_inf:  max |x_i|             (Chebychev distance)
     norm_min:  min |x_i|             (not a true norm)
 
+Norms are taken over the last axis, so a matrix of points gives the norm
+of each row.  User defined norms which only accept vectors still work,
+but population measures such as :class:`r_hull` are slower with them.
 
 The predefined scale factors in essence test for
 percentage changes rather than absolute changes.
@@ -123,16 +126,16 @@ from .condition import Condition
 # ==== Norms ====
 def norm_1(x):
     """1-norm: sum(|x_i|)"""
-    return numpy.sum(abs(x))
+    return numpy.sum(abs(x), axis=-1)
 def norm_2(x):
     """2-norm: sqrt(sum(|x_i|^2))"""
-    return math.sqrt(numpy.sum(abs(x)**2))
+    return numpy.sqrt(numpy.sum(abs(x)**2, axis=-1))
 def norm_inf(x):
     """inf-norm: max(|x_i|)"""
-    return max(abs(x))
+    return numpy.max(abs(x), axis=-1)
 def norm_min(x):
     """min-norm: min(|x_i|); this is not a true norm"""
-    return min(abs(x))
+    return numpy.min(abs(x), axis=-1)
 def norm_p(p):
     """p-norm: sum(|x_i|^p)^(1/p)"""
     if isinf(p):
@@ -145,7 +148,17 @@ def norm_p(p):
     elif p == 2:
         return norm_2
     else:
-        return lambda x: numpy.sum(abs(x)**p)**(1/p)
+        return lambda x: numpy.sum(abs(x)**p, axis=-1)**(1./p)
+
+def _row_norms(norm, x):
+    """
+    Return norm(x[i]) for each row of *x*, evaluating the rows one at a
+    time if *norm* does not handle matrices.
+    """
+    r = numpy.asarray(norm(x))
+    if r.shape != x.shape[:1]:
+        r = numpy.array([norm(xi) for xi in x])
+    return r
 
 # ==== Conditions ====
 class Dx(Condition):
@@ -425,8 +438,7 @@ class r_best:
         self.norm = norm
     def __call__(self, population, best, scale):
         P = numpy.asarray(population)
-        r = max(self.norm(p - best)/scale for p in P)
-        return r
+        return numpy.max(_row_norms(self.norm, (P - best)/scale))
 
 class r_centroid:
     """
@@ -438,9 +450,8 @@ class r_centroid:
         self.norm = norm
     def __call__(self, population, best, scale):
         P = numpy.asarray(population)
-        c_i = sum(P,index=1)/P.shape[1]
-        r = max(self.norm(p - c_i)/scale for p in P)
-        return r
+        c_i = numpy.mean(P, axis=0)
+        return numpy.max(_row_norms(self.norm, (P - c_i)/scale))
 
 def r_boundingbox(population, best, scale):
     """
@@ -449,9 +460,9 @@ def r_boundingbox(population, best, scale):
         (product (max(y_i) - min(y_i))/scale)**1/k  for i in dimensions-k
     """
     P = numpy.asarray(population)
-    lo = max(P,index=0)
-    hi = max(P,index=0)
-    r = numpy.prod((hi-lo)/scale)**(1/len(hi))
+    lo = numpy.min(P, axis=0)
+    hi = numpy.max(P, axis=0)
+    r = numpy.prod((hi-lo)/scale)**(1./len(hi))
     return r
 
 class r_hull:
@@ -459,15 +470,39 @@ class r_hull:
     Measure of population radius based on maximum diameter in convex hull.
 
         1/2 max || (y1 - y2)/scale || for y1,y2 in population
+
+    Comparing all pairs of points is O(n^2) in the population size, so by
+    default the diameter is estimated from the points which are farthest
+    from a few anchor points: the extreme points in each dimension, and
+    a chain of farthest points starting from the one farthest from the
+    centroid.  This takes O(n d^2) time and is exact in most cases.  It
+    is never less than half the true diameter, so the radius will not be
+    underestimated by more than a factor of two.  Use *exact=True* to
+    compare all pairs.
     """
-    def __init__(self, norm):
+    def __init__(self, norm, exact=False, sweeps=3):
         self.norm = norm
+        self.exact = exact
+        self.sweeps = sweeps
     def __call__(self, population, best, scale):
-        r = 0
-        for i,y1 in enumerate(population):
-            for y2 in population[i+1:]:
-                d = self.norm(y2-y1)
-                if d > r: r = d
+        P = numpy.asarray(population)/scale
+        if len(P) < 2:
+            return 0.
+        if self.exact:
+            # Compare each point to the points after it, one row at a time
+            r = max(numpy.max(_row_norms(self.norm, P[i+1:]-P[i]))
+                    for i in range(len(P)-1))
+            return r/2
+
+        anchors = set(numpy.argmin(P, axis=0)) | set(numpy.argmax(P, axis=0))
+        d = _row_norms(self.norm, P - numpy.mean(P, axis=0))
+        k = numpy.argmax(d)
+        for _ in range(self.sweeps):
+            if k in anchors: break
+            anchors.add(k)
+            d = _row_norms(self.norm, P - P[k])
+            k = numpy.argmax(d)
+        r = max(numpy.max(_row_norms(self.norm, P - P[i])) for i in anchors)
         return r/2
 
 class Rx(Condition):
@@ -496,6 +531,9 @@ class Rx(Condition):
 
             1/2 max || (y1 - y2)/scale || for y1,y2 in population
 
+            estimated in linear time; use r_hull(norm, exact=True) for
+            the O(n^2) comparison of all pairs
+
     scale is determined from the fit bounds (max-min) or the
     values sum(|y_i|)/n, with protection against zero values.
 
@@ -518,17 +556,17 @@ class Rx(Condition):
         self.radius = radius
         self.scaled = scaled
     def _scaled_condition(self, history):
-        P = numpy.asarray(history.population_points)
+        P = numpy.asarray(history.population_points[0])
         scale = history.upper_bound - history.lower_bound
         idx = isinf(scale)
-        if any(idx):
-            range = sum(abs(P),index=0)/P.shape[0]
+        if idx.any():
+            range = numpy.mean(abs(P), axis=0)
             scale[idx] = range[idx]
         scale[scale == 0] = 1
-        return self.radius(P, history.point, scale)
+        return self.radius(P, history.point[0], scale)
     def _raw_condition(self, history):
-        P = numpy.asarray(history.population_points)
-        return self.radius(P, history.point, 1)
+        P = numpy.asarray(history.population_points[0])
+        return self.radius(P, history.point[0], 1)
     def config_history(self, history):
         """
         Needs the previous n points from history.
@@ -846,6 +884,72 @@ class CPUTime(Condition):
     def __str__(self):
         return "cpu_time >= %g"%self.time
 
+def _benchmark():
+    """
+    Time the population radius measures on large populations.
+    """
+    import time
+    from .history import History
+    for npop in (500, 5000):
+        ndim = 10
+        h = History(population_points=1, point=1)
+        P = numpy.random.randn(npop, ndim)
+        h.update(population_points=P, point=P[0])
+        h.upper_bound = numpy.inf*numpy.ones(ndim)
+        h.lower_bound = -h.upper_bound
+        for name, radius in (("best", r_best(norm_2)),
+                             ("centroid", r_centroid(norm_2)),
+                             ("boundingbox", r_boundingbox),
+                             ("hull", r_hull(norm_2)),
+                             ("hull inf", r_hull(norm_inf))):
+            cond = Rx(tol=1e-3, radius=radius)
+            t0 = time.time()
+            for _ in range(10): cond(h)
+            print "Rx %s npop=%d: %.2f ms"%(name, npop, (time.time()-t0)*100)
+    P = numpy.random.randn(500, ndim)
+    print "r_hull estimate %g exact %g"%(r_hull(norm_2)(P, None, 1),
+                                         r_hull(norm_2, exact=True)(P, None, 1))
+
+def test():
+    """
+    Check the population radius measures against direct loops over the
+    population.
+    """
+    numpy.random.seed(3)
+    scale = numpy.array([1., 2., 0.5])
+    vector_2 = lambda x: numpy.sqrt(sum(abs(xi)**2 for xi in x))
+    norms = norm_1, norm_2, norm_inf, norm_p(3), vector_2
+    for P in (numpy.random.randn(40,3), numpy.random.rand(7,3)**4,
+              numpy.random.standard_cauchy((100,3))):
+        best = P[5]
+        centroid = sum(P)/len(P)
+        for norm in norms:
+            target = max(norm((p - best)/scale) for p in P)
+            assert abs(r_best(norm)(P, best, scale) - target) < 1e-12
+            target = max(norm((p - centroid)/scale) for p in P)
+            assert abs(r_centroid(norm)(P, best, scale) - target) < 1e-12
+
+            # The exact hull radius compares all pairs, and the estimate
+            # is within a factor of two below it.
+            exact = max(norm((p - q)/scale) for p in P for q in P)/2
+            assert abs(r_hull(norm, exact=True)(P, best, scale) - exact) < 1e-12
+            estimate = r_hull(norm)(P, best, scale)
+            assert exact/2 <= estimate <= exact + 1e-12
+
+        width = [max(P[:,i]) - min(P[:,i]) for i in range(3)]
+        target = numpy.prod([w/s for w, s in zip(width, scale)])**(1./3)
+        assert abs(r_boundingbox(P, best, scale) - target) < 1e-12
+
+    # Points at the corners of a box, and a single point
+    P = numpy.array([[0,0],[2,0],[0,8],[2,8]], 'd')
+    assert r_boundingbox(P, P[0], 1) == 4
+    assert r_hull(norm_2)(P, P[0], 1) == r_hull(norm_2, exact=True)(P, P[0], 1)
+    assert r_hull(norm_inf)(P, P[0], 1) == 4
+    assert r_hull(norm_2)(P[:1], P[0], 1) == 0
+
+if __name__ == "__main__":
+    _benchmark()
+
 """
 class Feasible: value can be used ** Not implemented **
 
@@ -13,7 +13,10 @@ parts of the model, or different models.
 """
 #__all__ = [ 'Parameter']
 
+from __future__ import with_statement
 from copy import copy
+from operator import attrgetter
+import weakref
 
 import numpy
 
@@ -175,6 +178,11 @@ class BaseParameter(object):
     def __repr__(self):
         return "Parameter(%s)"%self
 
+# Count of assignments to parameter values.  Compiled expression programs
+# compare this against the count at their last update to decide whether
+# the operator values they hold are out of date.
+_value_changes = 0
+
 class Constant(BaseParameter):
     """
     An unmodifiable value.
@@ -264,6 +272,21 @@ class Parameter(BaseParameter):
         self.fixed = fixed
         self.name = name
 
+    def _get_value(self):
+        return self._value
+    def _set_value(self, value):
+        global _value_changes
+        _value_changes += 1
+        self._value = value
+    value = property(_get_value, _set_value)
+
+    def __setstate__(self, state):
+        # Parameters pickled before value became a property stored it
+        # directly in the instance dictionary.
+        if 'value' in state:
+            state['_value'] = state.pop('value')
+        self.__dict__.update(state)
+
     def rand(self, rng=mbounds.RNG):
         """
         Set a random value for the parameter.
@@ -428,6 +451,12 @@ class FreeVariables(object):
         for p in self._parameters.values():
             p.set(i)
 
+    def references(self):
+        """
+        Return the model parameters which are replaced by set_model.
+        """
+        return [p.reference for p in self._parameters.values()]
+
 
 # Current implementation computes values on the fly, so you only
 # need to plug the values into the parameters and the parameters
@@ -481,15 +510,27 @@ exec _gen_constraint('NE','!=')
 
 
 # ==== Arithmetic operators ===
-def _gen_binop(name,op):
+class Operator(BaseParameter):
     """
-    Generate a comparison function from a comparison operator.
+    Abstract base class for parameter operators.
+
+    If the operator is part of a :class:`CompiledExpressions` program,
+    then the value is taken from the program rather than being computed
+    from the operands.
+    """
+    _program = None
+    _slot = None
+
+def _gen_binop(name,op,ufunc):
+    """
+    Generate an arithmetic operator class from an arithmetic operator.
     """
     return '''\
-class Operator%(name)s(BaseParameter):
+class Operator%(name)s(Operator):
     """
     Parameter operator %(op)s
     """
+    ufunc = numpy.%(ufunc)s
     def __init__(self, a, b):
         self.a, self.b = a,b
         pars = []
@@ -500,6 +541,10 @@ class Operator%(name)s(BaseParameter):
     def parameters(self):
         return self._parameters
     def _value(self):
+        if self._program is not None:
+            value = self._program.read(self._slot)
+            if value is not None:
+                return value
         return float(self.a) %(op)s float(self.b)
     value = property(_value)
     def _dvalue(self):
@@ -507,13 +552,215 @@ class Operator%(name)s(BaseParameter):
     dvalue = property(_dvalue)
     def __str__(self):
         return "(%%s %(op)s %%s)"%%(self.a,self.b)
-'''%dict(name=name,op=op)
+'''%dict(name=name,op=op,ufunc=ufunc)
+
+exec _gen_binop('Add','+','add')
+exec _gen_binop('Sub','-','subtract')
+exec _gen_binop('Mul','*','multiply')
+exec _gen_binop('Div','/','true_divide')
+exec _gen_binop('Pow','**','power')
+
+
+class CompiledExpressions(object):
+    """
+    Evaluate all the parameter operators in a parameter set in one pass.
+
+    Parameter expressions such as *a+b\*c* are normally evaluated each
+    time their value is requested by walking the expression tree.  For
+    models with many tied parameters this can dominate the cost of setting
+    the parameters.  Instead, we gather all operators into a topologically
+    ordered program with one slot per value, and compute every operator
+    at the same depth in the tree with a single array operation.
+
+    The program is evaluated lazily.  Setting the value of any
+    :class:`Parameter` marks the program as out of date, and the next
+    operator value read from it recomputes the whole program.  Operands
+    which store their value elsewhere, such as a :class:`Reference` to a
+    model attribute or a :class:`Function`, cannot signal a change, so the
+    operators which depend on them are evaluated directly as before.
+    :meth:`update` forces the program to be recomputed.
+
+    Operators whose compiled value is infinite or NaN are evaluated
+    directly when read, so division by zero and overflow raise the same
+    Python exceptions as they do without the program.
+
+    *pars* is the parameter structure to compile.  Operators which depend
+    on any of the parameters in *exclude* are left out of the program and
+    are evaluated directly as before.
+
+    Use :func:`compile_expressions` to share one program between all the
+    users of the same set of operators.  An operator is served by the first
+    live program that compiled it.  Call :meth:`release` to return the
+    operators to direct evaluation.
+
+    >>> a, b = Parameter(2, name='a'), Parameter(3, name='b')
+    >>> c = (a + b) * a
+    >>> program = CompiledExpressions([c])
+    >>> a.value = 3
+    >>> print c.value
+    18.0
+    >>> program.release()
+    >>> a.value = 4
+    >>> print c.value
+    28.0
+    """
+    def __init__(self, pars, exclude=()):
+        operators, depth = _gather_operators(pars, exclude)
+
+        # Assign slots for the operator results, then for the operands
+        # which are not themselves compiled operators.
+        slot = dict((id(p),k) for k,p in enumerate(operators))
+        leaves, constants = [], []
+        def operand(p):
+            if id(p) not in slot:
+                slot[id(p)] = len(slot)
+                if isinstance(p, BaseParameter):
+                    leaves.append(p)
+                else:
+                    constants.append((slot[id(p)], p))
+            return slot[id(p)]
+
+        # Group the operations by depth and by operator so that each
+        # group can be computed as a single ufunc call.
+        groups = {}
+        for p in operators:
+            key = depth[id(p)], p.ufunc.__name__
+            out, a, b = groups.setdefault(key, (p.ufunc, [], [], []))[1:]
+            out.append(slot[id(p)])
+            a.append(operand(p.a))
+            b.append(operand(p.b))
+        self._steps = [(ufunc, numpy.array(out), numpy.array(a),
+                        numpy.array(b))
+                       for _, (ufunc, out, a, b) in sorted(groups.items())]
+        self._leaves = leaves
+        self._leaf_slots = numpy.array([slot[id(p)] for p in leaves], 'i')
+        self.values = numpy.empty(len(slot), 'd')
+        for k,v in constants:
+            self.values[k] = v
+        self.update()
+
+        self._users = 1
+        self._operators = operators
+        for p in operators:
+            if p._program is None:
+                p._program, p._slot = self, slot[id(p)]
+
+    def __len__(self):
+        return len(self._operators)
+
+    def update(self):
+        """
+        Recompute the operator values from the current parameter values.
+        """
+        self._changes = _value_changes
+        if not self._steps:
+            return
+        values = self.values
+        # All leaves have tracked values, which are stored in p._value.
+        values[self._leaf_slots] = map(_leaf_value, self._leaves)
+        with numpy.errstate(all='ignore'):
+            for ufunc, out, a, b in self._steps:
+                values[out] = ufunc(values[a], values[b])
+        self._finite = numpy.isfinite(values).all()
+
+    def read(self, slot):
+        """
+        Return the value in *slot*, updating the program if it is stale.
+
+        Returns None if the value is not finite, in which case the caller
+        should evaluate the operator directly.
+        """
+        if self._changes != _value_changes:
+            self.update()
+        value = self.values[slot]
+        if self._finite or numpy.isfinite(value):
+            return value
+        return None
 
-exec _gen_binop('Add','+')
-exec _gen_binop('Sub','-')
-exec _gen_binop('Mul','*')
-exec _gen_binop('Div','/')
-exec _gen_binop('Pow','**')
+    def release(self):
+        """
+        Return the operators to direct evaluation once the last user of
+        the program has released it.
+        """
+        self._users -= 1
+        if self._users > 0:
+            return
+        for p in self._operators:
+            if p._program is self:
+                p._program = p._slot = None
+        self._operators = []
+
+_leaf_value = attrgetter('_value')
+
+def _gather_operators(pars, exclude=()):
+    """
+    Return the operators in *pars* which do not depend on any parameter in
+    *exclude* or on any operand with an untracked value, and a map from
+    operator id to depth in the expression tree.  Operands come before
+    the operators that use them.
+    """
+    exclude = set(id(p) for p in exclude)
+    depth = {}
+    operators = []
+    compiled = set()
+    def tracked(p):
+        if isinstance(p, Operator):
+            return id(p) in compiled
+        if isinstance(p, BaseParameter):
+            return getattr(type(p), 'value', None) in _TRACKED_VALUES
+        return True
+    def walk(p):
+        if not isinstance(p, Operator):
+            return 0
+        if id(p) not in depth:
+            depth[id(p)] = 1 + max(walk(p.a), walk(p.b))
+            if (tracked(p.a) and tracked(p.b)
+                and not any(id(q) in exclude for q in p.parameters())):
+                compiled.add(id(p))
+                operators.append(p)
+        return depth[id(p)]
+    for p in unique(pars):
+        walk(p)
+    return operators, depth
+
+# Live programs, keyed by the set of operators they compute.
+_PROGRAMS = weakref.WeakValueDictionary()
+
+def compile_expressions(pars, exclude=()):
+    """
+    Return a :class:`CompiledExpressions` program for *pars*.
+
+    If a live program already computes the same set of operators then it
+    is shared rather than compiling a second copy.  Each caller should
+    call :meth:`CompiledExpressions.release` when it no longer needs the
+    program.
+
+    >>> a, b = Parameter(2, name='a'), Parameter(3, name='b')
+    >>> c = a*b + 4
+    >>> first = compile_expressions([c])
+    >>> second = compile_expressions([c])
+    >>> first is second
+    True
+    >>> a.value = 5
+    >>> print c.value
+    19.0
+    >>> second.release()
+    >>> b.value = 4
+    >>> print c.value, c._program is first
+    24.0 True
+    >>> first.release()
+    >>> print c._program
+    None
+    """
+    operators, _ = _gather_operators(pars, exclude)
+    key = frozenset(id(p) for p in operators)
+    program = _PROGRAMS.get(key, None)
+    if program is None or program._users == 0:
+        program = CompiledExpressions(pars, exclude=exclude)
+        _PROGRAMS[key] = program
+    else:
+        program._users += 1
+    return program
 
 
 def substitute(a):
@@ -698,6 +945,17 @@ def unique(s):
     # Return the complete set of parameters
     return result
 
+def dependencies(s):
+    """
+    Return the independent parameters which determine the values in s.
+
+    Parameter expressions such as *a+b* and delayed function evaluations
+    are replaced by the parameters they are computed from, so that any
+    change to a value in s can be detected by checking only these.  The
+    ordering is stable, as for :func:`unique`.
+    """
+    return [p for p in unique(s) if p.parameters() == [p]]
+
 def fittable(s):
     """
     Return the list of fittable parameters in no paraticular order.
@@ -729,9 +987,13 @@ def current(s):
 class IntegerParameter(Parameter):
     discrete = True
     def _get_value(self): return self._value
-    def _set_value(self, value): self._value = int(value)
+    def _set_value(self, value): Parameter._set_value(self, int(value))
     value = property(_get_value, _set_value)
 
+# Value properties which count assignments in _value_changes.  Their
+# values are stored in p._value.
+_TRACKED_VALUES = (Parameter.value, Constant.value, IntegerParameter.value)
+
 class Alias(object):
     """
     Parameter alias.
@@ -753,3 +1015,104 @@ class Alias(object):
         setattr(self.obj,self.attr,self.par.value)
     def parameters(self):
         return self.p.parameters()
+
+
+def test():
+    class Model(object): pass
+    model = Model()
+    a, b = Parameter(3, name='a'), Parameter(4, name='b')
+    k, r = Constant(5, name='k'), Reference(model, 'x')
+    model.x = 2.
+    f = function(abs)(b)
+    tied = a*k + b
+    referenced = (a + r)*2
+    called = f*a
+    ratio = (a*1)/(b - 4)
+    n = IntegerParameter(2, name='n')
+    scaled = n*2
+    program = compile_expressions([tied, referenced, called, ratio, scaled])
+    assert tied.value == 19 and referenced.value == 10 and called.value == 12
+
+    # Only operators with tracked operands are compiled; the others are
+    # evaluated directly, so changes made outside the parameters are seen.
+    for p in (tied, ratio.a, ratio.b, ratio, scaled):
+        assert p._program is program
+    for p in (referenced, referenced.a, called):
+        assert p._program is None
+    model.x = 7.
+    assert referenced.value == 20
+    b.value = -6
+    assert called.value == 18 and tied.value == 9
+    n.value = 3.7
+    assert scaled.value == 6
+
+    # Constants are part of the program and parameter changes are seen
+    # without an explicit update.
+    a.value = 1
+    assert tied.value == -1
+    a.value = 2
+    assert tied.value == 4 and referenced.value == 18
+
+    # Division by zero raises as it does without the program.
+    b.value = 4
+    try:
+        ratio.value
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("expected ZeroDivisionError")
+    try:
+        (ratio + 1).value
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("expected ZeroDivisionError")
+    b.value = 5
+    assert ratio.value == 2
+
+    # A NaN leaf does not force the program to be recomputed on each read.
+    a.value = numpy.nan
+    assert numpy.isnan(tied.value)
+    changes = program._changes
+    program.update = None  # fails if the program is recomputed
+    assert numpy.isnan(tied.value) and numpy.isnan(ratio.value)
+    assert program._changes == changes
+    del program.update
+
+    program.release()
+    a.value = 3
+    assert tied.value == 20 and tied._program is None
+
+
+def _benchmark(n=500, repeat=200):
+    """
+    Compare compiled and recursive evaluation of parameter expressions.
+
+    Builds *n* parameters and *n* derived parameters, each depending on
+    three of the parameters through four operators, then times setting
+    new parameter values and reading back all the derived values.
+    """
+    import time
+    pars = [Parameter(k+1., name="p%d"%k) for k in range(n)]
+    derived = [(pars[k] + pars[(k+1)%n])*2 - pars[(k+2)%n]/3
+               for k in range(n)]
+    values = numpy.random.rand(repeat, n)
+
+    def run(program=None):
+        t0 = time.time()
+        for v in values:
+            for p,vk in zip(pars,v): p.value = vk
+            result = [p.value for p in derived]
+        return 1000*(time.time()-t0)/repeat, result
+
+    direct, expected = run()
+    program = CompiledExpressions(derived)
+    compiled, result = run(program)
+    assert numpy.allclose(result, expected)
+    print "%d parameters, %d operators"%(n, len(program))
+    program.release()
+    print "recursive evaluation: %.3f ms per update"%direct
+    print "compiled evaluation:  %.3f ms per update"%compiled
+
+if __name__ == "__main__":
+    _benchmark()
@@ -13,7 +13,7 @@ __all__ = ["parallel_tempering"]
 
 import numpy
 from numpy import asarray, zeros, ones, exp, diff, std, inf, \
-    array, nonzero, sqrt, zeros_like
+    array, nonzero, sqrt, zeros_like, where, repeat, arange
 from numpy.linalg import norm
 from numpy.random import rand,randn, randint, permutation
 
@@ -23,7 +23,7 @@ def every_ten(step,x,fx,P,E):
 def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
                        CR=0.9, burn=1000,
                        monitor=every_ten,
-                       logfile=None):
+                       logfile=None, mapper=None, replicas=1):
     r"""
     Perform a MCMC walk using multiple temperatures in parallel.
 
@@ -68,45 +68,67 @@ def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
         Name of the file which will log the history of every accepted step.
         Note that this includes all of the burn steps, so it can get very
         large.
+    *mapper* = None : function(array) -> vector
+        Function which evaluates the nllf for each of a set of points.
+        The proposals for all chains are sent to the mapper at once, so
+        use a parallel mapper to evaluate the temperatures in parallel.
+        The default is to call *nllf* for each point.
+    *replicas* = 1 : int
+        Number of chains to run at each temperature.  Chains swap with
+        the same replica at the neighbouring temperatures, and the replicas
+        at each temperature share history for their differential evolution
+        steps.  Use this to keep more processors busy than there are
+        temperatures.
 
     :Returns:
 
     *history* : History
         Structure containing *best*, *best_point* and *buffer*.  *best* is
         the best nllf value seen and *best_point* is the parameter vector
-        which yielded *best*.  The list *buffer* contains lists of tuples
-        (step, temperature, nllf, x) for each temperature.
+        which yielded *best*.  The arrays *steps*, *temperatures*,
+        *energies* and *points* hold the last *steps\*replicas* accepted
+        values for each temperature, with *count* of them filled.  The list
+        *buffer* contains lists of tuples (step, temperature, nllf, x) for
+        each temperature, oldest first.
     """
+    if mapper is None:
+        mapper = lambda points: asarray([nllf(p) for p in points])
+    T = asarray(T)
     N = len(T)
-    history = History(logfile=logfile, streams=N, size=steps)
+    history = History(logfile=logfile, streams=N, size=steps*replicas)
     bounder = ReflectBounds(*bounds)
     #stepper = RandStepper(bounds, tol=0.2/T[-1])
     stepper = Stepper(bounds, history)
-    dT = diff(1./asarray(T))
-    P = asarray([p]*N)   # Points
-    E = ones(N)*nllf(p)  # Values
-    history.save(step=0, temperature=T, energy=E, point=P)
-    total_accept = zeros(N)
+    dT = diff(1./T)
+    # Chains are ordered by temperature, with the replicas for each
+    # temperature adjacent to each other.
+    stream = repeat(arange(N), replicas)
+    Tchain = T[stream]
+    P = asarray([p]*(N*replicas)) # Points
+    E = ones(N*replicas)*nllf(p)  # Values
+    history.save(step=0, temperature=T, energy=E[::replicas],
+                 point=P[::replicas])
+    total_accept = zeros(N*replicas)
     total_swap = zeros(N-1)
     for step in range(1,steps+burn):
         # Take a step
         R = rand()
         if step < 20 or R < 0.2:
             #action = 'jiggle'
-            Pnext = [stepper.jiggle(p,0.01*t/T[-1]) for p,t in zip(P,T)]
+            Pnext = stepper.jiggle(P, 0.01*Tchain/T[-1])
         elif R < 0.4:
             #action = 'direct'
-            Pnext = [stepper.direct(p, i) for i,p in enumerate(P)]
+            Pnext = stepper.direct(P, stream)
         else:
             #action = 'diffev'
-            Pnext = [stepper.diffev(p, i, CR=CR) for i,p in enumerate(P)]
+            Pnext = stepper.diffev(P, stream, CR=CR)
 
         # Test constraints
-        Pnext = asarray([bounder.apply(p) for p in Pnext])
+        Pnext = bounder.apply(Pnext)
 
         # Temperature dependent Metropolis update
-        Enext = asarray([nllf(p) for p in Pnext])
-        accept = exp(-(Enext-E)/T) > rand(N)
+        Enext = asarray(mapper(Pnext), 'd')
+        accept = exp(-(Enext-E)/Tchain) > rand(N*replicas)
         #print step,action
         #print "dP"," ".join("%.6f"%norm((pn-p)/stepper.step) for pn,p in zip(P,Pnext))
         #print "dE"," ".join("%.1f"%(en-e) for en,e in zip(E,Enext))
@@ -117,7 +139,8 @@ def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
         total_accept += accept
 
         # Accumulate history for population based methods
-        history.save(step, temperature=T, energy=E, point=P, changed=accept)
+        history.save(step, temperature=Tchain, energy=E, point=P,
+                     changed=accept, stream=stream)
         #print "best",history.best
 
         # Swap chains across temperatures
@@ -125,13 +148,16 @@ def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
         # point is found at a high temperature which push it immediately as
         # low as we can go rather than risk losing it at the next high temp
         # step.
+        # Each replica swaps with the same replica at the next temperature.
+        Er = E.reshape(N,replicas)
+        Pr = P.reshape(N,replicas,-1)
         swap = zeros(N-1)
         for i in range(N-2,-1,-1):
             #print "swap",E[i+1]-E[i],dT[i],exp((E[i+1]-E[i])*dT[i])
-            if exp((E[i+1]-E[i])*dT[i]) > rand():
-                swap[i] = 1
-                E[i+1],E[i] = E[i],E[i+1]
-                P[i+1],P[i] = P[i]+0,P[i+1]+0
+            r = exp((Er[i+1]-Er[i])*dT[i]) > rand(replicas)
+            swap[i] = numpy.sum(r)/replicas
+            Er[i+1,r],Er[i,r] = Er[i,r],Er[i+1,r]+0
+            Pr[i+1,r],Pr[i,r] = Pr[i,r],Pr[i+1,r]+0
         total_swap += swap
         #assert nllf(P[0]) == E[0]
 
@@ -151,53 +177,127 @@ def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
     return history
 
 class History(object):
+    """
+    Per-temperature ring buffers holding the last *size* accepted points.
+
+    The steps, temperatures, energies and points for each stream are stored
+    in preallocated arrays of shape (streams, size, ...), with *count*
+    recording how many slots of each stream are filled.  The arrays are
+    allocated on the first call to *save*, once the number of parameters
+    is known.
+
+    If *logfile* is given, every accepted point is appended to it as a row
+    of float64 values (step, temperature, energy, point...) following a
+    one line text header.  Use :func:`read_log` to load it.
+    """
     def __init__(self, streams=None, size=1000, logfile=None):
-        # Allocate buffers
+        self.streams = streams
         self.size = size
-        self.buffer = [[] for _ in range(streams)]
-        # Prepare log file
-        if logfile != None:
-            self.log = open(logfile,'w')
-            print >>self.log, "# Step Temperature Energy Point"
-        else:
-            self.log = None
+        self.count = zeros(streams, 'i')
+        self._index = zeros(streams, 'i')
+        self.steps = self.temperatures = self.energies = self.points = None
+        self.logfile = logfile
+        self.log = None
         # Track the optimum
         self.best = inf
-    def save(self, step, temperature, energy, point, changed=None):
-        if changed is None: changed = ones(len(temperature),'b')
-        for i,a in enumerate(changed):
-            if a:
-                self._save_point(step,i,temperature[i],energy[i],point[i]+0)
-    def _save_point(self, step, i, T, E, P):
-        # Save in buffer
-        S = self.buffer[i]
-        if len(S) >= self.size: S.pop(0)
-        if len(S) > 0:
-            #print "P",P
-            #print "S",S[-1][3]
-            assert norm(P-S[-1][3]) != 0
-        S.append( (step,T,E,P) )
-        #print "stream",i,"now len",len(S)
-        # Track of the optimum
-        if E < self.best:
-            self.best = E
-            self.best_point = P
+
+    def _allocate(self, Nvar):
+        self.steps = zeros((self.streams, self.size), 'i')
+        self.temperatures = zeros((self.streams, self.size), 'd')
+        self.energies = zeros((self.streams, self.size), 'd')
+        self.points = zeros((self.streams, self.size, Nvar), 'd')
+        if self.logfile is not None:
+            self.log = open(self.logfile, 'wb')
+            self.log.write(LOG_HEADER%Nvar)
+
+    def save(self, step, temperature, energy, point, changed=None,
+             stream=None):
+        """
+        Save the changed points.  Point *i* is saved to *stream[i]*, or to
+        stream *i* if no streams are given.
+        """
+        point = asarray(point)
+        if self.points is None: self._allocate(point.shape[1])
+        idx = (arange(len(temperature)) if changed is None
+               else nonzero(changed)[0])
+        if len(idx) == 0: return
+        s = idx if stream is None else asarray(stream)[idx]
+
+        # Several replicas may save to the same stream in one step, so
+        # offset each point by its rank among the points for its stream.
+        order = numpy.argsort(s, kind='mergesort')
+        idx, s = idx[order], s[order]
+        rank = arange(len(s)) - numpy.searchsorted(s, s, 'left')
+        slot = (self._index[s] + rank) % self.size
+        T, E, P = asarray(temperature)[idx], asarray(energy)[idx], point[idx]
+        self.steps[s, slot] = step
+        self.temperatures[s, slot] = T
+        self.energies[s, slot] = E
+        self.points[s, slot] = P
+        n = numpy.bincount(s, minlength=self.streams)
+        self._index = (self._index + n) % self.size
+        self.count = numpy.minimum(self.count + n, self.size)
+
+        # Track the optimum
+        i = numpy.argmin(E)
+        if E[i] < self.best:
+            self.best = E[i]
+            self.best_point = P[i]+0
+
         # Log to file
         if self.log:
-            point_str = " ".join("%.6g"%v for v in P)
-            print >>self.log,step,T,E,point_str
+            rows = numpy.hstack((numpy.tile(float(step), (len(s),1)),
+                                 T[:,None], E[:,None], P))
+            rows.astype('<f8').tofile(self.log)
             self.log.flush()
 
+    def draw_points(self, streams, k):
+        """
+        Return an array of shape len(streams) x k x Nvar with k points drawn
+        without replacement from each of the given streams.
+
+        The streams must each have at least k points.
+        """
+        streams = asarray(streams)
+        slot = choose_rows(self.count[streams], k)
+        return self.points[streams[:,None], slot]
+
     def draw(self, stream, k):
         """
         Return a list of k items drawn from the given stream.
 
         If the stream is too short, fewer than n items may be returned.
         """
-        S = self.buffer[stream]
-        n = len(S)
-        return [S[i] for i in choose(n,k)] if n > k else S[:]
+        n = self.count[stream]
+        slot = choose(n,k) if n > k else arange(n)
+        return [self._item(stream, i) for i in slot]
+
+    @property
+    def buffer(self):
+        """
+        List of (step, temperature, nllf, x) tuples for each stream, oldest
+        first.
+        """
+        return [[self._item(i, j % self.size)
+                 for j in range(self._index[i]-self.count[i], self._index[i])]
+                for i in range(self.streams)]
 
+    def _item(self, stream, slot):
+        return (self.steps[stream, slot], self.temperatures[stream, slot],
+                self.energies[stream, slot], self.points[stream, slot])
+
+LOG_HEADER = "# Step Temperature Energy Point[%d] as float64 rows\n"
+
+def read_log(logfile):
+    """
+    Return the rows (step, temperature, energy, point...) of a parallel
+    tempering log file.
+    """
+    with open(logfile, 'rb') as fid:
+        header = fid.readline()
+        Nvar = int(header.split('[')[1].split(']')[0])
+        data = numpy.fromfile(fid, dtype='<f8')
+    return data.reshape(-1, 3+Nvar)
 
 
 class Stepper(object):
@@ -207,69 +307,100 @@ class Stepper(object):
         self.step = (high-low)
         self.history = history
 
-    def diffev(self, p, stream, CR=0.8, noise=0.05):
-        if len(self.history.buffer[stream]) < 20:
-            #print "jiggling",stream,stream,len(self.history.buffer[stream])
-            return self.jiggle(p,1e-6)
+    def diffev(self, P, streams, CR=0.8, noise=0.05):
+        """
+        Differential evolution step for each point in *P* using history
+        from the corresponding stream.
+        """
         # Ideas incorporated from DREAM by Vrugt
-        N = len(p)
+        M, N = P.shape
+        delta = self._jiggle_short(P, streams)
+        ready = nonzero(self._ready(streams))[0]
+
         # Select to number of vector pair differences to use in update
         # using k ~ discrete U[1,max pairs]
-        k = randint(4)+1
-
-        # Select 2*k members at random
-        parents = [v[3] for v in self.history.draw(stream, 2*k)]
-        k = len(parents)//2  # May not have enough parents
-        pop = array(parents)
-        #print "k",k
-        #print "parents",parents
-        #print "pop",pop
-
-        # Select the dims to update based on the crossover ratio, making
-        # sure at least one significant dim is selected
-        while True:
-            vars = nonzero(rand(N) < CR)
-            if len(vars) == 0: vars = [randint(N)]
-            step = numpy.sum(pop[:k]-pop[k:], axis=0)
-            if norm(step[vars]) > 0: break
-
-        # Weight the size of the jump inversely proportional to the
-        # number of contributions, both from the parameters being
-        # updated and from the population defining the step direction.
-        gamma = 2.38/sqrt(2 * len(vars) * k)
-
-        # Apply that step with F scaling and noise
-        eps = 1 + noise * (2 * rand(N) - 1)
-        #print "j",j
-        #print "gamma",gamma
-        #print "step",step.shape
-        #print "vars",vars.shape
-        delta = zeros_like(p)
-        delta[vars] = gamma*(eps*step)[vars]
-        assert norm(delta) != 0
-        return p + delta
+        pairs = randint(4, size=len(ready))+1
+        for k in range(1,5):
+            idx = ready[pairs == k]
+            if len(idx) == 0: continue
+
+            # Select 2*k members at random
+            pop = self.history.draw_points(streams[idx], 2*k)
+            step = numpy.sum(pop[:,:k]-pop[:,k:], axis=1)
+
+            # Select the dims to update based on the crossover ratio, making
+            # sure at least one significant dim is selected.  Points whose
+            # parents are all identical jiggle instead.
+            vars = rand(len(idx),N) < CR
+            retry = nonzero(~numpy.any(vars & (step != 0), axis=1)
+                            & numpy.any(step != 0, axis=1))[0]
+            while len(retry) > 0:
+                vars[retry] = rand(len(retry),N) < CR
+                retry = retry[~numpy.any(vars[retry] & (step[retry] != 0),
+                                         axis=1)]
+            vars &= numpy.any(step != 0, axis=1)[:,None]
+
+            # Weight the size of the jump inversely proportional to the
+            # number of contributions from the population defining the
+            # step direction.
+            gamma = 2.38/sqrt(2 * k)
+
+            # Apply that step with F scaling and noise
+            eps = 1 + noise * (2 * rand(len(idx),N) - 1)
+            delta[idx] = where(vars, gamma*eps*step, 0)
+            stuck = idx[~numpy.any(vars, axis=1)]
+            delta[stuck] = randn(len(stuck),N)*self.step*1e-6
+        assert (numpy.sum(delta**2, axis=1) != 0).all()
+        return P + delta
+
+    def direct(self, P, streams):
+        """
+        Step each point in *P* by the difference between two points from the
+        history of the corresponding stream.
+        """
+        delta = self._jiggle_short(P, streams)
+        ready = nonzero(self._ready(streams))[0]
+        if len(ready) > 0:
+            pair = self.history.draw_points(streams[ready], 2)
+            delta[ready] = pair[:,0] - pair[:,1]
+            same = ready[numpy.all(delta[ready] == 0, axis=1)]
+            if len(same) > 0:
+                print "direct should never return identical points!!"
+                delta[same] = (rand(len(same),P.shape[1])*self.step
+                               + self.offset)
+        assert (numpy.sum(delta**2, axis=1) != 0).all()
+        return P + delta
+
+    def jiggle(self, P, noise):
+        """
+        Gaussian step for each point in *P* with standard deviation *noise*
+        times the range of the parameter.
+        """
+        noise = asarray(noise)
+        delta = randn(*P.shape)*self.step*noise[...,None]
+        assert (numpy.sum(delta**2, axis=-1) != 0).all()
+        return P + delta
 
-    def direct(self, p, stream):
-        if len(self.history.buffer[stream]) < 20:
-            #print "jiggling",stream,len(self.history.buffer[stream])
-            return self.jiggle(p,1e-6)
-        pair = self.history.draw(stream, 2)
-        delta = pair[0][3] - pair[1][3]
-        if norm(delta) == 0:
-            print "direct should never return identical points!!"
-            return self.random(p)
-        assert norm(delta) != 0
-        return p + delta
+    def random(self, P):
+        delta = rand(*P.shape)*self.step + self.offset
+        assert (numpy.sum(delta**2, axis=-1) != 0).all()
+        return P + delta
 
-    def jiggle(self, p, noise):
-        delta = randn(len(p))*self.step*noise
-        assert norm(delta) != 0
-        return p + delta
+    def _ready(self, streams):
+        """
+        Return true for each stream with enough history for population steps.
+        """
+        return self.history.count[streams] >= 20
 
-    def random(self, p):
-        delta = rand(len(p))*self.step + self.offset
-        assert norm(delta) != 0
-        return p + delta
+    def _jiggle_short(self, P, streams):
+        """
+        Return small random steps for the points whose streams do not yet
+        have enough history, and zero steps for the rest.
+        """
+        delta = zeros_like(P)
+        short = nonzero(~self._ready(streams))[0]
+        delta[short] = randn(len(short),P.shape[1])*self.step*1e-6
+        return delta
 
     def subspace_jiggle(self, p, noise, k):
         n = len(self.step)
@@ -294,16 +425,19 @@ class ReflectBounds(object):
         """
         Update x so all values lie within bounds
 
+        *y* may be a single point or an array with one point per row.
+
         Returns x for convenience.  E.g., y = bounds.apply(x+0)
         """
         minn, maxn = self.low, self.high
         # Reflect points which are out of bounds
-        idx = y < minn; y[idx] = 2*minn[idx] - y[idx]
-        idx = y > maxn; y[idx] = 2*maxn[idx] - y[idx]
+        y[...] = where(y < minn, 2*minn - y, y)
+        y[...] = where(y > maxn, 2*maxn - y, y)
 
         # Randomize points which are still out of bounds
         idx = (y < minn) | (y > maxn)
-        y[idx] = minn[idx] + rand(sum(idx))*(maxn[idx]-minn[idx])
+        if idx.any():
+            y[idx] = (minn + rand(*y.shape)*(maxn-minn))[idx]
         return y
 
 def choose(n, k):
@@ -321,3 +455,136 @@ def choose(n, k):
     if len(set(idx)) != len(idx):
         print "choose(n,k) contains dups!!",n,k
     return idx
+
+def choose_rows(n, k):
+    """
+    Return an array of len(n) x k indices, with row *i* holding k things
+    selected from a pool of n[i] without replacement.
+    """
+    # Draw from the pool less the items already chosen, then step the
+    # draw past each chosen item at or below it, smallest first.
+    n = asarray(n)
+    idx = zeros((len(n),k), 'i')
+    for j in range(k):
+        r = (rand(len(n))*(n-j)).astype('i')
+        chosen = numpy.sort(idx[:,:j], axis=1)
+        for c in range(j):
+            r += (r >= chosen[:,c])
+        idx[:,j] = r
+    return idx
+
+
+def test():
+    """
+    Check the population steppers, the bounds reflection and a small run
+    with several replicas per temperature evaluated through a mapper.
+    """
+    numpy.random.seed(1)
+
+    # Stream 0 varies only in x and stream 1 only in y.  The values are
+    # distinct powers of two so that no sum of differences between distinct
+    # points is zero.
+    history = History(streams=2, size=40)
+    x = 2.**arange(30)
+    for k in range(30):
+        history.save(step=k, temperature=[1,2], energy=[0,0],
+                     point=[[x[k],0],[0,x[k]]])
+    stepper = Stepper((zeros(2), ones(2)), history)
+    streams = array([0,0,1,1,1])
+    P = randn(5,2)
+    for Pnext in (stepper.direct(P, streams),
+                  stepper.diffev(P, streams, CR=0.5)):
+        delta = Pnext - P
+        assert (delta[streams==0, 0] != 0).all()
+        assert (delta[streams==0, 1] == 0).all()
+        assert (delta[streams==1, 0] == 0).all()
+        assert (delta[streams==1, 1] != 0).all()
+    delta = stepper.jiggle(P, array([1,1,1,1e-10,1e-10])) - P
+    assert (abs(delta[3:]) < 1e-7).all() and (abs(delta[:3]) > 1e-7).any()
+
+    # Reflecting an array of points matches reflecting each point
+    bounder = ReflectBounds([0,-1], [1,1])
+    Y = array([[0.5,0.5], [-0.25,0.5], [1.25,-1.5], [0.5,3.], [-0.5,1.5]])
+    reflected = array([[0.5,0.5], [0.25,0.5], [0.75,-0.5], [0.5,-1.],
+                       [0.5,0.5]])
+    assert (bounder.apply(Y+0) == reflected).all()
+    for y, r in zip(Y, reflected):
+        assert (bounder.apply(y+0) == r).all()
+    y = bounder.apply(array([[5.,-5.]]))
+    assert (y >= [0,-1]).all() and (y <= [1,1]).all()
+
+    # Small run with two replicas at each of three temperatures
+    nllf = lambda p: numpy.sum((p-0.25)**2)/2
+    sizes = []
+    def mapper(points):
+        sizes.append(len(points))
+        return [nllf(p) for p in points]
+    def monitor(step, x, fx, P, E):
+        assert numpy.allclose(E, [nllf(p) for p in P])
+        assert (P >= -1).all() and (P <= 1).all()
+    T = array([1.,2.,4.])
+    history = parallel_tempering(nllf, p=array([0.9,-0.9]),
+                                 bounds=(-ones(2),ones(2)), T=T,
+                                 steps=30, burn=60, monitor=monitor,
+                                 mapper=mapper, replicas=2)
+    assert sizes == [6]*89
+    assert history.best < nllf(array([0.9,-0.9]))
+    assert abs(history.best - nllf(history.best_point)) < 1e-12
+    assert (history.count <= 60).all() and (history.count > 20).all()
+    assert (history.temperatures[0,:history.count[0]] == T[0]).all()
+
+    _check_history()
+
+def _check_history():
+    """
+    Check the history ring buffers and the log file against a list of the
+    saved points for each stream.
+    """
+    import os, tempfile
+    fd, logfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        history = History(streams=3, size=5, logfile=logfile)
+        saved, logged = [[],[],[]], []
+        stream = array([0,0,1,1,2])
+        for step in range(12):
+            T = 1. + stream
+            E = rand(5)
+            P = rand(5,2)
+            changed = rand(5) < 0.7
+            history.save(step, temperature=T, energy=E, point=P,
+                         changed=changed, stream=stream)
+            for i in nonzero(changed)[0]:
+                saved[stream[i]].append((step, T[i], E[i], P[i]))
+            # Rows are logged grouped by stream
+            for i in sorted(nonzero(changed)[0], key=lambda i: stream[i]):
+                logged.append([step, T[i], E[i]] + list(P[i]))
+        history.log.close()
+
+        # The log holds every saved point
+        rows = read_log(logfile)
+        assert rows.shape == (len(logged), 5)
+        assert (rows == array(logged)).all()
+    finally:
+        os.unlink(logfile)
+
+    # The buffer view holds the last *size* points of each stream
+    assert all(len(points) > 5 for points in saved)
+    for s in range(3):
+        assert history.count[s] == min(len(saved[s]), 5)
+        buffer = history.buffer[s]
+        assert len(buffer) == history.count[s]
+        for item, target in zip(buffer, saved[s][-5:]):
+            assert item[:3] == target[:3] and (item[3] == target[3]).all()
+
+    # Points drawn from a stream are distinct members of that stream
+    for _ in range(20):
+        pop = history.draw_points([0,1,2,1], 4)
+        for s, points in zip([0,1,2,1], pop):
+            pool = [tuple(p) for _,_,_,p in saved[s][-5:]]
+            drawn = [tuple(p) for p in points]
+            assert len(set(drawn)) == 4
+            assert all(p in pool for p in drawn)
+
+if __name__ == "__main__":
+    test()
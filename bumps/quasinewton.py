@@ -50,6 +50,7 @@ __all__ = [ "quasinewton" ]
 
 from numpy import inf, sqrt, isnan, isinf
 from numpy import diag, zeros, ones, array, linalg, inner, outer, dot, amax, maximum
+from numpy import asarray, where, vstack
 
 STATUS = {
     1: "Gradient < tolerance",
@@ -66,9 +67,18 @@ STATUS = {
 def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [],
               maxstep = 100, gradtol = 1e-6, steptol = 1e-12, itnlimit = 2000,
               abort_test = None,
-              monitor = lambda **kw: True) :
+              monitor = lambda **kw: True,
+              mapper = None, central = False) :
     """
     Run a quasinewton optimization on the problem.
+
+    If no analytic gradient *grad* is given, the gradient is estimated by
+    finite differences.  *mapper* is an optional function which takes an
+    array of points and returns the value of *fn* at each point.  If it
+    is given, the perturbed points for the gradient are evaluated in one
+    call to the mapper, so use a parallel mapper when *fn* is expensive.
+    If *central* is True, use central differences rather than forward
+    differences, which doubles the number of function evaluations.
     """
     #print "starting QN"
     # If some input parameters are not specified, define default values for them
@@ -109,8 +119,8 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
         fcount = fcount + 1
     else :
         fc = fn(x0)
-        gc = fdgrad(n, x0, fc, fn, Sx, eta)
-        fcount = fcount + n + 1
+        gc = fdgrad(n, x0, fc, fn, Sx, eta, mapper, central)
+        fcount = fcount + n*(2 if central else 1) + 1
 
 
 
@@ -161,8 +171,8 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
         if analgrad == 1 :
             gp = grad(xp)
         else :
-            gp = fdgrad(n, xp, fp, fn, Sx, eta)
-            fcount = fcount + n
+            gp = fdgrad(n, xp, fp, fn, Sx, eta, mapper, central)
+            fcount = fcount + n*(2 if central else 1)
 
         # Check stopping criteria (alg.7.2.1)
         consecmax = consecmax+1 if maxtaken else 0
@@ -315,37 +325,40 @@ def choldecomp(n, H, maxoffl, macheps):
 #
 #--- EVALUATE APPR. GRADIENT
 # First evaluate function at xc + hj * ej and then estimate jth entry of
-# the gradient.
-
-def fdgrad(n, xc, fc, fn, Sx, eta) :
+# the gradient.  The points for all j are formed first so that they can be
+# evaluated together with mapper.  With central differences the function
+# is also evaluated at xc - hj * ej.
 
-    # create memory for gradient
-    g = zeros(n)
+def fdgrad(n, xc, fc, fn, Sx, eta, mapper=None, central=False) :
 
+    #--- FIND STEP SIZE hj
     sqrteta = sqrt(eta)
-    for j in range(1, n+1) :
-        #--- FIND STEP SIZE hj
-        if xc[j-1] >= 0 :
-            signxcj = 1
-        else :
-            signxcj = -1                # 1.a
-
-        hj = sqrteta * max(abs(xc[j-1]), 1/Sx[j-1]) * signxcj                # 1.b
-
-        tempj = xc[j-1]                                                                # 1.c
-        xc[j-1] = xc[j-1] + hj
-        hj = xc[j-1] - tempj
-
-        #--- EVALUATE APPR. GRADIENT
-        fj = fn(xc)
-        # PAK: hack for infeasible region: point the other way
-        if isinf(fj): fj = fc+hj
-        g[j-1] = (fj - fc)/hj
-        #if isinf(g[j-1]):
-        #    print "fc,fj,hj,Sx,xc",fc,fj,hj,Sx[j-1],xc[j-1]
-
-        # now reset the current
-        xc[j-1] = tempj
+    signxc = where(xc >= 0, 1, -1)                                      # 1.a
+    h = sqrteta * maximum(abs(xc), 1/Sx) * signxc                       # 1.b
+    h = (xc + h) - xc                                                   # 1.c
+
+    #--- EVALUATE APPR. GRADIENT
+    points = xc + diag(h)
+    if central:
+        points = vstack((points, xc - diag(h)))
+    if mapper is not None:
+        f = asarray(mapper(points), 'd')
+    else:
+        f = array([fn(p) for p in points], 'd')
+
+    # PAK: hack for infeasible region: point the other way
+    fj = where(isinf(f[:n]), fc+h, f[:n])
+    g = (fj - fc)/h
+    if central:
+        hb = xc - (xc - h)
+        fb = f[n:]
+        both = ~isinf(f[:n]) & ~isinf(fb)
+        g[both] = (fj[both] - fb[both])/(h[both] + hb[both])
+        # Use the backward difference if the forward point is infeasible
+        back = isinf(f[:n]) & ~isinf(fb)
+        g[back] = (fc - fb[back])/hb[back]
+    #if isinf(g).any():
+    #    print "fc,f,h,Sx,xc",fc,f,h,Sx,xc
 
     return g
 
@@ -744,4 +757,44 @@ def example_call():
     for k in sorted(result.keys()): print k,"=",result[k]
 
 
+def test():
+    from numpy import allclose, sin
+    # Bowl with an infeasible region for p[1] > 0.5, so that the forward
+    # step, the backward step or neither is infeasible in some dimension.
+    def fn(p):
+        if p[1] > 0.5: return inf
+        return sin(p[0]) + p[1]**2 + p[0]*p[2]**3
+    calls = []
+    def mapper(points):
+        calls.append(len(points))
+        return [fn(p) for p in points]
+    n = 3
+    Sx = ones(n)
+    eta = 2.2e-16
+    for xc in (array([0.3, -0.2, 1.5]), array([-1.2, 0.5, -0.7])):
+        fc = fn(xc)
+        h = sqrt(eta) * maximum(abs(xc), 1/Sx) * where(xc >= 0, 1, -1)
+        h = (xc + h) - xc
+
+        # Serial forward and central differences, one dimension at a time
+        forward, centered = zeros(n), zeros(n)
+        for j in range(n):
+            e = zeros(n); e[j] = h[j]
+            fj, fb = fn(xc+e), fn(xc-e)
+            forward[j] = (fj-fc)/h[j] if not isinf(fj) else 1.
+            if not isinf(fj) and not isinf(fb):
+                centered[j] = (fj-fb)/(2*h[j])
+            elif not isinf(fb):
+                centered[j] = (fc-fb)/h[j]
+            else:
+                centered[j] = forward[j]
+
+        for central, target in ((False, forward), (True, centered)):
+            del calls[:]
+            g = fdgrad(n, xc.copy(), fc, fn, Sx, eta, mapper, central)
+            assert calls == [n*(2 if central else 1)]
+            assert allclose(g, target, rtol=0, atol=1e-12), (g, target)
+            g = fdgrad(n, xc.copy(), fc, fn, Sx, eta, None, central)
+            assert allclose(g, target, rtol=0, atol=1e-12), (g, target)
+
 if __name__ == "__main__": example_call()
@@ -3,10 +3,9 @@
 
 __all__ = [ "random_lines"]
 
-from numpy import zeros, ones, asarray, sqrt
+from numpy import ones, asarray, sqrt, argmin, nonzero, where, \
+    minimum, maximum
 from numpy.random import rand, random_integers
-from copy import deepcopy
-from itertools import count, izip
 
 def print_every_five(step, x, fx, k):
     if step%5 == 0:
@@ -27,13 +26,14 @@ def random_lines(cfo, NP, CR = 0.9, epsilon = 1e-10, abort_test=None, maxiter =
     satisfied_sc = 0
 
     # CREATE FIRST GENERATION WITH LEGAL PARAMETER VALUES AND EVALUATE COSTS
-    for m in range(0, NP):                        # m th member of the population
-        X[:,m] = cfo['x1'] + (cfo['x2'] - cfo['x1']) * X[:,m]
+    x1, x2 = [asarray(v,'d')[:,None] for v in (cfo['x1'], cfo['x2'])]
+    X = x1 + (x2 - x1) * X
     if 'x0' in cfo: X[:,0] = cfo['x0']
     f = mapper(X)
 
     n_feval = NP
-    f_best, i_best = min(izip(f, count()))
+    i_best = argmin(f)
+    f_best = f[i_best]
 
     # CHECK INITIAL STOPPING CRITERIA
     if abs(cfo['f_opt']-f_best) < epsilon:
@@ -74,43 +74,36 @@ def random_lines(cfo, NP, CR = 0.9, epsilon = 1e-10, abort_test=None, maxiter =
         b = (muk/(muk - 1)) * fj - ((muk+1)/muk) * fi - (1/(muk*(muk-1))) * fk
         a = fj - fi - b
 
-        crossovers = []
-        for k in range(0,NP):
-            if abs(a[k]) < 1e-30 or (a[k] < 0 and fk[k]>fi[k] and fk[k]>fj[k]):
-                # xi survives
-                continue
-            else:
-                # xi may not survive
-                mustar = -b[k]/(2*a[k])
-                xstar = Xi[:,k] + mustar * P[:,k]
+        # xi survives if the quadratic model is flat or has a maximum
+        # between the points; otherwise it may not survive
+        survive = (abs(a) < 1e-30) | ((a < 0) & (fk > fi) & (fk > fj))
+        idx = nonzero(~survive)[0]
 
-                # choosing random numbers for crossover
-                rn = rand(n)
-                indi = (rn < 0.5*(1 - CR))
-                indj = (rn > 0.5*(1 + CR))
-                xstar[indi] = Xi[indi, k]
-                xstar[indj] = Xj[indj, k]
+        if len(idx) > 0:
+            mustar = -b[idx]/(2*a[idx])
+            xstar = Xi[:,idx] + mustar * P[:,idx]
 
-                # map into feasible set
-                inx = xstar < cfo['x1'];
-                xstar[inx] = cfo['x1'][inx];
-                inx = xstar > cfo['x2'];
-                xstar[inx] = cfo['x2'][inx];
+            # choosing random numbers for crossover
+            rn = rand(len(idx), n).T
+            indi = (rn < 0.5*(1 - CR))
+            indj = (rn > 0.5*(1 + CR))
+            xstar = where(indi, Xi[:,idx], xstar)
+            xstar = where(indj, Xj[:,idx], xstar)
 
-                crossovers.append((k,xstar))
+            # map into feasible set
+            xstar = minimum(maximum(xstar, x1), x2)
 
-        if len(crossovers) > 0:
-            idx,xstar = [asarray(v) for v in zip(*crossovers)]
-            fstar = mapper(xstar.T)
-            n_feval += len(crossovers)
+            fstar = mapper(xstar)
+            n_feval += len(idx)
 
             # xi does not survive, xstar replaces it
             update = fstar < fi[idx]
             f[idx[update]] = fstar[update]
-            X[:,idx[update]] = xstar[update,:].T
+            X[:,idx[update]] = xstar[:,update]
 
         # CHECKING STOPPING CRITERIA
-        f_best, i_best = min(izip(f, count()))
+        i_best = argmin(f)
+        f_best = f[i_best]
         if abs(cfo['f_opt']-f_best) < epsilon:
             satisfied_sc = 1
             x_best = X[:,i_best]
@@ -136,34 +129,32 @@ def particle_swarm(cfo, NP, epsilon = 1e-10, maxiter = 1000):
     K = 2 / abs(2 - phi - sqrt(phi*phi - 4*phi))
 
     X = rand(n, NP)            # will hold original vectors
-    V = zeros((n, NP))
 
     satisfied_sc = 0
 
     # CREATE FIRST GENERATION WITH LEGAL PARAMETER VALUES AND EVALUATE COSTS
     rn1 = rand(n, NP);
-    for m in range(0, NP):                        # m th member of the population
-        extend = cfo['x2'] - cfo['x1']
-        X[:,m] = cfo['x1'] + extend * X[:,m]
-        V[:,m] = 2 * rn1[:,m] * extend - extend
+    x1, x2 = [asarray(v,'d')[:,None] for v in (cfo['x1'], cfo['x2'])]
+    extend = x2 - x1
+    X = x1 + extend * X
+    V = 2 * rn1 * extend - extend
 
     if 'x0' in cfo: X[:,0] = cfo['x0']
     f = mapper(X)
 
     n_feval = NP
-    P = deepcopy(X)
+    P = X.copy()
 
-    f_best, i_best = min(izip(f, count()))
+    i_best = argmin(f)
+    f_best = f[i_best]
     for L in range(2,maxiter+1):
 
+        # only the first two random numbers for each member are used
         rn2 = rand(n, NP)
-        for i in range(0, NP):
-            #r = rand(2)
-            r = rn2[:,i];
-            V[:,i] = V[:,i] + r[0]*c1*(P[:,i] - X[:,i]) + r[1]*c2*(P[:,i_best] - X[:,i])
-            V[:,i] = K * V[:,i]
-
-            X[:,i] = X[:,i] + V[:,i]
+        r0, r1 = rn2[0], rn2[1]
+        V = V + r0*c1*(P - X) + r1*c2*(P[:,i_best:i_best+1] - X)
+        V = K * V
+        X = X + V
 
         f_temp = mapper(X)
         idx = f_temp < f
@@ -173,7 +164,8 @@ def particle_swarm(cfo, NP, epsilon = 1e-10, maxiter = 1000):
         n_feval = n_feval + NP
 
         # CHECKING STOPPING CRITERIA
-        f_best, i_best = min(izip(f, count()))
+        i_best = argmin(f)
+        f_best = f[i_best]
         if abs(cfo['f_opt']-f_best) < epsilon:
             satisfied_sc = 1
             x_best = X[:,i_best]
@@ -197,11 +189,131 @@ def example_call(optimizer=random_lines):
     satisfied_sc, n_feval, f_best, x_best = optimizer(cfo, NP)
     print satisfied_sc, "n:%d"%n_feval, f_best, x_best
 
+def _benchmark():
+    import time
+    n = 10
+    cost = lambda X: (X**2).sum(axis=0)
+    cfo = {'parallel_cost':lambda v: cost(v.T), 'n':n,
+           'x1':-5*ones(n), 'x2':5*ones(n), 'f_opt':-1,
+           'monitor':lambda *args: None}
+    for optimizer in (random_lines, particle_swarm):
+        for NP in (20, 200, 2000):
+            t0 = time.time()
+            if optimizer is random_lines:
+                optimizer(cfo, NP, abort_test=lambda: False, maxiter=100)
+            else:
+                optimizer(cfo, NP, maxiter=100)
+            print "%s NP=%d: %.2f ms per generation"\
+                %(optimizer.__name__,NP,(time.time()-t0)*10)
+
+def test():
+    """
+    Check the generations against the per-member loops they replace, with
+    the same random number seed.
+    """
+    from numpy import zeros, sin
+    from numpy.random import seed
+    n, NP = 3, 12
+    x1, x2 = -2*ones(n), 3*ones(n)
+    calls = []
+    def cost(X):
+        calls.append(X.copy())
+        return (X**2).sum(axis=1) + sin(5*X).sum(axis=1)
+    cfo = {'parallel_cost':cost, 'n':n, 'x1':x1, 'x2':x2, 'f_opt':-100,
+           'monitor':lambda *args: None}
+    mapper = lambda v: asarray(cost(v.T),'d')
+
+    def random_lines_loop(CR=0.9, maxiter=30):
+        X = rand(n, NP)
+        for m in range(0, NP):
+            X[:,m] = x1 + (x2 - x1) * X[:,m]
+        f = mapper(X)
+        for L in range(1,maxiter+1):
+            i_Xj = random_integers(0,NP-2,NP)
+            i_ge = (i_Xj >= range(0,NP))
+            i_Xj[i_ge] = i_Xj[i_ge] + 1
+            muk = 0.01 + 0.49*rand(NP)
+            inx = rand(NP) < 0.5
+            muk[inx] = -muk[inx]
+            Xi = X
+            Xj = X[:,i_Xj]
+            P = Xj - Xi
+            fk = mapper(Xi + (ones((n,1))*muk) * P)
+            fi = f
+            fj = f[i_Xj]
+            b = (muk/(muk - 1)) * fj - ((muk+1)/muk) * fi - (1/(muk*(muk-1))) * fk
+            a = fj - fi - b
+            crossovers = []
+            for k in range(0,NP):
+                if abs(a[k]) < 1e-30 or (a[k] < 0 and fk[k]>fi[k] and fk[k]>fj[k]):
+                    continue
+                xstar = Xi[:,k] + (-b[k]/(2*a[k])) * P[:,k]
+                rn = rand(n)
+                indi = (rn < 0.5*(1 - CR))
+                indj = (rn > 0.5*(1 + CR))
+                xstar[indi] = Xi[indi, k]
+                xstar[indj] = Xj[indj, k]
+                inx = xstar < x1
+                xstar[inx] = x1[inx]
+                inx = xstar > x2
+                xstar[inx] = x2[inx]
+                crossovers.append((k,xstar))
+            if len(crossovers) > 0:
+                idx,xstar = [asarray(v) for v in zip(*crossovers)]
+                fstar = mapper(xstar.T)
+                update = fstar < fi[idx]
+                f[idx[update]] = fstar[update]
+                X[:,idx[update]] = xstar[update,:].T
+        return X
+
+    def particle_swarm_loop(maxiter=30):
+        c1, c2 = 2.8, 1.3
+        phi = c1 + c2
+        K = 2 / abs(2 - phi - sqrt(phi*phi - 4*phi))
+        X = rand(n, NP)
+        V = zeros((n, NP))
+        rn1 = rand(n, NP)
+        for m in range(0, NP):
+            extend = x2 - x1
+            X[:,m] = x1 + extend * X[:,m]
+            V[:,m] = 2 * rn1[:,m] * extend - extend
+        f = mapper(X)
+        P = X.copy()
+        i_best = argmin(f)
+        for L in range(2,maxiter+1):
+            rn2 = rand(n, NP)
+            for i in range(0, NP):
+                r = rn2[:,i]
+                V[:,i] = V[:,i] + r[0]*c1*(P[:,i] - X[:,i]) + r[1]*c2*(P[:,i_best] - X[:,i])
+                V[:,i] = K * V[:,i]
+                X[:,i] = X[:,i] + V[:,i]
+            f_temp = mapper(X)
+            idx = f_temp < f
+            f[idx] = f_temp[idx]
+            P[:,idx] = X[:,idx]
+            i_best = argmin(f)
+        return X
+
+    for optimizer, loop, kw in ((random_lines, random_lines_loop,
+                                 dict(abort_test=lambda: False)),
+                                (particle_swarm, particle_swarm_loop, {})):
+        seed(5)
+        del calls[:]
+        loop()
+        target = calls[:]
+        seed(5)
+        del calls[:]
+        optimizer(cfo, NP, maxiter=30, **kw)
+        assert len(calls) == len(target)
+        for X, Xt in zip(calls, target):
+            assert X.shape == Xt.shape and (X == Xt).all()
+
 def main():
     print "=== Random Lines"
     example_call(random_lines)
     print "=== Particle Swarm"
     example_call(particle_swarm)
+    _benchmark()
 
 if __name__ == "__main__":
     main()
@@ -35,6 +35,24 @@ def wrap_function(function, bounds):
             return function(x)
     return ncalls, function_wrapper
 
+def wrap_mapper(mapper, bounds):
+    ncalls = [0]
+    if bounds is not None:
+        lo, hi = [numpy.asarray(v) for v in bounds]
+    def mapper_wrapper(points):
+        points = numpy.asarray(points)
+        ncalls[0] += len(points)
+        fx = numpy.empty(len(points))
+        fx[:] = numpy.inf
+        if bounds is not None:
+            valid = ~numpy.any((points<lo)|(points>hi), axis=1)
+        else:
+            valid = numpy.ones(len(points), bool)
+        if valid.any():
+            fx[valid] = mapper(points[valid])
+        return fx
+    return ncalls, mapper_wrapper
+
 class Result:
     """
     Results from the fit.
@@ -64,7 +82,8 @@ def dont_abort(): return False
 
 def simplex(f, x0=None, bounds=None, radius=0.05,
             xtol=1e-4, ftol=1e-4, maxiter=None,
-            update_handler=None, abort_test=dont_abort):
+            update_handler=None, abort_test=dont_abort,
+            mapper=None, speculative=False):
     """
     Minimize a function using Nelder-Mead downhill simplex algorithm.
 
@@ -83,7 +102,8 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
     *Parameters*:
 
         f : callable f(x,*args)
-            The objective function to be minimized.
+            The objective function to be minimized.  This may be None if
+            *mapper* is given.
         x0 : ndarray
             Initial guess.
         bounds : (ndarray,ndarray) or None
@@ -120,6 +140,20 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
             where k is the current iteration, n is the maximum
             iteration, xk is the simplex and fxk is the value of
             the simplex vertices.  xk[0],fxk[0] is the current best.
+        mapper : callable mapper(points)
+            Evaluate the objective function for each row of *points*,
+            returning a vector of values.  If given, the vertices of the
+            initial simplex and of each shrink step are evaluated in one
+            call to the mapper, so use a parallel mapper when the function
+            is expensive.  Single points are evaluated with *f*, or with
+            the mapper if *f* is None.
+        speculative : boolean
+            If True, evaluate the reflection, expansion and both
+            contraction candidates in a single call to *mapper* at each
+            iteration rather than evaluating them one at a time as needed.
+            This takes extra evaluations in exchange for fewer rounds,
+            which is faster when the mapper has at least four processors
+            available.  The sequence of simplex updates is unchanged.
 
     *Notes*
 
@@ -127,7 +161,16 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         function of one or more variables.
 
     """
-    fcalls, func = wrap_function(f, bounds)
+    fcalls, mcalls = [0], [0]
+    if f is not None:
+        fcalls, func = wrap_function(f, bounds)
+    if mapper is not None:
+        mcalls, fmap = wrap_mapper(mapper, bounds)
+        if f is None:
+            func = lambda x: fmap([x])[0]
+    else:
+        fmap = lambda points: numpy.array([func(x) for x in points])
+        speculative = False
     x0 = numpy.asfarray(x0).flatten()
     #print "x0",x0
     N = len(x0)
@@ -146,7 +189,6 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         sim = numpy.zeros((N+1,N), dtype=x0.dtype)
     fsim = numpy.zeros((N+1,), float)
     sim[0] = x0
-    fsim[0] = func(x0)
 
     # Metropolitan simplex: simplex has vertices at x0 and at
     # x0 + j*radius for each unit vector j.  Radius is a percentage
@@ -188,7 +230,7 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         y = x0+0
         y[k] = val[k]
         sim[k+1] = y
-        fsim[k+1] = func(y)
+    fsim[:] = fmap(sim)
 
     #print sim
     ind = numpy.argsort(fsim)
@@ -206,14 +248,20 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
 
         xbar = numpy.sum(sim[:-1],0) / N
         xr = (1+rho)*xbar - rho*sim[-1]
+        xe = (1+rho*chi)*xbar - rho*chi*sim[-1]
+        xc = (1+psi*rho)*xbar - psi*rho*sim[-1]
+        xcc = (1-psi)*xbar + psi*sim[-1]
         #print "xbar" ,xbar,rho,sim[-1],N
         #break
-        fxr = func(xr)
+        if speculative:
+            fxr, fxe, fxc, fxcc = fmap([xr, xe, xc, xcc])
+        else:
+            fxr = func(xr)
         doshrink = 0
 
         if fxr < fsim[0]:
-            xe = (1+rho*chi)*xbar - rho*chi*sim[-1]
-            fxe = func(xe)
+            if not speculative:
+                fxe = func(xe)
 
             if fxe < fxr:
                 sim[-1] = xe
@@ -228,8 +276,8 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
             else: # fxr >= fsim[-2]
                 # Perform contraction
                 if fxr < fsim[-1]:
-                    xc = (1+psi*rho)*xbar - psi*rho*sim[-1]
-                    fxc = func(xc)
+                    if not speculative:
+                        fxc = func(xc)
 
                     if fxc <= fxr:
                         sim[-1] = xc
@@ -238,8 +286,8 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
                         doshrink=1
                 else:
                     # Perform an inside contraction
-                    xcc = (1-psi)*xbar + psi*sim[-1]
-                    fxcc = func(xcc)
+                    if not speculative:
+                        fxcc = func(xcc)
 
                     if fxcc < fsim[-1]:
                         sim[-1] = xcc
@@ -248,9 +296,8 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
                         doshrink = 1
 
                 if doshrink:
-                    for j in xrange(1,N+1):
-                        sim[j] = sim[0] + sigma*(sim[j] - sim[0])
-                        fsim[j] = func(sim[j])
+                    sim[1:] = sim[0] + sigma*(sim[1:] - sim[0])
+                    fsim[1:] = fmap(sim[1:])
 
         ind = numpy.argsort(fsim)
         sim = numpy.take(sim,ind,0)
@@ -261,7 +308,7 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         if abort_test(): break #STOPHERE
 
     status = 0 if iterations < maxiter else 1
-    res = Result(sim[0], fsim[0], iterations, fcalls[0], status)
+    res = Result(sim[0], fsim[0], iterations, fcalls[0]+mcalls[0], status)
     res.next_start = sim[numpy.random.randint(N)]
     return res
 
@@ -332,5 +379,62 @@ def main():
     print x
     print "Time:",time.time() - start
 
+
+    x0 = [0.8,1.2,0.7]
+    print "Batch Nelder-Mead Simplex"
+    print "========================="
+    print "speculative evaluation of the candidate vertices through a mapper"
+    start = time.time()
+    x = simplex(None,x0,mapper=lambda P: [rosen(p) for p in P],
+                speculative=True)
+    print x
+    print "Time:",time.time() - start
+
+def test():
+    """
+    Check that evaluating through a mapper, with or without speculative
+    evaluation of the candidate vertices, follows the same simplex steps.
+    """
+    def rosen(x):
+        return numpy.sum(100.0*(x[1:]-x[:-1]**2.0)**2.0 + (1-x[:-1])**2.0)
+    x0 = [0.8,1.2,0.7]
+    bounds = [0.]*3, [1.1]*3
+    def run(f, speculative=False, use_mapper=True):
+        steps, sizes = [], []
+        def mapper(points):
+            sizes.append(len(points))
+            assert all(((p >= 0) & (p <= 1.1)).all() for p in points)
+            return [rosen(p) for p in points]
+        def handler(k, n, x, fx):
+            steps.append((x+0, fx+0))
+        res = simplex(f, x0, bounds=bounds, update_handler=handler,
+                      mapper=mapper if use_mapper else None,
+                      speculative=speculative)
+        return res, steps, sizes
+
+    target, target_steps, _ = run(rosen, use_mapper=False)
+    assert abs(target.fx) < 1e-6
+    for f, speculative in ((rosen, False), (None, False),
+                           (rosen, True), (None, True)):
+        res, steps, sizes = run(f, speculative)
+        assert len(steps) == len(target_steps)
+        for (x, fx), (tx, tfx) in zip(steps, target_steps):
+            assert (x == tx).all() and (fx == tfx).all()
+        assert (res.x == target.x).all() and res.fx == target.fx
+        if speculative:
+            assert res.calls > target.calls
+        else:
+            assert res.calls == target.calls
+        # Speculative runs send the candidates to the mapper each step.
+        # Otherwise single points go to the mapper only when there is no
+        # f, so with f the mapper sees just the initial simplex and the
+        # shrink steps.
+        if speculative:
+            assert len(sizes) > len(steps)
+        elif f is not None:
+            assert 1 not in sizes and len(sizes) < len(steps)
+        else:
+            assert 1 in sizes
+
 if __name__ == "__main__":
     main()